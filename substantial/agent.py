@@ -1,6 +1,8 @@
 import asyncio
-from contextlib import suppress
-from substantial.backends.backend import Backend
+from datetime import datetime, timedelta
+import signal
+from typing import Any, Set, Union
+from substantial.backends.backend import Backend, Watch
 import uvloop
 
 from substantial.workflows.run import Run
@@ -9,36 +11,133 @@ from substantial.workflows.run import Run
 # move to backend?
 lease_seconds = 10
 renew_seconds = 8
-pool_interval = 1
 
 
 class Agent:
-    def __init__(self, backend: Backend, queue: str):
+    """
+    Claims the runs of a queue and replays up to `concurrency` of them at once
+    on the event loop, each under its own lease (renewed by a heartbeat).
+    No run is claimed while all the slots are taken (backpressure).
+
+    The number of runs in flight is reported to `in_flight` and the seconds the
+    last claimed run waited once due to `claim_lag` (shared multiprocessing.Value)
+    if given, see AgentPool.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        queue: str,
+        concurrency: int = 32,
+        in_flight: Any = None,
+        claim_lag: Any = None,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be positive, got {concurrency}")
+
         self.backend = backend
         self.queue = queue
+        self.concurrency = concurrency
+        self.in_flight = in_flight
+        self.claim_lag = claim_lag
+        self.active: Set[asyncio.Task] = set()
+        self.claiming: Union[asyncio.Task, None] = None
+        self.stopped = False
 
     def run_sync(self):
+        async def main():
+            # stopped by its pool or conductor, see stop
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+            await self.run()
+
         with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
-            runner.run(self.run())
+            runner.run(main())
+
+    def stop(self):
+        """Stop claiming, run returns once the runs in flight are replayed"""
+        self.stopped = True
+        if self.claiming is not None:
+            self.claiming.cancel()
 
     async def run(self):
-        while True:
-            await self.poll_with_lease()
-            await asyncio.sleep(pool_interval)
+        self.claiming = asyncio.create_task(self.claim_loop())
+        try:
+            await self.claiming
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling() > 0:
+                # cancelled itself, the runs in flight are abandoned
+                active = list(self.active)
+                for task in active:
+                    task.cancel()
+                await asyncio.gather(*active, return_exceptions=True)
+                raise
+        await asyncio.gather(*list(self.active), return_exceptions=True)
+
+    async def claim_loop(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        # woken up on new schedules, polling is only the fallback
+        watch = await self.backend.watch_schedules(self.queue)
+        # and on the runs replayed here, as their leases (which made claim skip
+        # the schedules added meanwhile, e.g. by a send) are released
+        freed = asyncio.Event()
+        try:
+            while not self.stopped:
+                await slots.acquire()
+                freed.clear()
+                claimed = await self.claim()
+                if claimed is None:
+                    slots.release()
+                    await self.idle(watch, freed)
+                    continue
+
+                # claim again right away, until saturated or drained
+                task = asyncio.create_task(self.process(*claimed))
+                self.active.add(task)
+                task.add_done_callback(self.active.discard)
+                task.add_done_callback(lambda _: slots.release())
+                task.add_done_callback(lambda _: self.report())
+                task.add_done_callback(lambda _: freed.set())
+                self.report()
+        finally:
+            await watch.close()
+
+    def report(self):
+        if self.in_flight is not None:
+            self.in_flight.value = len(self.active)
+
+    async def idle(self, watch: Watch, freed: asyncio.Event):
+        """Until a change of the queue, a replay of this agent ends or idle_seconds"""
+        waiting = asyncio.create_task(watch.wait(await self.idle_seconds(watch)))
+        freeing = asyncio.create_task(freed.wait())
+        try:
+            await asyncio.wait([waiting, freeing], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in [waiting, freeing]:
+                task.cancel()
+            await asyncio.gather(waiting, freeing, return_exceptions=True)
 
-    async def poll_with_lease(self):
-        active_leases = await self.backend.active_leases(lease_seconds)
-        next_run = await self.backend.next_run(self.queue, active_leases)
+    async def idle_seconds(self, watch: Watch) -> float:
+        """Until the next schedule is due, polling at least every watch.poll_seconds"""
+        due = await self.backend.next_due(self.queue)
+        if due is None:
+            return watch.poll_seconds
+        until_due = (due - datetime.now()).total_seconds()
+        return max(0, min(watch.poll_seconds, until_due))
+
+    async def claim(self):
+        next_run = await self.backend.claim_next(self.queue, lease_seconds)
         print("run_id", next_run)
-        print("active leases", active_leases)
+        if self.claim_lag is not None:
+            # nothing claimed, nothing due is left waiting for this agent
+            lag = timedelta(0) if next_run is None else datetime.now() - next_run[1]
+            self.claim_lag.value = max(0, lag.total_seconds())
 
         if next_run is None:
             print("no runs")
-            await asyncio.sleep(1)
-            return
-
-        run_id, schedule = next_run
+        return next_run
 
+    async def process(self, run_id: str, schedule: datetime):
         async def heartbeat():
             while True:
                 await asyncio.sleep(renew_seconds)
@@ -46,25 +145,31 @@ class Agent:
                 if not renewed:
                     return
 
-        leased = await self.backend.acquire_lease(run_id, lease_seconds)
-        if not leased:
-            return
-
         renew_task = asyncio.create_task(heartbeat())
         run = Run(run_id, self.queue, self.backend)
         process_task = asyncio.create_task(run.replay(schedule))
 
-        done, pending = await asyncio.wait(
-            [
-                renew_task,
-                process_task,
-            ],
-            return_when=asyncio.FIRST_COMPLETED,
-        )
-        done = done.pop()
-        pending = pending.pop()
-
-        pending.cancel()
-        with suppress(asyncio.CancelledError):
-            await pending
+        try:
+            done, _ = await asyncio.wait(
+                [
+                    renew_task,
+                    process_task,
+                ],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            for task in [renew_task, process_task]:
+                task.cancel()
+            await asyncio.gather(renew_task, process_task, return_exceptions=True)
+
+        if process_task not in done:
+            # someone else may hold it by now
+            print(f"lease of {run_id} lost, replay abandoned")
+            return
+
+        if process_task.exception() is not None:
+            print(f"replay of {run_id} failed: {process_task.exception()}")
+        try:
             await self.backend.remove_lease(run_id, lease_seconds)
+        except Exception as e:
+            print(f"lease of {run_id} not removed: {e}")
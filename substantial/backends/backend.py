@@ -1,16 +1,91 @@
-from datetime import datetime
-from typing import List, Tuple, Union
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple, Union
 from substantial.protos.events import Event, Records
-from substantial.protos.metadata import Metadata
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+class ConflictError(Exception):
+    """Raised when a concurrent writer has already changed the stored state"""
+
+
+@dataclass(frozen=True)
+class Retention:
+    """
+    Bound the metadata kept per run, as every replay appends one entry:
+      * max_entries => only the most recent entries are kept
+      * ttl => entries are dropped once older than it
+    Dropped entries are only counted (see read_dropped_metadata).
+    """
+
+    max_entries: Union[int, None] = None
+    ttl: Union[timedelta, None] = None
+
+    def __post_init__(self):
+        if self.max_entries is not None and self.max_entries < 1:
+            raise ValueError(f"max_entries must be positive, got {self.max_entries}")
+        if self.ttl is not None and self.ttl <= timedelta(0):
+            raise ValueError(f"ttl must be positive, got {self.ttl}")
+
+
+class Watch:
+    """
+    Wakeups on the changes of a queue or a run (see Backend.watch_schedules).
+    Subscribed once created, so that a change between reading the state and
+    waiting is not missed. This fallback has no notifications, it only polls.
+    """
+
+    # longest wait between two reads of the state
+    poll_seconds: float = 1
+
+    async def wait(self, timeout: float) -> None:
+        """Return on a change (possibly spurious) or after timeout seconds"""
+        await asyncio.sleep(timeout)
+
+    async def close(self) -> None:
+        pass
+
+
+class LocalWatch(Watch):
+    """Watch notified from the event loop of the process"""
+
+    # notified, the reads only catch what has no notification (e.g. expired leases)
+    poll_seconds: float = 30
+
+    def __init__(self, on_close: Callable[[], None] = lambda: None):
+        self.changed = asyncio.Event()
+        self.on_close = on_close
+
+    def notify(self) -> None:
+        self.changed.set()
+
+    async def wait(self, timeout: float) -> None:
+        with suppress(TimeoutError):
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        self.changed.clear()
+
+    async def close(self) -> None:
+        self.on_close()
 
 
 class Backend:
+    # state only reachable from the current process, agents must then run in it
+    process_local = False
+
     # metadata related
-    async def read_all_metadata(self, run_id: str) -> List[Metadata]:
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
+        raise NotImplementedError()
+
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        """
+        Number of metadata entries of the run dropped by the retention policy.
+        """
         raise NotImplementedError()
 
     async def append_metadata(
-        self, run_id: str, schedule: datetime, content: str
+        self, run_id: str, schedule: datetime, content: MetadataRecords
     ) -> None:
         raise NotImplementedError()
 
@@ -27,6 +102,15 @@ class Backend:
     async def write_events(self, run_id: str, content: Records) -> None:
         raise NotImplementedError()
 
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        """
+        Append `new_events` to the history, provided that it still holds
+        `expected_len` events (ConflictError otherwise).
+        """
+        raise NotImplementedError()
+
     async def add_schedule(
         self, queue: str, run_id: str, schedule: datetime, content: Union[Event, None]
     ) -> None:
@@ -40,11 +124,78 @@ class Backend:
     async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
         raise NotImplementedError()
 
+    async def commit_replay(
+        self,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        new_events: List[Event],
+        expected_len: int,
+        metadata: MetadataRecords,
+        next_schedule: Union[Tuple[datetime, Union[Event, None]], None],
+    ) -> None:
+        """
+        Persist the outcome of a replay: append its events and metadata, close the
+        replayed schedule and add the follow-up one (if any).
+
+        Backends should apply it in one round trip and atomically, this fallback
+        only orders the steps so that a crash replays the run again rather than
+        losing it.
+        """
+        await self.append_events(run_id, new_events, expected_len)
+        await self.append_metadata(run_id, schedule, metadata)
+
+        if next_schedule is None:
+            await self.close_schedule(queue, run_id, schedule)
+        elif next_schedule[0] == schedule:
+            await self.close_schedule(queue, run_id, schedule)
+            await self.add_schedule(queue, run_id, *next_schedule)
+        else:
+            await self.add_schedule(queue, run_id, *next_schedule)
+            await self.close_schedule(queue, run_id, schedule)
+
     # agent related
 
     async def next_run(
         self, queue: str, excludes: list[str]
     ) -> Union[Tuple[str, datetime], None]:
+        """
+        Earliest due schedule (not in the future) of a run not excluded.
+        """
+        raise NotImplementedError()
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        """
+        Earliest schedule of the queue still in the future, so that agents can
+        sleep until then (None if unknown, they then poll).
+        """
+        return None
+
+    async def queue_depth(self, queue: str) -> int:
+        """
+        Number of due schedules of the queue (the ones in flight included),
+        used to size the agent pools.
+        """
+        raise NotImplementedError()
+
+    async def watch_schedules(self, queue: str) -> Watch:
+        """
+        Wakeups on the new schedules of the queue, agents poll without them.
+        """
+        return Watch()
+
+    async def watch_events(self, run_id: str) -> Watch:
+        """
+        Wakeups on the new events of the run, result waiters poll without them.
+        """
+        return Watch()
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        """
+        Lease the run of the earliest due schedule not leased yet, atomically.
+        """
         raise NotImplementedError()
 
     async def active_leases(self, lease_seconds: int) -> List[str]:
@@ -0,0 +1,142 @@
+from dataclasses import dataclass
+from typing import Type, TypeVar, Union
+import zlib
+
+import betterproto
+
+try:
+    import zstandard
+except ImportError:  # optional (zstd extra), only required by the zstd algorithm
+    zstandard = None
+
+
+T = TypeVar("T", bound=betterproto.Message)
+
+# 0xff never starts a JSON document (invalid utf-8 byte), payloads starting with it
+# are binary and carry their format on the next byte, anything else is legacy JSON
+MAGIC = b"\xff"
+FORMAT_PROTOBUF = 1
+FORMAT_ZLIB = 2
+FORMAT_ZSTD = 3
+
+
+@dataclass(frozen=True)
+class Compression:
+    """
+    Compress the binary payloads larger than `threshold` bytes (e.g. big saved values).
+    A `dictionary` trained on typical payloads helps small ones, it must then
+    be the same for all the readers/writers of the backend.
+    zstd (the zstd extra) is opt-in: all the readers then need the zstandard package.
+    """
+
+    threshold: int = 1024
+    level: int = 3
+    dictionary: Union[bytes, None] = None
+    algorithm: str = "zlib"
+
+    def __post_init__(self):
+        if self.algorithm not in ("zstd", "zlib"):
+            raise ValueError(
+                f"Unknown algorithm {self.algorithm}, must be zstd or zlib"
+            )
+        if self.algorithm == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+
+@dataclass
+class CompressionStats:
+    encoded: int = 0
+    compressed: int = 0
+    raw_bytes: int = 0
+    stored_bytes: int = 0
+
+    @property
+    def ratio(self) -> float:
+        """raw size / stored size of the binary payloads encoded so far"""
+        return self.raw_bytes / self.stored_bytes if self.stored_bytes > 0 else 1.0
+
+
+class Codec:
+    """
+    (De)serialization of the stored messages (events, schedules, metadata).
+      - binary => MAGIC + format byte + protobuf wire encoding (maybe compressed)
+      - json => betterproto JSON, as written by the previous versions
+    Both are always readable, so existing runs are migrated lazily on rewrite.
+    """
+
+    def __init__(
+        self,
+        binary: bool = True,
+        compression: Union[Compression, None] = None,
+    ):
+        self.binary = binary
+        self.compression = compression
+        self.stats = CompressionStats()
+
+        self._zstd_compressor = None
+        self._zstd_decompressor = None
+        if zstandard is not None:
+            dict_data = None
+            if compression is not None and compression.dictionary is not None:
+                dict_data = zstandard.ZstdCompressionDict(compression.dictionary)
+            if compression is not None and compression.algorithm == "zstd":
+                self._zstd_compressor = zstandard.ZstdCompressor(
+                    level=compression.level, dict_data=dict_data
+                )
+            self._zstd_decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def encode(self, message: betterproto.Message) -> bytes:
+        if not self.binary:
+            return message.to_json().encode()
+
+        raw = bytes(message)
+        fmt, stored = FORMAT_PROTOBUF, raw
+        if self.compression is not None and len(raw) >= self.compression.threshold:
+            fmt, compressed = self._compress(raw)
+            if len(compressed) < len(raw):
+                stored = compressed
+                self.stats.compressed += 1
+            else:
+                fmt = FORMAT_PROTOBUF
+
+        self.stats.encoded += 1
+        self.stats.raw_bytes += len(raw)
+        self.stats.stored_bytes += len(stored)
+        return MAGIC + bytes([fmt]) + stored
+
+    def decode(self, data: bytes, cls: Type[T]) -> T:
+        if data[:1] != MAGIC:
+            return cls().from_json(data)
+
+        fmt = data[1]
+        if fmt == FORMAT_PROTOBUF:
+            return cls().parse(data[2:])
+        if fmt == FORMAT_ZLIB:
+            return cls().parse(self._zlib_decompress(data[2:]))
+        if fmt == FORMAT_ZSTD:
+            if self._zstd_decompressor is None:
+                raise ValueError(
+                    "zstd payload found, the zstandard package is required"
+                )
+            return cls().parse(self._zstd_decompressor.decompress(data[2:]))
+
+        raise ValueError(f"Unknown format {fmt}, written by a newer version?")
+
+    def _compress(self, raw: bytes):
+        if self._zstd_compressor is not None:
+            return FORMAT_ZSTD, self._zstd_compressor.compress(raw)
+
+        if self.compression.dictionary is not None:
+            c = zlib.compressobj(
+                self.compression.level, zdict=self.compression.dictionary
+            )
+        else:
+            c = zlib.compressobj(self.compression.level)
+        return FORMAT_ZLIB, c.compress(raw) + c.flush()
+
+    def _zlib_decompress(self, data: bytes) -> bytes:
+        if self.compression is not None and self.compression.dictionary is not None:
+            d = zlib.decompressobj(zdict=self.compression.dictionary)
+        else:
+            d = zlib.decompressobj()
+        return d.decompress(data) + d.flush()
@@ -0,0 +1,344 @@
+import argparse
+import asyncio
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+import importlib
+from importlib.metadata import PackageNotFoundError, version
+import statistics
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Union
+from uuid import uuid4
+
+import orjson as json
+from substantial.backends.backend import Backend, ConflictError
+from substantial.protos.events import Event, Records, Save, Start
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+class ConformanceError(Exception):
+    """Raised when a backend does not honour the contract of Backend"""
+
+
+def expect(condition: bool, message: str) -> None:
+    if not condition:
+        raise ConformanceError(message)
+
+
+def unique(name: str) -> str:
+    # the suite only touches fresh queues and runs, any store can be used
+    return f"conformance-{name}-{uuid4()}"
+
+
+def past() -> datetime:
+    # schedules already due, dispatched right away
+    return datetime.now() - timedelta(hours=1)
+
+
+def save(i: int) -> Event:
+    return Event(save=Save(i, json.dumps(i), -1))
+
+
+# Checks
+
+
+async def check_lease_exclusion(backend: Backend, agents: int) -> None:
+    """Concurrent agents racing for the same lease, exactly one wins"""
+    for _ in range(4):
+        run_id = unique("lease")
+        won = await asyncio.gather(
+            *[backend.acquire_lease(run_id, 30) for _ in range(agents)]
+        )
+        expect(sum(won) == 1, f"{sum(won)} agents acquired the lease of {run_id}")
+        expect(run_id in await backend.active_leases(30), f"{run_id} lease not active")
+        expect(await backend.renew_lease(run_id, 30), f"{run_id} lease not renewed")
+        await backend.remove_lease(run_id, 30)
+        expect(await backend.acquire_lease(run_id, 30), f"{run_id} lease not freed")
+
+
+async def check_claim_exclusion(backend: Backend, agents: int) -> None:
+    """Concurrent agents claiming a queue, each run is claimed once"""
+    queue = unique("claim")
+    runs = [unique("run") for _ in range(2 * agents)]
+    start = past()
+    for i, run_id in enumerate(runs):
+        await backend.add_schedule(queue, run_id, start + timedelta(seconds=i), None)
+
+    async def agent():
+        claimed = []
+        while (found := await backend.claim_next(queue, 30)) is not None:
+            claimed.append(found[0])
+        return claimed
+
+    claimed = await asyncio.gather(*[agent() for _ in range(agents)])
+    claims = [run_id for runs_claimed in claimed for run_id in runs_claimed]
+    expect(len(claims) == len(set(claims)), "a run was claimed more than once")
+    expect(sorted(claims) == sorted(runs), "not every run was claimed")
+
+
+async def check_ordering(backend: Backend, size: int) -> None:
+    """Runs come out by schedule whatever the insertion order"""
+    queue = unique("ordering")
+    start = past()
+    schedules = [(start + timedelta(seconds=i), unique("run")) for i in range(size)]
+    # interleaved insertion order
+    for schedule, run_id in schedules[1::2] + schedules[::2]:
+        await backend.add_schedule(queue, run_id, schedule, None)
+
+    seen = []
+    while (found := await backend.next_run(queue, seen)) is not None:
+        seen.append(found[0])
+        expect(len(seen) <= size, "next_run returned excluded runs")
+    expect(seen == [run_id for _, run_id in schedules], "next_run is not by schedule")
+
+    for schedule, run_id in schedules:
+        found = await backend.next_run(queue, [])
+        expect(found == (run_id, schedule), f"expected {run_id} next, got {found}")
+        await backend.close_schedule(queue, run_id, schedule)
+    expect(await backend.next_run(queue, []) is None, "closed schedules remain")
+
+
+async def check_coalescing(backend: Backend) -> None:
+    """A new schedule overwrites the earlier replays of the run, not its events"""
+    queue, run_id = unique("coalescing"), unique("run")
+    event = Event(start=Start())
+    schedules = [past() + timedelta(seconds=i) for i in range(4)]
+    await backend.add_schedule(queue, run_id, schedules[0], None)
+    await backend.add_schedule(queue, run_id, schedules[1], event)
+    await backend.add_schedule(queue, run_id, schedules[2], None)
+    await backend.add_schedule(queue, run_id, schedules[3], None)
+
+    pending = []
+    while (found := await backend.next_run(queue, [])) is not None:
+        _, schedule = found
+        pending.append((schedule, await backend.read_schedule(queue, run_id, schedule)))
+        await backend.close_schedule(queue, run_id, schedule)
+        expect(len(pending) <= 4, "closed schedules remain")
+
+    expect(
+        pending == [(schedules[1], event), (schedules[3], None)],
+        f"expected the event and the last replay, got {pending}",
+    )
+
+
+async def check_due_only(backend: Backend) -> None:
+    """Future schedules are not dispatched, the next one due is reported"""
+    queue, due_run, later_run = unique("due"), unique("run"), unique("run")
+    due, later = past(), datetime.now() + timedelta(hours=1)
+    await backend.add_schedule(queue, later_run, later, None)
+    await backend.add_schedule(queue, due_run, due, None)
+
+    expect(await backend.next_run(queue, []) == (due_run, due), "due run not next")
+    expect(await backend.next_run(queue, [due_run]) is None, "future run dispatched")
+    expect(await backend.claim_next(queue, 30) == (due_run, due), "due run not claimed")
+    expect(await backend.claim_next(queue, 30) is None, "future run claimed")
+    depth = await backend.queue_depth(queue)
+    expect(depth == 1, f"expected 1 due schedule (in flight), got {depth}")
+    next_due = await backend.next_due(queue)
+    expect(next_due in (None, later), f"expected {later} next due, got {next_due}")
+
+
+async def check_append_conflict(backend: Backend) -> None:
+    """Appends at a stale length are rejected, nothing is written"""
+    run_id = unique("events")
+    await backend.append_events(run_id, [save(0), save(1)], 0)
+    try:
+        await backend.append_events(run_id, [save(2)], 1)
+        raise ConformanceError("stale append accepted")
+    except ConflictError:
+        pass
+    records = await backend.read_events(run_id)
+    expect(
+        records is not None and records.events == [save(0), save(1)],
+        "stale append altered the history",
+    )
+
+
+# Benchmarks
+
+
+def summary(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def timed(fn: Callable[[], Awaitable[Any]]) -> float:
+    start = time.perf_counter()
+    await fn()
+    return time.perf_counter() - start
+
+
+async def bench_schedules(
+    backend: Backend, pending: Sequence[int], samples: int, concurrency: int
+) -> List[Dict[str, Any]]:
+    """add_schedule throughput and next_run latency vs pending schedules"""
+    results = []
+    for size in pending:
+        queue = unique("schedules")
+        runs = [unique("run") for _ in range(size)]
+        start = past()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def add(i: int):
+            async with semaphore:
+                await backend.add_schedule(
+                    queue, runs[i], start + timedelta(seconds=i), None
+                )
+
+        elapsed = await timed(lambda: asyncio.gather(*[add(i) for i in range(size)]))
+
+        next_run = [
+            await timed(lambda: backend.next_run(queue, [])) for _ in range(samples)
+        ]
+        results.append(
+            {
+                "pending": size,
+                "add_schedule_per_second": size / elapsed,
+                "next_run": summary(next_run),
+            }
+        )
+    return results
+
+
+async def bench_replays(
+    backend: Backend, histories: Sequence[int], samples: int
+) -> List[Dict[str, Any]]:
+    """read_events and commit_replay latency vs history length"""
+    results = []
+    for length in histories:
+        queue, run_id = unique("replays"), unique("run")
+        await backend.write_events(
+            run_id, Records(run_id=run_id, events=[save(i) for i in range(length)])
+        )
+        schedule = past()
+        await backend.add_schedule(queue, run_id, schedule, None)
+
+        reads, commits = [], []
+        for i in range(samples):
+            reads.append(await timed(lambda: backend.read_events(run_id)))
+            next_schedule = schedule + timedelta(seconds=1)
+            commits.append(
+                await timed(
+                    lambda: backend.commit_replay(
+                        queue,
+                        run_id,
+                        schedule,
+                        [save(length + i)],
+                        length + i,
+                        MetadataRecords(run_id=run_id),
+                        (next_schedule, None),
+                    )
+                )
+            )
+            schedule = next_schedule
+
+        results.append(
+            {
+                "history": length,
+                "read_events": summary(reads),
+                "commit_replay": summary(commits),
+            }
+        )
+    return results
+
+
+async def run_suite(
+    backend: Backend,
+    *,
+    agents: int = 8,
+    pending: Sequence[int] = (10, 100, 1000),
+    histories: Sequence[int] = (10, 100, 1000),
+    samples: int = 20,
+    benchmarks: bool = True,
+) -> Dict[str, Any]:
+    """
+    Check that the backend honours the contract of Backend, then measure it.
+    The report is JSON serializable, so that runs can be compared across versions.
+
+    Only fresh queues and runs are used, but they are left behind: point the
+    backend to a scratch store.
+    """
+    checks: Dict[str, Callable[[], Awaitable[None]]] = {
+        "lease_exclusion": lambda: check_lease_exclusion(backend, agents),
+        "claim_exclusion": lambda: check_claim_exclusion(backend, agents),
+        "ordering": lambda: check_ordering(backend, 2 * agents),
+        "coalescing": lambda: check_coalescing(backend),
+        "due_only": lambda: check_due_only(backend),
+        "append_conflict": lambda: check_append_conflict(backend),
+    }
+
+    report: Dict[str, Any] = {
+        "backend": type(backend).__name__,
+        "version": package_version(),
+        "at": datetime.now(timezone.utc).isoformat(),
+        "checks": {},
+        "benchmarks": {},
+    }
+    for name, check in checks.items():
+        start = time.perf_counter()
+        try:
+            await check()
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        report["checks"][name] = {
+            "ok": error is None,
+            "error": error,
+            "seconds": time.perf_counter() - start,
+        }
+
+    if benchmarks:
+        report["benchmarks"] = {
+            "schedules": await bench_schedules(backend, pending, samples, agents),
+            "replays": await bench_replays(backend, histories, samples),
+        }
+    return report
+
+
+def package_version() -> Union[str, None]:
+    try:
+        return version("substantial")
+    except PackageNotFoundError:
+        return None
+
+
+def main(argv: Union[Sequence[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m substantial.backends.conformance",
+        description="Run the backend conformance suite, print the JSON report.",
+    )
+    parser.add_argument("backend", help="e.g. substantial.backends.fs:FSBackend")
+    parser.add_argument(
+        "options", nargs="?", default="{}", help='JSON kwargs, e.g. {"root": "./b"}'
+    )
+    parser.add_argument("--agents", type=int, default=8)
+    parser.add_argument("--pending", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--histories", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--samples", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    module, name = args.backend.split(":")
+    backend = getattr(importlib.import_module(module), name)(**json.loads(args.options))
+    # the backends may print, stdout is kept for the report
+    with redirect_stdout(sys.stderr):
+        report = asyncio.run(
+            run_suite(
+                backend,
+                agents=args.agents,
+                pending=args.pending,
+                histories=args.histories,
+                samples=args.samples,
+            )
+        )
+    sys.stdout.buffer.write(json.dumps(report, option=json.OPT_INDENT_2) + b"\n")
+    return 0 if all(check["ok"] for check in report["checks"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
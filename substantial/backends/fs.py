@@ -1,146 +1,577 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime, timedelta
+from functools import partial
+import os
 from pathlib import Path
-from typing import List, Tuple, Union
+import shutil
+from typing import Callable, List, Tuple, TypeVar, Union
 from uuid import uuid4
-from substantial.backends.backend import Backend
+from substantial.backends.backend import Backend, ConflictError, Retention, Watch
+from substantial.backends.codec import Codec, Compression
+from substantial.backends.fs_index import Change, ScheduleIndexes, locked
+from substantial.backends.fs_io import Durability, Syncer, make_dirs, write_atomic
+from substantial.backends.fs_log import EventLog
+from substantial.backends.fs_watch import watch
 from substantial.protos.events import Event, Records
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+T = TypeVar("T")
 
 
 class FSBackend(Backend):
     """
     This backend is for testing purposes only as it is not scalable:
-      - there is no file order in POSIX
+      - there is no file order in POSIX, each process keeps a sorted index
+        of the schedules in memory (see fs_index)
       - all the runs need to be loaded in memory
       - not all required operations are atomic or using compare-and-swap
+
+    The blocking file operations of each call run together on a thread pool
+    (opened lazily per process), so that a slow disk does not stall the event
+    loop, e.g. the heartbeats of the agent.
+
+    Files are written aside (in tmp/) and renamed over, a crash never leaves
+    a truncated one behind.
     """
 
-    def __init__(self, root: str):
+    def __init__(
+        self,
+        root: str,
+        binary: bool = True,
+        compression: Union[Compression, None] = Compression(),
+        retention: Retention = Retention(),
+        io_concurrency: int = 8,
+        durability: Union[Durability, None] = None,
+        segment_size: int = 1 << 20,
+    ):
+        """
+        * root => directory holding the runs, schedules and leases
+        * binary => protobuf wire encoding of the stored messages (JSON otherwise)
+        * compression => compression of the large binary payloads (None to disable)
+        * retention => bounds on the metadata kept per run (unbounded by default)
+        * io_concurrency => threads running the file operations of a process
+        * durability => fsync the writes before returning (None to leave it to the OS)
+        * segment_size => bytes after which the event log of a run starts a new segment
+        """
+        if io_concurrency < 1:
+            raise ValueError(f"io_concurrency must be positive, got {io_concurrency}")
+
         self.root = Path(root)
-        for d in ["runs", "schedules", "leases"]:
+        self.codec = Codec(binary, compression)
+        self.retention = retention
+        self.io_concurrency = io_concurrency
+        self.durability = durability
+        self.segment_size = segment_size
+        self.indexes = ScheduleIndexes(self.root)
+        for d in ["runs", "schedules", "leases", "indexes", "tmp"]:
             (self.root / d).mkdir(parents=True, exist_ok=True)
 
+        self._pid: Union[int, None] = None
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self.syncer = Syncer(durability)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pid=None, _executor=None, syncer=None)
+        return state
+
+    async def _io(self, fn: Callable[..., T], *args) -> T:
+        if self._pid != os.getpid():
+            # threads do not survive a fork (nor the locks they were holding)
+            self._pid = os.getpid()
+            self.indexes = ScheduleIndexes(self.root)
+            self.syncer = Syncer(self.durability)
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.io_concurrency, thread_name_prefix="substantial-fs"
+            )
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args))
+
     async def read_events(self, run_id: str) -> Union[Records, None]:
-        f = self.root / "runs" / run_id / "events"
-        if not f.exists():
-            return None
-        return Records().from_json(f.read_text())
+        def read():
+            log = self.events_log(run_id)
+            if not log.exists():
+                return None
+
+            return Records(
+                run_id=run_id,
+                events=[self.codec.decode(frame, Event) for frame in log.read()],
+            )
+
+        return await self._io(read)
 
     async def write_events(self, run_id: str, content: Records) -> None:
-        f = self.root / "runs" / run_id / "events"
-        f.parent.mkdir(parents=True, exist_ok=True)
-        f.write_text(content.to_json(indent=4))
-
-    async def read_all_metadata(self, run_id: str) -> List[str]:
-        f = self.root / "runs" / run_id / "logs"
-        ret = []
-        for log in f.iterdir():
-            # could be polymorphic
-            ret.append(log.read_text())
-        return ret
-
-    async def append_metadata(self, run_id: str, schedule: datetime, content: str):
-        f = self.root / "runs" / run_id / "logs" / schedule.isoformat()
-        f.parent.mkdir(parents=True, exist_ok=True)
-        f.write_text(content)
+        frames = [self.codec.encode(event) for event in content.events]
+
+        def write():
+            log = self.events_log(run_id)
+            make_dirs(log.d.parent, self.syncer)
+            with locked(log.lock):
+                log.rewrite(frames, self.syncer)
+
+        await self._io(write)
+
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        if len(new_events) == 0:
+            return
+
+        frames = [self.codec.encode(event) for event in new_events]
+
+        def append():
+            log = self.events_log(run_id)
+            make_dirs(log.d.parent, self.syncer)
+            with locked(log.lock):
+                stored_len = log.stored_len()
+                if stored_len != expected_len:
+                    raise ConflictError(
+                        f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+                    )
+                log.append(frames, self.syncer)
+
+        await self._io(append)
+
+    def write(self, f: Path, data: bytes, exclusive: bool = False) -> None:
+        write_atomic(f, data, self.root / "tmp", self.syncer, exclusive)
+
+    def events_log(self, run_id: str) -> EventLog:
+        """
+        Mental model:
+            * runs/{run_id}/events.log => segmented log of the events (see EventLog)
+            * runs/{run_id}/events.d/{offset} => Records appended at that offset (legacy)
+            * runs/{run_id}/events => Records (legacy file)
+                - Both moved into the log on access
+        """
+        run = self.root / "runs" / run_id
+        log = EventLog(run / "events.log", self.segment_size, self.root / "tmp")
+        segments, legacy = run / "events.d", run / "events"
+        if not segments.exists() and not legacy.exists():
+            return log
+
+        with locked(log.lock):
+            if not log.exists():
+                events = []
+                if legacy.exists():
+                    events.extend(
+                        self.codec.decode(legacy.read_bytes(), Records).events
+                    )
+                if segments.exists():
+                    for segment in sorted(segments.iterdir()):
+                        records = self.codec.decode(segment.read_bytes(), Records)
+                        events.extend(records.events)
+                log.rewrite([self.codec.encode(event) for event in events], self.syncer)
+            shutil.rmtree(segments, ignore_errors=True)
+            with suppress(FileNotFoundError):
+                legacy.unlink()
+        return log
+
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
+        def read():
+            ret = []
+            for log in self.retain_metadata(run_id):
+                # could be polymorphic
+                with suppress(FileNotFoundError):
+                    ret.append(self.codec.decode(log.read_bytes(), MetadataRecords))
+            return ret
+
+        return await self._io(read)
+
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        def read():
+            f = self.root / "runs" / run_id / "logs_dropped"
+            return int(f.read_text() or 0) if f.exists() else 0
+
+        return await self._io(read)
+
+    async def append_metadata(
+        self, run_id: str, schedule: datetime, content: MetadataRecords
+    ):
+        def append():
+            f = self.root / "runs" / run_id / "logs" / schedule.isoformat()
+            make_dirs(f.parent, self.syncer)
+            self.write(f, self.codec.encode(content))
+            self.retain_metadata(run_id)
+
+        await self._io(append)
+
+    def retain_metadata(self, run_id: str) -> List[Path]:
+        """
+        Drop the metadata entries beyond the retention policy, count them
+        in runs/{run_id}/logs_dropped and return the remaining ones (oldest first).
+        """
+        d = self.root / "runs" / run_id / "logs"
+        if not d.exists():
+            return []
+
+        # named after their schedule, the lexicographic order is the time order
+        logs = sorted(d.iterdir())
+        cut = 0
+        if self.retention.ttl is not None:
+            horizon = (datetime.now() - self.retention.ttl).timestamp()
+            while cut < len(logs) and mtime(logs[cut]) < horizon:
+                cut += 1
+        if self.retention.max_entries is not None:
+            cut = max(cut, len(logs) - self.retention.max_entries)
+
+        dropped = 0
+        for log in logs[:cut]:
+            with suppress(FileNotFoundError):
+                # concurrent readers may prune it too, only one counts it
+                log.unlink()
+                dropped += 1
+
+        if dropped > 0:
+            counter = self.root / "runs" / run_id / "logs_dropped"
+            # the counter is replaced on write, the lock is thus aside
+            with locked(counter.with_name("logs_dropped.lock")):
+                count = dropped
+                if counter.exists():
+                    count += int(counter.read_text() or 0)
+                self.write(counter, str(count).encode())
+
+        return logs[cut:]
 
     async def read_workflow_links(self, workflow_name: str) -> List[str]:
-        f = self.root / "links" / "runs" / workflow_name
-        ret = []
-        for run_id in sorted(f.iterdir()):
-            ret.append(run_id.name)
-        return ret
+        def read():
+            f = self.root / "links" / "runs" / workflow_name
+            return sorted(entry.name for entry in os.scandir(f))
+
+        return await self._io(read)
 
     async def write_workflow_link(self, workflow_name: str, run_id: str) -> None:
-        f = self.root / "links" / "runs" / workflow_name / run_id
-        f.parent.mkdir(parents=True, exist_ok=True)
-        f.write_text(run_id)
+        def write():
+            f = self.root / "links" / "runs" / workflow_name / run_id
+            make_dirs(f.parent, self.syncer)
+            self.write(f, run_id.encode())
+
+        await self._io(write)
 
     async def next_run(
         self, queue: str, excludes: list[str]
     ) -> Union[Tuple[str, datetime], None]:
-        f = self.root / "schedules" / queue
         excludes_set = set(excludes)  # Note: lease related
 
-        for schedule in sorted(f.iterdir()):
-            for run_id in schedule.iterdir():
-                if run_id.name not in excludes_set:
-                    return run_id.name, datetime.fromisoformat(schedule.name)
+        found = await self._io(
+            self.indexes[queue].first,
+            lambda entry: entry[1] not in excludes_set,
+            datetime.now(),
+        )
+        if found is not None:
+            schedule, run_id = found
+            return run_id, datetime.fromisoformat(schedule)
+
+        return None
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        now = datetime.now()
+        # only the due entries are visited first, i.e. the ones leased by the agents
+        found = await self._io(
+            self.indexes[queue].first,
+            lambda entry: datetime.fromisoformat(entry[0]) > now,
+        )
+        return None if found is None else datetime.fromisoformat(found[0])
+
+    async def queue_depth(self, queue: str) -> int:
+        return await self._io(self.indexes[queue].size, datetime.now())
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        def lease(entry: Tuple[str, str]) -> bool:
+            return leasing_cas(
+                self.root / "leases" / entry[1], "acquire", lease_seconds
+            )
+
+        def claim():
+            while True:
+                with locked(self.root / "leases.lock"):
+                    found = self.indexes[queue].first(lease, datetime.now())
+                if found is None:
+                    return None
+
+                schedule, run_id = found
+                if not (self.root / "runs" / run_id / "commit").exists():
+                    return found
+                log = self.events_log(run_id)
+                with locked(log.lock):
+                    self._redo_commit(run_id, log)
+                if (self.root / "schedules" / queue / schedule / run_id).exists():
+                    return found
+                # closed by the interrupted commit, look further
+                with locked(self.root / "leases.lock"):
+                    with suppress(FileNotFoundError):
+                        (self.root / "leases" / run_id).unlink()
+
+        found = await self._io(claim)
+        if found is not None:
+            schedule, run_id = found
+            return run_id, datetime.fromisoformat(schedule)
 
         return None
 
     async def add_schedule(
         self, queue: str, run_id: str, schedule: datetime, content: Union[Event, None]
     ) -> None:
-        q = self.root / "schedules" / queue
-
-        if q.exists():
-            # Note: new schedule should always overwrite replays (but not scheduled events)
-            # This is for keeping the run consistent,
-            # Case 1: ======= r1 == ev1 == r2 ====== r3 ========>
-            #                              x r4
-            # Result: ============== ev1 = r4 ====== r3 ========>
-            # Rationale being that the scheduled replays are often triggered by Interrupts and such
-            # for more sane runs, fuse planned replays (induced by add_schedule calls)?
-
-            for sched in sorted(q.iterdir()):
-                for planned in sched.iterdir():
-                    planned_date = datetime.fromisoformat(sched.name)
-                    if planned.name == run_id and planned_date <= schedule:
-                        event = await self.read_schedule(queue, run_id, planned_date)
-                        if event is None:  # event => None == scheduled replays..
-                            await self.close_schedule(queue, run_id, planned_date)
-
-        f1 = q / schedule.isoformat() / run_id
-        f1.parent.mkdir(parents=True, exist_ok=False)
-        f1.write_text("" if content is None else content.to_json())
+        """
+        Mental model:
+            * schedules/{queue}/{schedule}/{run_id} => schedule payload (empty for replays)
+            * runs/{run_id}/schedules/{queue}/{schedule} => "replay" or "event"
+                - Pending schedules of the run, so that coalescing does not scan the queue
+        """
+        data = None if content is None else self.codec.encode(content)
+
+        def add():
+            changes = self._add_schedule(queue, run_id, schedule, data)
+            self.indexes[queue].update(changes)
+
+        await self._io(add)
+
+    def _add_schedule(
+        self, queue: str, run_id: str, schedule: datetime, data: Union[bytes, None]
+    ) -> List[Change]:
+        """Write the files of a schedule, the index changes are left to the caller"""
+        # Note: new schedule should always overwrite replays (but not scheduled events)
+        # This is for keeping the run consistent,
+        # Case 1: ======= r1 == ev1 == r2 ====== r3 ========>
+        #                              x r4
+        # Result: ============== ev1 = r4 ====== r3 ========>
+        # Rationale being that the scheduled replays are often triggered by Interrupts and such
+        # for more sane runs, fuse planned replays (induced by add_schedule calls)?
+        changes: List[Change] = []
+
+        pending = self.root / "runs" / run_id / "schedules" / queue
+        if pending.exists():
+            for planned in sorted(pending.iterdir()):
+                planned_date = datetime.fromisoformat(planned.name)
+                if planned_date <= schedule and planned.read_bytes() == b"replay":
+                    changes.extend(self._remove_schedule(queue, run_id, planned_date))
+
+        f1 = self.root / "schedules" / queue / schedule.isoformat() / run_id
+        while True:
+            make_dirs(f1.parent, self.syncer)
+            try:
+                self.write(f1, b"" if data is None else data)
+                break
+            except FileNotFoundError:
+                if f1.parent.exists():
+                    raise
+                # emptied and removed by a concurrent close, recreate it
+
+        make_dirs(pending, self.syncer)
+        self.write(
+            pending / schedule.isoformat(),
+            b"replay" if data is None else b"event",
+        )
+        changes.append(("+", schedule, run_id))
+        return changes
 
     async def read_schedule(
         self, queue: str, run_id: str, schedule: datetime
     ) -> Union[Event, None]:
-        f = self.root / "schedules" / queue / schedule.isoformat() / run_id
-        if not f.exists():
-            raise Exception(f"run not found: {f}")
-        ret = f.read_text()
-        return None if ret == "" else Event().from_json(ret)
+        def read():
+            f = self.root / "schedules" / queue / schedule.isoformat() / run_id
+            if not f.exists():
+                raise Exception(f"run not found: {f}")
+            return f.read_bytes()
+
+        ret = await self._io(read)
+        return None if ret == b"" else self.codec.decode(ret, Event)
 
     async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
+        await self._io(self._close_schedule, queue, run_id, schedule)
+
+    def _close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
+        self.indexes[queue].update(self._remove_schedule(queue, run_id, schedule))
+
+    def _remove_schedule(
+        self, queue: str, run_id: str, schedule: datetime
+    ) -> List[Change]:
+        """Remove the files of a schedule, the index changes are left to the caller"""
         f = self.root / "schedules" / queue / schedule.isoformat() / run_id
+        pending = self.root / "runs" / run_id / "schedules" / queue
         if not f.exists():
             # raise Exception(f"run not found: {f}")
-            return
+            with suppress(FileNotFoundError):
+                (pending / schedule.isoformat()).unlink()
+            return []
         print(f"closed {f}")
         f.unlink()
+        # the last schedule at this time, otherwise it stays (OSError)
+        with suppress(OSError):
+            f.parent.rmdir()
+        with suppress(FileNotFoundError):
+            (pending / schedule.isoformat()).unlink()
+        return [("-", schedule, run_id)]
+
+    async def commit_replay(
+        self,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        new_events: List[Event],
+        expected_len: int,
+        metadata: MetadataRecords,
+        next_schedule: Union[Tuple[datetime, Union[Event, None]], None],
+    ) -> None:
+        """
+        Mental model:
+            * runs/{run_id}/commit => "{events} {schedule} {next} {kind} {queue}\n{payload}"
+                - Redo record of the schedule changes, written before the events are
+                  appended (the commit point) and removed once the changes are done
+                - Left by a crash, it is applied (or dropped if the events were not
+                  appended) by the next commit or claim of the run, see _redo_commit
+        """
+        frames = [self.codec.encode(event) for event in new_events]
+        content = self.codec.encode(metadata)
+        next_at, next_data = None, None
+        if next_schedule is not None:
+            next_at = next_schedule[0]
+            if next_schedule[1] is not None:
+                next_data = self.codec.encode(next_schedule[1])
+
+        events_end = expected_len + len(frames)
+        next_iso = "-" if next_at is None else next_at.isoformat()
+        kind = "replay" if next_data is None else "event"
+        redo = (
+            f"{events_end} {schedule.isoformat()} {next_iso} {kind} {queue}\n".encode()
+        )
+        redo += b"" if next_data is None else next_data
+
+        def commit():
+            log = self.events_log(run_id)
+            make_dirs(log.d.parent, self.syncer)
+            with locked(log.lock):
+                self._redo_commit(run_id, log)
+                if len(frames) > 0:
+                    stored_len = log.stored_len()
+                    if stored_len != expected_len:
+                        raise ConflictError(
+                            f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+                        )
+
+                f = self.root / "runs" / run_id / "commit"
+                self.write(f, redo)
+                logs = self.root / "runs" / run_id / "logs"
+                make_dirs(logs, self.syncer)
+                self.write(logs / schedule.isoformat(), content)
+                self.retain_metadata(run_id)
+                if len(frames) > 0:
+                    log.append(frames, self.syncer)
+                self._move_schedule(queue, run_id, schedule, next_at, next_data)
+                f.unlink()
+
+        await self._io(commit)
+
+    def _move_schedule(
+        self,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        next_at: Union[datetime, None],
+        next_data: Union[bytes, None],
+    ) -> None:
+        """Close the replayed schedule and add the next one, in one index update"""
+        changes: List[Change] = []
+        if next_at is None or next_at == schedule:
+            changes.extend(self._remove_schedule(queue, run_id, schedule))
+        if next_at is not None:
+            changes.extend(self._add_schedule(queue, run_id, next_at, next_data))
+        if next_at is not None and next_at != schedule:
+            changes.extend(self._remove_schedule(queue, run_id, schedule))
+        self.indexes[queue].update(changes)
+
+    def _redo_commit(self, run_id: str, log: EventLog) -> None:
+        """
+        Complete the schedule changes of a commit interrupted by a crash,
+        the lock of the run must be held.
+        """
+        f = self.root / "runs" / run_id / "commit"
+        try:
+            header, next_data = f.read_bytes().split(b"\n", 1)
+        except FileNotFoundError:
+            return
+
+        events, schedule, next_at, kind, queue = header.decode().split(" ", 4)
+        if log.stored_len() >= int(events):
+            # committed, only the schedules are behind
+            self._move_schedule(
+                queue,
+                run_id,
+                datetime.fromisoformat(schedule),
+                None if next_at == "-" else datetime.fromisoformat(next_at),
+                None if kind == "replay" else next_data,
+            )
+        f.unlink()
+
+    async def watch_schedules(self, queue: str) -> Watch:
+        # every add (or close) appends to the journal of the queue index
+        return watch([(self.root / "indexes", f"{queue}.journal")])
+
+    async def watch_events(self, run_id: str) -> Watch:
+        run = self.root / "runs" / run_id
+        return watch(
+            [
+                (self.root / "runs", run_id),
+                (run, "events.log"),
+                (run / "events.log", None),
+            ]
+        )
 
     async def active_leases(self, lease_seconds: int) -> List[str]:
-        f = self.root / "leases"
-        ret = []
-        for lease in f.iterdir():
-            if not lease_held(lease, lease_seconds):
-                continue
-            ret.append(lease.name)
-        return ret
+        def read():
+            horizon = (datetime.now() - timedelta(seconds=lease_seconds)).timestamp()
+            ret = []
+            for lease in os.scandir(self.root / "leases"):
+                with suppress(FileNotFoundError):
+                    if lease.stat().st_mtime > horizon:
+                        ret.append(lease.name)
+            return ret
+
+        return await self._io(read)
 
     async def acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
-        f = self.root / "leases" / run_id
-        return leasing_cas(f, "acquire", lease_seconds)
+        def acquire():
+            f = self.root / "leases" / run_id
+            with locked(self.root / "leases.lock"):
+                return leasing_cas(f, "acquire", lease_seconds)
+
+        return await self._io(acquire)
 
     async def renew_lease(self, run_id: str, lease_seconds: int) -> bool:
-        f = self.root / "leases" / run_id
+        def renew():
+            f = self.root / "leases" / run_id
 
-        if not f.exists():
-            raise Exception(f"lease not found: {f}")
+            with locked(self.root / "leases.lock"):
+                if not f.exists():
+                    raise Exception(f"lease not found: {f}")
+                # held by the caller, only its mtime is pushed back
+                return cas(f, "renew")
 
-        return leasing_cas(f, "renew", lease_seconds)
+        return await self._io(renew)
 
     async def remove_lease(self, run_id: str, lease_seconds: int):
-        f = self.root / "leases" / run_id
+        def remove():
+            f = self.root / "leases" / run_id
 
-        if not f.exists():
-            raise Exception(f"lease not found: {f}")
+            with locked(self.root / "leases.lock"):
+                if not f.exists():
+                    raise Exception(f"lease not found: {f}")
+                f.unlink()
+
+        await self._io(remove)
 
-        still_holding = leasing_cas(f, "remove", lease_seconds)
-        if still_holding:
-            f.unlink()
+
+def mtime(f: Path) -> float:
+    try:
+        return f.stat().st_mtime
+    except FileNotFoundError:
+        # removed concurrently, as old as it gets
+        return 0.0
 
 
 def leasing_cas(f: Path, suffix: str, lease_seconds: int) -> bool:
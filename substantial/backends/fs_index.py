@@ -0,0 +1,268 @@
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import heapq
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Union
+from uuid import uuid4
+
+
+# (schedule isoformat, run_id)
+Entry = Tuple[str, str]
+# ("+" or "-", schedule, run_id)
+Change = Tuple[str, datetime, str]
+
+
+class ScheduleIndex:
+    """
+    Sorted index of the schedules of a queue, backed by an append-only journal.
+
+    Mental model:
+        * indexes/{queue}.journal => lines "+ {schedule} {run_id}" or "- {schedule} {run_id}"
+            - Appended (under the lock) after a schedule file is written / removed
+            - Replayed incrementally by the readers into an in-memory heap
+            - Compacted by rewriting the live entries and renaming it over, under
+              a new generation header: readers notice the new (inode, header)
+              and replay it from the start
+        * indexes/{queue}.lock => serializes appends and compactions
+
+    The schedule files remain the source of truth: the index is rebuilt from them
+    on first use by a process (so that the appends lost in a crash are recovered)
+    and each candidate is checked to still exist before being dispatched. Later
+    compactions only rewrite the live entries, in O(live) whatever the history.
+    """
+
+    def __init__(self, queue_dir: Path, index_dir: Path, compact_min: int = 1024):
+        self.queue_dir = queue_dir
+        self.journal = index_dir / f"{queue_dir.name}.journal"
+        self.lock = index_dir / f"{queue_dir.name}.lock"
+        self.compact_min = compact_min
+
+        # (inode, first line) of the journal replayed, an inode may be reused
+        self.identity: Union[Tuple[int, bytes], None] = None
+        self.offset = 0
+        self.lines = 0
+        self.live: Set[Entry] = set()
+        self.heap: List[Tuple[datetime, str, str]] = []
+        self.recovered = False
+        # the backend calls it from its I/O threads
+        self.mutex = threading.Lock()
+
+    def add(self, schedule: datetime, run_id: str) -> None:
+        self.update([("+", schedule, run_id)])
+
+    def remove(self, schedule: datetime, run_id: str) -> None:
+        self.update([("-", schedule, run_id)])
+
+    def update(self, changes: List[Change]) -> None:
+        """Append the changes in order, in one write"""
+        if len(changes) == 0:
+            return
+        with self.mutex:
+            self._append(changes)
+
+    def size(self, due: Union[datetime, None] = None) -> int:
+        """
+        Live entries (scheduled at or before `due`), closed schedules may be
+        counted until checked by `first`.
+        """
+        with self.mutex:
+            self._recover()
+            self._refresh()
+            if due is None:
+                return len(self.live)
+            return sum(
+                1
+                for schedule, _ in self.live
+                if datetime.fromisoformat(schedule) <= due
+            )
+
+    def first(
+        self, accept: Callable[[Entry], bool], due: Union[datetime, None] = None
+    ) -> Union[Entry, None]:
+        """
+        Earliest live entry accepted by `accept` (and scheduled at or before `due`),
+        in O(log N) per entry visited.
+        """
+        with self.mutex:
+            return self._first(accept, due)
+
+    def _first(
+        self, accept: Callable[[Entry], bool], due: Union[datetime, None]
+    ) -> Union[Entry, None]:
+        self._recover()
+        self._refresh()
+
+        skipped = []
+        found = None
+        seen: Set[Entry] = set()
+        try:
+            while len(self.heap) > 0:
+                item = heapq.heappop(self.heap)
+                at, run_id, schedule = item
+                if due is not None and at > due:
+                    skipped.append(item)
+                    break
+                entry = (schedule, run_id)
+                if entry not in self.live or entry in seen:
+                    continue  # removed or duplicated by a re-add
+                if not (self.queue_dir / schedule / run_id).exists():
+                    # closed without its journal line yet (or lost in a crash)
+                    self.live.discard(entry)
+                    continue
+
+                seen.add(entry)
+                skipped.append(item)
+                if accept(entry):
+                    found = entry
+                    break
+        finally:
+            for item in skipped:
+                heapq.heappush(self.heap, item)
+
+        return found
+
+    def _append(self, changes: List[Change]) -> None:
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        line = b"".join(
+            f"{op} {schedule.isoformat()} {run_id}\n".encode()
+            for op, schedule, run_id in changes
+        )
+
+        with locked(self.lock):
+            if not self.journal.exists():
+                self._compact()
+
+            fd = os.open(self.journal, os.O_RDWR | os.O_APPEND)
+            try:
+                size = os.fstat(fd).st_size
+                if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                    line = b"\n" + line  # torn by a crash, skipped by the readers
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+            self._refresh()
+            if self.lines > 2 * len(self.live) + self.compact_min:
+                # up to date under the lock, no need to scan the schedule files
+                self._compact(sorted(self.live))
+
+    def _recover(self) -> None:
+        if self.recovered:
+            return
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        with locked(self.lock):
+            self._compact()
+        self.recovered = True
+
+    def _compact(self, entries: Union[List[Entry], None] = None) -> None:
+        """
+        Rewrite the journal from `entries` (the schedule files by default),
+        the lock must be held.
+        """
+        if entries is None:
+            entries = sorted(scan(self.queue_dir))
+        tmp = self.journal.with_name(f".{self.journal.name}.{uuid4()}")
+        with open(tmp, "wb") as fd:
+            fd.write(f"# {uuid4().hex}\n".encode())
+            fd.write(
+                b"".join(
+                    f"+ {schedule} {run_id}\n".encode() for schedule, run_id in entries
+                )
+            )
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp, self.journal)
+        self.recovered = True
+
+    def _refresh(self) -> None:
+        """Replay the journal lines appended since the last refresh"""
+        try:
+            fd = os.open(self.journal, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+
+        with os.fdopen(fd, "rb") as f:
+            identity = (os.fstat(fd).st_ino, f.readline())
+            if identity != self.identity:
+                # compacted meanwhile, start over
+                self.identity, self.offset, self.lines = identity, 0, 0
+                self.live, self.heap = set(), []
+
+            f.seek(self.offset)
+            data = f.read()
+
+        end = data.rfind(b"\n") + 1  # an unterminated tail is still being written
+        for line in data[:end].splitlines():
+            self._apply(line)
+        self.offset += end
+
+    def _apply(self, line: bytes) -> None:
+        self.lines += 1
+        if line.startswith(b"#"):
+            return  # generation header
+        try:
+            op, schedule, run_id = line.decode().split(" ", 2)
+            at = datetime.fromisoformat(schedule)
+        except ValueError:
+            return  # torn line
+
+        entry = (schedule, run_id)
+        if op == "+" and entry not in self.live:
+            self.live.add(entry)
+            heapq.heappush(self.heap, (at, run_id, schedule))
+        elif op == "-":
+            self.live.discard(entry)
+
+
+class ScheduleIndexes:
+    """Lazily opened schedule index of each queue"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.indexes: Dict[str, ScheduleIndex] = {}
+        self.mutex = threading.Lock()
+
+    def __getitem__(self, queue: str) -> ScheduleIndex:
+        with self.mutex:
+            index = self.indexes.get(queue)
+            if index is None:
+                index = ScheduleIndex(
+                    self.root / "schedules" / queue, self.root / "indexes"
+                )
+                self.indexes[queue] = index
+            return index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(indexes={}, mutex=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, mutex=threading.Lock())
+
+
+def scan(queue_dir: Path) -> Iterator[Entry]:
+    if not queue_dir.exists():
+        return
+    for schedule in os.scandir(queue_dir):
+        try:
+            run_ids = list(os.scandir(schedule.path))
+        except FileNotFoundError:
+            continue  # its last schedule closed meanwhile
+        for run_id in run_ids:
+            if not run_id.name.startswith("."):
+                yield schedule.name, run_id.name
+
+
+@contextmanager
+def locked(f: Path):
+    """Exclusive advisory lock shared by all the processes using the same root"""
+    with open(f, "a") as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
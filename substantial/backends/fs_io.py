@@ -0,0 +1,144 @@
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+import time
+from typing import List, Tuple, Union
+from uuid import uuid4
+
+
+@dataclass(frozen=True)
+class Durability:
+    """
+    Make the FS writes durable (fsync) before returning:
+      * group_window => seconds during which the fsyncs of concurrent writers
+        are gathered and issued together (None to fsync each write on its own)
+    """
+
+    group_window: Union[float, None] = 0.002
+
+    def __post_init__(self):
+        if self.group_window is not None and self.group_window < 0:
+            raise ValueError(f"group_window must be positive, got {self.group_window}")
+
+
+class Syncer:
+    """
+    Issue the fsyncs required by the durability policy (none if it is None).
+    With a group window, the first writer waits for the window to pass and then
+    fsyncs for everyone who joined meanwhile, the others only wait for it.
+    """
+
+    def __init__(self, durability: Union[Durability, None]):
+        self.durability = durability
+        self.cond = threading.Condition()
+        self.pending: List[int] = []
+        self.opened = 0  # batch currently gathering fds
+        self.synced = -1  # last batch synced
+        self.leading = False
+        self.failure: Union[Tuple[int, OSError], None] = None
+        # fsync calls issued / batches issued
+        self.fsyncs = 0
+        self.batches = 0
+
+    def sync(self, fds: List[int]) -> None:
+        if self.durability is None:
+            return
+
+        if self.durability.group_window is None:
+            for fd in fds:
+                os.fsync(fd)
+            with self.cond:
+                self.fsyncs += len(fds)
+                self.batches += 1
+            return
+
+        with self.cond:
+            batch = self.opened
+            self.pending.extend(fds)
+            while self.synced < batch and self.leading:
+                self.cond.wait()
+            if self.synced >= batch:
+                # synced by the leader of the batch
+                if self.failure is not None and self.failure[0] == batch:
+                    raise self.failure[1]
+                return
+            self.leading = True
+
+        time.sleep(self.durability.group_window)
+
+        with self.cond:
+            pending, self.pending = self.pending, []
+            batch = self.opened
+            self.opened += 1
+
+        failure = None
+        try:
+            for fd in set(pending):
+                os.fsync(fd)
+        except OSError as e:
+            failure = e
+
+        with self.cond:
+            self.fsyncs += len(pending)
+            self.batches += 1
+            self.synced = batch
+            self.failure = None if failure is None else (batch, failure)
+            self.leading = False
+            self.cond.notify_all()
+
+        if failure is not None:
+            raise failure
+
+    def sync_dir(self, d: Path) -> None:
+        if self.durability is None:
+            return
+
+        fd = os.open(d, os.O_RDONLY)
+        try:
+            self.sync([fd])
+        finally:
+            os.close(fd)
+
+
+def write_atomic(
+    f: Path, data: bytes, tmp_dir: Path, syncer: Syncer, exclusive: bool = False
+) -> None:
+    """
+    Write `data` aside (in `tmp_dir`, on the same file system) and move it to `f`,
+    readers see either the previous content or the whole new one.
+    With `exclusive`, FileExistsError is raised if `f` already exists.
+    """
+    tmp = tmp_dir / f"{f.name}.{uuid4()}"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(fd, view) :]
+        syncer.sync([fd])
+    finally:
+        os.close(fd)
+
+    try:
+        if exclusive:
+            os.link(tmp, f)
+        else:
+            os.replace(tmp, f)
+    finally:
+        if exclusive or tmp.exists():
+            tmp.unlink()
+
+    syncer.sync_dir(f.parent)
+
+
+def make_dirs(d: Path, syncer: Syncer) -> None:
+    """mkdir -p, the new directory entries being made durable as well"""
+    if d.exists():
+        return
+
+    make_dirs(d.parent, syncer)
+    try:
+        d.mkdir()
+    except FileExistsError:
+        return
+    syncer.sync_dir(d.parent)
@@ -0,0 +1,158 @@
+import mmap
+import os
+from pathlib import Path
+import shutil
+import struct
+from typing import Iterator, List, Tuple, Union
+from uuid import uuid4
+
+from substantial.backends.fs_io import Syncer, make_dirs, write_atomic
+
+
+# frame => length (u32) + end of append flag (u8) + encoded event
+HEADER = struct.Struct(">IB")
+
+
+class EventLog:
+    """
+    Segmented log of the events of a run.
+
+    Mental model:
+        * {dir}/{first seq} => frames of the events from that sequence number on
+            - Appends only touch the last segment, a new one is started when
+              the last one would exceed segment_size
+            - The frames of an append never span two segments, the last one is
+              flagged so that a torn append (crash) is ignored as a whole
+        * {dir}.lock => serializes the appends and rewrites
+
+    Segments are read through mmap, only the frames are copied out. Bytes are
+    hence never truncated from a segment (the readers would fault), a torn tail
+    is left behind by starting a new segment (or replacing it if nothing else).
+    """
+
+    def __init__(self, d: Path, segment_size: int, tmp_dir: Path):
+        self.d = d
+        self.lock = d.with_name(f"{d.name}.lock")
+        self.segment_size = segment_size
+        self.tmp_dir = tmp_dir
+
+    def exists(self) -> bool:
+        return self.d.exists()
+
+    def read(self) -> List[bytes]:
+        frames = []
+        for segment in self.segments():
+            with open(segment, "rb") as f:
+                frames.extend(payload for payload, _ in committed(f))
+        return frames
+
+    def stored_len(self) -> int:
+        return self.tail()[0]
+
+    def tail(self) -> Tuple[int, Union[Path, None], int, int]:
+        """(events stored, last segment, its committed size, its actual size)"""
+        segments = self.segments()
+        if len(segments) == 0:
+            return 0, None, 0, 0
+
+        tail = segments[-1]
+        count, end = 0, 0
+        with open(tail, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            for _, end in committed(f):
+                count += 1
+        return int(tail.name) + count, tail, end, size
+
+    def append(self, frames: List[bytes], syncer: Syncer) -> int:
+        """Append frames after the stored ones, the lock must be held"""
+        make_dirs(self.d, syncer)
+        stored_len, tail, end, size = self.tail()
+        data = encode(frames)
+
+        if tail is not None and end == 0 and size > 0:
+            # torn and nothing committed, replaced as a whole
+            write_atomic(tail, data, self.tmp_dir, syncer)
+        elif tail is None or (
+            end > 0 and (size > end or end + len(data) > self.segment_size)
+        ):
+            fd = os.open(
+                self.d / segment_name(stored_len),
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                0o644,
+            )
+            try:
+                write_all(fd, data, 0)
+                syncer.sync([fd])
+            finally:
+                os.close(fd)
+            syncer.sync_dir(self.d)
+        else:
+            fd = os.open(tail, os.O_WRONLY)
+            try:
+                write_all(fd, data, end)
+                syncer.sync([fd])
+            finally:
+                os.close(fd)
+
+        return stored_len + len(frames)
+
+    def rewrite(self, frames: List[bytes], syncer: Syncer) -> None:
+        """Replace all the frames, the lock must be held"""
+        new = self.tmp_dir / f"{self.d.name}.{uuid4()}"
+        new.mkdir()
+        if len(frames) > 0:
+            EventLog(new, self.segment_size, self.tmp_dir).append(frames, syncer)
+
+        make_dirs(self.d.parent, syncer)
+        old = self.tmp_dir / f"{self.d.name}.{uuid4()}"
+        if self.d.exists():
+            os.rename(self.d, old)
+        os.rename(new, self.d)
+        syncer.sync_dir(self.d.parent)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def segments(self) -> List[Path]:
+        if not self.d.exists():
+            return []
+        # zero-padded names, the lexicographic order is the sequence order
+        return sorted(Path(entry.path) for entry in os.scandir(self.d))
+
+
+def segment_name(seq: int) -> str:
+    return f"{seq:012d}"
+
+
+def write_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.pwrite(fd, view, offset)
+        view, offset = view[written:], offset + written
+
+
+def encode(frames: List[bytes]) -> bytes:
+    return b"".join(
+        HEADER.pack(len(frame), i == len(frames) - 1) + frame
+        for i, frame in enumerate(frames)
+    )
+
+
+def committed(f) -> Iterator[Tuple[bytes, int]]:
+    """(frame, end offset) of the frames of the complete appends in the segment"""
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        return
+
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+        pending = []
+        offset = 0
+        while offset + HEADER.size <= size:
+            length, last = HEADER.unpack_from(m, offset)
+            start = offset + HEADER.size
+            if start + length > size:
+                break  # torn
+            offset = start + length
+            pending.append(m[start:offset])
+            if last:
+                for frame in pending:
+                    yield frame, offset
+                pending = []
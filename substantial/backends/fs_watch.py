@@ -0,0 +1,113 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+from pathlib import Path
+import struct
+from typing import Dict, List, Tuple, Union
+
+from substantial.backends.backend import LocalWatch, Watch
+
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+MASK = IN_MODIFY | IN_MOVED_TO | IN_CREATE
+
+# wd (i32), mask (u32), cookie (u32), len (u32), then the name (len bytes)
+EVENT = struct.Struct("iIII")
+
+
+def load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None  # not Linux
+
+
+libc = load_libc()
+
+# directory watched => name of the entries that matter in it (None for all)
+Target = Tuple[Path, Union[str, None]]
+
+
+class InotifyWatch(LocalWatch):
+    """
+    Watch notified by inotify (Linux) on the changes of entries in directories.
+
+    The targets may not exist yet, e.g. runs/{run_id}/events.log before the first
+    append: each change in an existing target re-arms the missing ones, so the
+    targets are listed from the outermost existing directory in.
+    """
+
+    def __init__(self, targets: List[Target]):
+        super().__init__()
+        self.targets = targets
+        self.wds: Dict[int, Union[str, None]] = {}
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self.arm()
+            if len(self.wds) == 0:
+                # nothing would ever notify it, e.g. the root was removed
+                raise OSError(errno.ENOENT, f"no target to watch: {targets}")
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.fd, self.read)
+
+    def arm(self) -> None:
+        for path, name in self.targets:
+            # the same wd is returned for a watched directory
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(path), MASK)
+            if wd >= 0:
+                self.wds[wd] = name
+            elif ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+
+    def read(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        changed = False
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            raw = data[offset + EVENT.size : offset + EVENT.size + length]
+            offset += EVENT.size + length
+
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)  # directory removed or replaced
+                continue
+            if wd not in self.wds:
+                continue
+            name = self.wds[wd]
+            if name is None or name == os.fsdecode(raw.rstrip(b"\0")):
+                changed = True
+
+        if changed:
+            self.arm()
+            self.notify()
+
+    async def close(self) -> None:
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+
+
+def watch(targets: List[Target]) -> Watch:
+    """Inotify watch where supported, polling otherwise"""
+    if libc is None:
+        return Watch()
+    try:
+        return InotifyWatch(targets)
+    except OSError:
+        # e.g. out of inotify instances
+        return Watch()
@@ -0,0 +1,265 @@
+from collections import deque
+from datetime import datetime
+import heapq
+import time
+from typing import Deque, Dict, List, Set, Tuple, Union
+
+from substantial.backends.backend import (
+    Backend,
+    ConflictError,
+    LocalWatch,
+    Retention,
+    Watch,
+)
+from substantial.protos.events import Event, Records
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+class InMemoryBackend(Backend):
+    """
+    Backend keeping everything in the memory of the process (tests, benchmarks,
+    embedded use). Its agents must thus run in the same process (see Conductor.run).
+
+    Mental model:
+        * events => run_id -> list of events (append only)
+        * metadata => run_id -> deque of (monotonic time, metadata), bounded by the retention
+        * schedules => queue -> heap of (schedule, run_id), removals being lazy
+            - (queue, schedule, run_id) -> payload (None for replays)
+            - (queue, run_id) -> pending schedules of the run, used for coalescing
+        * leases => run_id -> monotonic expiration
+        * watches => ("schedules", queue) or ("events", run_id) -> watches to notify
+
+    No method awaits, each of them is hence atomic for the tasks of the event loop.
+    """
+
+    process_local = True
+
+    def __init__(self, retention: Retention = Retention()):
+        self.retention = retention
+        self.events: Dict[str, List[Event]] = {}
+        self.metadata: Dict[str, Deque[Tuple[float, MetadataRecords]]] = {}
+        self.metadata_dropped: Dict[str, int] = {}
+        self.links: Dict[str, Dict[str, None]] = {}
+        self.queues: Dict[str, List[Tuple[datetime, str]]] = {}
+        self.schedules: Dict[Tuple[str, datetime, str], Union[Event, None]] = {}
+        self.run_schedules: Dict[Tuple[str, str], Set[datetime]] = {}
+        self.leases: Dict[str, float] = {}
+        self.watches: Dict[Tuple[str, str], Set[LocalWatch]] = {}
+
+    async def read_events(self, run_id: str) -> Union[Records, None]:
+        events = self.events.get(run_id)
+        if events is None:
+            return None
+        return Records(run_id=run_id, events=list(events))
+
+    async def write_events(self, run_id: str, content: Records) -> None:
+        self.events[run_id] = list(content.events)
+        self.notify(("events", run_id))
+
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        if len(new_events) == 0:
+            return
+
+        events = self.events.setdefault(run_id, [])
+        if len(events) != expected_len:
+            raise ConflictError(
+                f"events of {run_id}: expected {expected_len} stored, got {len(events)}"
+            )
+        events.extend(new_events)
+        self.notify(("events", run_id))
+
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
+        self.retain_metadata(run_id)
+        return [content for _, content in self.metadata.get(run_id, [])]
+
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        return self.metadata_dropped.get(run_id, 0)
+
+    async def append_metadata(
+        self, run_id: str, schedule: datetime, content: MetadataRecords
+    ) -> None:
+        self.metadata.setdefault(run_id, deque()).append((time.monotonic(), content))
+        self.retain_metadata(run_id)
+
+    def retain_metadata(self, run_id: str) -> None:
+        logs = self.metadata.get(run_id)
+        if logs is None:
+            return
+
+        dropped = 0
+        if self.retention.ttl is not None:
+            horizon = time.monotonic() - self.retention.ttl.total_seconds()
+            while len(logs) > 0 and logs[0][0] < horizon:
+                logs.popleft()
+                dropped += 1
+        if self.retention.max_entries is not None:
+            while len(logs) > self.retention.max_entries:
+                logs.popleft()
+                dropped += 1
+
+        if dropped > 0:
+            self.metadata_dropped[run_id] = (
+                self.metadata_dropped.get(run_id, 0) + dropped
+            )
+
+    async def read_workflow_links(self, workflow_name: str) -> List[str]:
+        return sorted(self.links.get(workflow_name, {}))
+
+    async def write_workflow_link(self, workflow_name: str, run_id: str) -> None:
+        self.links.setdefault(workflow_name, {})[run_id] = None
+
+    async def next_run(
+        self, queue: str, excludes: list[str]
+    ) -> Union[Tuple[str, datetime], None]:
+        excludes_set = set(excludes)
+        found = self.first(
+            queue, lambda run_id: run_id not in excludes_set, datetime.now()
+        )
+        if found is not None:
+            schedule, run_id = found
+            return run_id, schedule
+        return None
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        now = datetime.now()
+        heap = self.queues.get(queue, [])
+        # only the due entries are visited first, i.e. the ones leased by the agents
+        skipped = []
+        found = None
+        while len(heap) > 0:
+            item = heapq.heappop(heap)
+            if (queue, *item) not in self.schedules:
+                continue  # closed
+            skipped.append(item)
+            if item[0] > now:
+                found = item[0]
+                break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return found
+
+    async def queue_depth(self, queue: str) -> int:
+        now = datetime.now()
+        return sum(1 for q, at, _ in self.schedules if q == queue and at <= now)
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        now = time.monotonic()
+
+        def free(run_id: str) -> bool:
+            return self.leases.get(run_id, 0) <= now
+
+        found = self.first(queue, free, datetime.now())
+        if found is not None:
+            schedule, run_id = found
+            self.leases[run_id] = now + lease_seconds
+            return run_id, schedule
+        return None
+
+    def first(
+        self, queue: str, accept, due: datetime
+    ) -> Union[Tuple[datetime, str], None]:
+        """
+        Earliest schedule of the queue, at or before `due`, whose run is accepted,
+        in O(log N) per visit.
+        """
+        heap = self.queues.get(queue, [])
+        skipped = []
+        seen = set()
+        found = None
+        try:
+            while len(heap) > 0:
+                item = heapq.heappop(heap)
+                schedule, run_id = item
+                if schedule > due:
+                    skipped.append(item)
+                    break
+                if (queue, schedule, run_id) not in self.schedules or item in seen:
+                    continue  # closed or duplicated by a re-add
+                seen.add(item)
+                skipped.append(item)
+                if accept(run_id):
+                    found = item
+                    break
+        finally:
+            for item in skipped:
+                heapq.heappush(heap, item)
+        return found
+
+    async def add_schedule(
+        self, queue: str, run_id: str, schedule: datetime, content: Union[Event, None]
+    ) -> None:
+        # new schedules overwrite the earlier replays of the run (see FSBackend)
+        for planned in list(self.run_schedules.get((queue, run_id), ())):
+            if planned <= schedule and self.schedules[(queue, planned, run_id)] is None:
+                self.close(queue, run_id, planned)
+
+        key = (queue, schedule, run_id)
+        if key not in self.schedules:
+            heapq.heappush(self.queues.setdefault(queue, []), (schedule, run_id))
+        self.schedules[key] = content
+        self.run_schedules.setdefault((queue, run_id), set()).add(schedule)
+        self.notify(("schedules", queue))
+
+    async def read_schedule(
+        self, queue: str, run_id: str, schedule: datetime
+    ) -> Union[Event, None]:
+        key = (queue, schedule, run_id)
+        if key not in self.schedules:
+            raise Exception(f"schedule not found: {key}")
+        return self.schedules[key]
+
+    async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
+        self.close(queue, run_id, schedule)
+
+    def close(self, queue: str, run_id: str, schedule: datetime) -> None:
+        self.schedules.pop((queue, schedule, run_id), None)
+        pending = self.run_schedules.get((queue, run_id))
+        if pending is not None:
+            pending.discard(schedule)
+            if len(pending) == 0:
+                del self.run_schedules[(queue, run_id)]
+
+    async def watch_schedules(self, queue: str) -> Watch:
+        return self.watch(("schedules", queue))
+
+    async def watch_events(self, run_id: str) -> Watch:
+        return self.watch(("events", run_id))
+
+    def watch(self, key: Tuple[str, str]) -> LocalWatch:
+        def close():
+            watches.discard(watch)
+            if len(watches) == 0 and self.watches.get(key) is watches:
+                del self.watches[key]
+
+        watches = self.watches.setdefault(key, set())
+        watch = LocalWatch(close)
+        watches.add(watch)
+        return watch
+
+    def notify(self, key: Tuple[str, str]) -> None:
+        for watch in self.watches.get(key, ()):
+            watch.notify()
+
+    async def active_leases(self, _lease_seconds: int) -> List[str]:
+        now = time.monotonic()
+        return [run_id for run_id, expires in self.leases.items() if expires > now]
+
+    async def acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
+        now = time.monotonic()
+        if self.leases.get(run_id, 0) > now:
+            return False
+        self.leases[run_id] = now + lease_seconds
+        return True
+
+    async def renew_lease(self, run_id: str, lease_seconds: int) -> bool:
+        if run_id not in self.leases:
+            raise Exception(f"lease not found {run_id}")
+        self.leases[run_id] = time.monotonic() + lease_seconds
+        return True
+
+    async def remove_lease(self, run_id: str, _lease_seconds: int):
+        self.leases.pop(run_id, None)
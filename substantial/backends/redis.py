@@ -1,17 +1,184 @@
-from datetime import datetime, timedelta
-from typing import List, Tuple, Union
-
-import redis
-from substantial.backends.backend import Backend
+import asyncio
+from datetime import datetime
+from typing import Any, Dict, List, Set, Tuple, Union
+import weakref
+
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.exceptions import TimeoutError as RedisTimeoutError
+from substantial.backends.backend import (
+    Backend,
+    ConflictError,
+    LocalWatch,
+    Retention,
+    Watch,
+)
+from substantial.backends.redis_scripts import SCRIPTS, ScriptRegistry
+from substantial.backends.codec import Codec, Compression
 from substantial.protos.events import Event, Records
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+# Connections are bound to the event loop that opened them, pools are hence shared
+# per loop (and thus per process, as each agent process runs its own loop)
+# loop => {connection options => (pool, options)}
+_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def options_key(options: Dict[str, Any]) -> Tuple:
+    """
+    Hashable key of connection options, the unhashable values (e.g. a list of
+    errors to retry on) being compared by identity.
+    """
+    key = []
+    for name, value in sorted(options.items()):
+        try:
+            hash(value)
+        except TypeError:
+            value = ("id", id(value))
+        key.append((name, value))
+    return tuple(key)
+
+
+def shared_pool(**options) -> redis.BlockingConnectionPool:
+    """
+    Connection pool shared by all the backends of the running event loop
+    that have been configured with the same connection options.
+    """
+    loop = asyncio.get_running_loop()
+    pools = _pools.setdefault(loop, {})
+    key = options_key(options)
+    if key not in pools:
+        # the options are kept alive, the ids in the key can then not be reused
+        pools[key] = (redis.BlockingConnectionPool(**options), options)
+    return pools[key][0]
+
+
+# loop => {connection options => subscriptions}
+_subscriptions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class Subscriptions:
+    """
+    Pub/sub connection shared by the watches of the backends of the running event
+    loop that have been configured with the same connection options. The scripts
+    publish on the keys they change (e.g. the queue on a new schedule).
+    """
+
+    def __init__(self, client: redis.Redis):
+        self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self.watches: Dict[bytes, Set["ChannelWatch"]] = {}
+        self.reader: Union[asyncio.Task, None] = None
+
+    async def watch(self, channel: str) -> Watch:
+        key = channel.encode()
+        watches = self.watches.setdefault(key, set())
+        watch = ChannelWatch(self, key)
+        watches.add(watch)
+        if len(watches) == 1:
+            await self.pubsub.subscribe(key)
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self.read())
+        return watch
+
+    async def unwatch(self, watch: "ChannelWatch") -> None:
+        watches = self.watches.get(watch.channel)
+        if watches is None:
+            return
+        watches.discard(watch)
+        if len(watches) == 0:
+            del self.watches[watch.channel]
+            await self.pubsub.unsubscribe(watch.channel)
+
+    async def read(self) -> None:
+        while True:
+            try:
+                # finite, a blocking read would fail after socket_timeout idle
+                message = await self.pubsub.get_message(timeout=1)
+            except (RedisConnectionError, RedisTimeoutError, OSError) as e:
+                print(f"pub/sub connection lost ({e}), reconnecting")
+                # resubscribed to the channels on the next read
+                await self.pubsub.connection.disconnect()
+                await asyncio.sleep(1)
+                # messages may have been missed meanwhile
+                for watches in list(self.watches.values()):
+                    for watch in watches:
+                        watch.notify()
+                continue
+
+            if message is not None and message["type"] == "message":
+                for watch in self.watches.get(message["channel"], ()):
+                    watch.notify()
+
+
+class ChannelWatch(LocalWatch):
+    def __init__(self, subscriptions: Subscriptions, channel: bytes):
+        super().__init__()
+        self.subscriptions = subscriptions
+        self.channel = channel
+
+    async def close(self) -> None:
+        await self.subscriptions.unwatch(self)
 
 
 class RedisBackend(Backend):
-    def __init__(self, host: str, port: int, **kwargs):
-        self.redis = redis.Redis(host=host, port=port, decode_responses=True, **kwargs)
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        max_connections: int = 50,
+        pool_timeout: Union[float, None] = 20,
+        socket_timeout: Union[float, None] = 10,
+        socket_connect_timeout: Union[float, None] = 10,
+        binary: bool = True,
+        compression: Union[Compression, None] = Compression(),
+        retention: Retention = Retention(),
+        **kwargs,
+    ):
+        """
+        Non-blocking backend built on `redis.asyncio`:
+            * max_connections => size of the pool shared by the backends of a process
+            * pool_timeout => seconds to wait for a free connection before failing
+            * socket_timeout, socket_connect_timeout => per command/connect timeouts
+            * binary => protobuf wire encoding of the stored messages (JSON otherwise)
+            * compression => compression of the large binary payloads (None to disable)
+            * retention => bounds on the metadata kept per run (unbounded by default)
+        """
+        self.options = dict(
+            host=host,
+            port=port,
+            decode_responses=False,
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_connect_timeout,
+            **kwargs,
+        )
         self.separator = ":/"
         self.base_prefix = "substantial"
-        # self.redis.flushall()
+        self._client: Union[redis.Redis, None] = None
+        self.scripts = ScriptRegistry(SCRIPTS)
+        self.codec = Codec(binary, compression)
+        self.retention = retention
+        # queues checked for schedules in the legacy layout
+        self._migrated_queues: Set[str] = set()
+
+    @property
+    def redis(self) -> redis.Redis:
+        pool = shared_pool(**self.options)
+        if self._client is None or self._client.connection_pool is not pool:
+            self._client = redis.Redis(connection_pool=pool)
+        return self._client
+
+    @property
+    def subscriptions(self) -> Subscriptions:
+        loop = asyncio.get_running_loop()
+        shared = _subscriptions.setdefault(loop, {})
+        key = options_key(self.options)
+        if key not in shared:
+            shared[key] = Subscriptions(self.redis)
+        return shared[key]
 
     # Utils
     def _key(self, *parts: str) -> str:
@@ -22,6 +189,12 @@ class RedisBackend(Backend):
             )
         return f"{self.base_prefix}{self.separator}{self.separator.join(parts)}"
 
+    def _retention_args(self) -> List[int]:
+        max_entries = self.retention.max_entries or 0
+        ttl = self.retention.ttl
+        ttl_ms = 0 if ttl is None else max(1, int(ttl.total_seconds() * 1000))
+        return [max_entries, ttl_ms]
+
     def _parts(self, key: str) -> List[str]:
         if not key.startswith(self.base_prefix):
             raise ValueError(
@@ -31,46 +204,175 @@ class RedisBackend(Backend):
         offset = len(self.base_prefix + self.separator)
         return key[offset:].split(self.separator)
 
+    async def _migrate_schedules(self, queue: str) -> None:
+        """
+        Mental model (legacy, moved once per queue and process on first read):
+            * schedules:/{queue} => Sorted set of ref_:/{run_id}:/{schedule_isoformat}
+                - Deref sched_ref => Sorted set of run_id scored by due timestamp
+        """
+
+        if queue in self._migrated_queues:
+            return
+
+        migrated = await self.scripts.run(
+            self.redis,
+            "migrate_schedules",
+            keys=[self._key("schedules", queue), self._key("schedules", queue, "due")],
+            args=[self.separator, self.base_prefix, queue],
+        )
+        if migrated > 0:
+            print(f"migrated {migrated} legacy schedules of {queue}")
+        self._migrated_queues.add(queue)
+
     # Backend
 
     async def read_events(self, run_id: str) -> Union[Records, None]:
-        event_key = self._key("runs", run_id, "events")
-        val = self.redis.get(event_key)
+        """
+        Mental model:
+            * runs:/{run_id}:/events_log => List of events (append only)
+                - Extended by append_events, replaced by write_events
+            * runs:/{run_id}:/events => Records (legacy blob)
+                - Moved to the events list on first read
+        """
+
+        log_key = self._key("runs", run_id, "events_log")
+        legacy_key = self._key("runs", run_id, "events")
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(log_key, 0, -1)
+        pipe.get(legacy_key)
+        vals, legacy = await pipe.execute()
+
+        if legacy is not None:
+            records = self.codec.decode(legacy, Records)
+            await self.scripts.run(
+                self.redis,
+                "migrate_events",
+                keys=[log_key, legacy_key],
+                args=[self.codec.encode(event) for event in records.events],
+            )
+            vals = await self.redis.lrange(log_key, 0, -1)
 
-        return None if val is None else Records().from_json(val)
+        if len(vals) == 0 and legacy is None:
+            return None
+
+        return Records(
+            run_id=run_id, events=[self.codec.decode(val, Event) for val in vals]
+        )
 
     async def write_events(self, run_id: str, content: Records) -> None:
-        key = self._key("runs", run_id, "events")
-        self.redis.set(key, content.to_json(indent=4))
+        log_key = self._key("runs", run_id, "events_log")
+        legacy_key = self._key("runs", run_id, "events")
+
+        await self.scripts.run(
+            self.redis,
+            "write_events",
+            keys=[log_key, legacy_key],
+            args=[self.codec.encode(event) for event in content.events],
+        )
+
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        if len(new_events) == 0:
+            return
+
+        log_key = self._key("runs", run_id, "events_log")
+        appended, stored_len = await self.scripts.run(
+            self.redis,
+            "append_events",
+            keys=[log_key],
+            args=[expected_len, *[self.codec.encode(event) for event in new_events]],
+        )
+
+        if not appended:
+            raise ConflictError(
+                f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+            )
 
-    async def read_all_metadata(self, run_id: str) -> List[str]:
+    async def commit_replay(
+        self,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        new_events: List[Event],
+        expected_len: int,
+        metadata: MetadataRecords,
+        next_schedule: Union[Tuple[datetime, Union[Event, None]], None],
+    ) -> None:
+        keys = [
+            self._key("runs", run_id, "events_log"),
+            self._key("runs", run_id, "logs"),
+            self._key(run_id, schedule.isoformat()),
+            self._key("schedules", queue, "due"),
+            self._key(schedule.isoformat(), run_id),
+            self._key("runs", run_id, "logs_dropped"),
+            self._key("runs", run_id, "schedules", queue),
+        ]
+        next_score, next_content = "", b""
+        if next_schedule is not None:
+            next_at, next_event = next_schedule
+            keys.append(self._key(next_at.isoformat(), run_id))
+            next_score = next_at.timestamp()
+            if next_event is not None:
+                next_content = self.codec.encode(next_event)
+
+        committed, stored_len = await self.scripts.run(
+            self.redis,
+            "commit_replay",
+            keys=keys,
+            args=[
+                expected_len,
+                self.codec.encode(metadata),
+                next_score,
+                next_content,
+                *self._retention_args(),
+                *[self.codec.encode(event) for event in new_events],
+            ],
+        )
+
+        if not committed:
+            raise ConflictError(
+                f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+            )
+
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
         log_key = self._key("runs", run_id, "logs")
-        sched_keys = self.redis.lrange(log_key, 0, -1)
-        logs = self.redis.mget(sched_keys)
-        return logs
+        dropped_key = self._key("runs", run_id, "logs_dropped")
+        logs = await self.scripts.run(
+            self.redis, "read_metadata", keys=[log_key, dropped_key]
+        )
+        return [self.codec.decode(log, MetadataRecords) for log in logs]
 
-    async def append_metadata(self, run_id: str, schedule: datetime, content: str):
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        dropped_key = self._key("runs", run_id, "logs_dropped")
+        return int(await self.redis.get(dropped_key) or 0)
+
+    async def append_metadata(
+        self, run_id: str, schedule: datetime, content: MetadataRecords
+    ):
         """
         Mental model:
             * runs:/{run_id}:/logs => List keys {run_id}:/{schedule_isoformat}
-                - Deref key => metadata content
+                - Deref key => metadata content (expiring after retention.ttl)
+                - Trimmed to the latest retention.max_entries
+            * runs:/{run_id}:/logs_dropped => Count of the trimmed/expired entries
         """
 
         log_key = self._key("runs", run_id, "logs")  # queue
+        dropped_key = self._key("runs", run_id, "logs_dropped")
         sched_key = self._key(run_id, schedule.isoformat())
 
-        self.redis.register_script("""
-            local log_key = KEYS[1]
-            local sched_key = KEYS[2]
-            local content = ARGV[1]
-
-            redis.call("LPUSH", log_key, sched_key)
-            redis.call("SET", sched_key, content)
-        """)(keys=[log_key, sched_key], args=[content])
+        await self.scripts.run(
+            self.redis,
+            "append_metadata",
+            keys=[log_key, dropped_key, sched_key],
+            args=[self.codec.encode(content), *self._retention_args()],
+        )
 
     async def read_workflow_links(self, workflow_name: str) -> List[str]:
         links_key = self._key("links", "runs", workflow_name)
-        return self.redis.zrange(links_key, 0, -1)
+        return [run_id.decode() for run_id in await self.redis.zrange(links_key, 0, -1)]
 
     async def write_workflow_link(self, workflow_name: str, run_id: str) -> None:
         """
@@ -80,41 +382,66 @@ class RedisBackend(Backend):
         """
 
         links_key = self._key("links", "runs", workflow_name)
-        self.redis.zadd(links_key, {run_id: 0})
+        await self.redis.zadd(links_key, {run_id: 0})
 
     async def next_run(
         self, queue: str, excludes: list[str]
     ) -> Union[Tuple[str, datetime], None]:
-        q_key = self._key("schedules", queue)  # priority queue
-
-        lua_ret = self.redis.register_script("""
-            local q_key = KEYS[1]
-            local excludes = ARGV
-            local schedule_refs = redis.call("ZRANGE", q_key, 0, -1)
-
-            for _, schedule_ref in ipairs(schedule_refs) do
-                local run_ids = redis.call("ZRANGE", schedule_ref, 0, -1)
-                for _, run_id in ipairs(run_ids) do
-                    local is_excluded = false
-                    for k = 1, #excludes do
-                        if run_id == excludes[k] then
-                            is_excluded = true
-                            break
-                        end
-                    end
-
-                    if not is_excluded then
-                        return {run_id, schedule_ref}
-                    end
-                end
-            end
-
-            return nil
-        """)(keys=[q_key], args=excludes)
-
-        if lua_ret is not None:
-            run_id, sched_ref = lua_ret
-            schedule = self._parts(sched_ref)[-1]
+        await self._migrate_schedules(queue)
+        q_key = self._key("schedules", queue, "due")  # priority queue
+
+        sched_key = await self.scripts.run(
+            self.redis,
+            "next_run",
+            keys=[q_key],
+            args=[self.separator, datetime.now().timestamp(), *excludes],
+        )
+
+        if sched_key is not None:
+            schedule, run_id = self._parts(sched_key.decode())
+            return run_id, datetime.fromisoformat(schedule)
+
+        return None
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        await self._migrate_schedules(queue)
+        q_key = self._key("schedules", queue, "due")
+        now = datetime.now()
+        sched_keys = await self.redis.zrangebyscore(
+            q_key, f"({now.timestamp()}", "+inf", start=0, num=1
+        )
+        if len(sched_keys) == 0:
+            return None
+        schedule, _ = self._parts(sched_keys[0].decode())
+        return datetime.fromisoformat(schedule)
+
+    async def queue_depth(self, queue: str) -> int:
+        await self._migrate_schedules(queue)
+        q_key = self._key("schedules", queue, "due")
+        return await self.redis.zcount(q_key, "-inf", datetime.now().timestamp())
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        await self._migrate_schedules(queue)
+        q_key = self._key("schedules", queue, "due")
+        lease_prefix = self._key("lease", "")
+
+        sched_key = await self.scripts.run(
+            self.redis,
+            "claim_next",
+            keys=[q_key],
+            args=[
+                self.separator,
+                datetime.now().timestamp(),
+                lease_prefix,
+                datetime.now().isoformat(),
+                lease_seconds * 1000,
+            ],
+        )
+
+        if sched_key is not None:
+            schedule, run_id = self._parts(sched_key.decode())
             return run_id, datetime.fromisoformat(schedule)
 
         return None
@@ -124,173 +451,115 @@ class RedisBackend(Backend):
     ) -> None:
         """
         Mental model:
-            * schedules:/{queue} => List sched_ref (ref_:/{run_id}:/{schedule_isoformat})
-                - sched_ref => Ordered list of run_id
-                - Used by next_run
+            * schedules:/{queue}:/due => Sorted set of sched_key scored by due timestamp
+                - Used by next_run (ZRANGEBYSCORE up to now, earliest first)
+                - Used by next_due (ZRANGEBYSCORE from now)
                 - Freed by close_schedule
-            * {schedule_isoformat}/{run_id} => schedule payload (e.g. send, start, stop)
+            * {schedule_isoformat}:/{run_id} (sched_key) => schedule payload (e.g. send, start, stop)
                 - Used by read_schedule
                 - Freed by close_schedule
+            * runs:/{run_id}:/schedules:/{queue} => Sorted set of the sched_key of the run
+                - Earlier replays of the run are fused into the new schedule (see FSBackend)
         """
 
-        q_key = self._key("schedules", queue)  # priority queue
-
-        non_prefixed_sched_ref = schedule.isoformat()
-        sched_score = schedule.timestamp()
-        sched_key = self._key(non_prefixed_sched_ref, run_id)
-        sched_ref = self._key("ref_", run_id, non_prefixed_sched_ref)
-
-        self.redis.register_script("""
-            local q_key = KEYS[1]
-            local sched_ref = KEYS[2]
-            local sched_key = KEYS[3]
-            local sched_score = tonumber(ARGV[1])
-            local run_id = ARGV[2]
-            local content = ARGV[3]
-
-            redis.call("ZADD", q_key, 0, sched_ref)
-            redis.call("ZADD", sched_ref, sched_score, run_id)
-            redis.call("SET", sched_key, content)
-        """)(
-            keys=[q_key, sched_ref, sched_key],
-            args=[sched_score, run_id, "" if content is None else content.to_json()],
+        q_key = self._key("schedules", queue, "due")  # priority queue
+        run_q_key = self._key("runs", run_id, "schedules", queue)
+        sched_key = self._key(schedule.isoformat(), run_id)
+
+        await self.scripts.run(
+            self.redis,
+            "add_schedule",
+            keys=[q_key, run_q_key, sched_key],
+            args=[
+                schedule.timestamp(),
+                b"" if content is None else self.codec.encode(content),
+            ],
         )
 
     async def read_schedule(
         self, queue: str, run_id: str, schedule: datetime
     ) -> Union[Event, None]:
         sched_key = self._key(schedule.isoformat(), run_id)
-        ret = self.redis.get(sched_key)
+        ret = await self.redis.get(sched_key)
         if ret is None:
             raise Exception(f"schedule not found: {sched_key}")
-        return None if ret == "" else Event().from_json(ret)
+        return None if ret == b"" else self.codec.decode(ret, Event)
 
     async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
-        q_key = self._key("schedules", queue)
-        non_prefixed_sched_ref = schedule.isoformat()
-        sched_key = self._key(non_prefixed_sched_ref, run_id)
-        sched_ref = self._key("ref_", run_id, non_prefixed_sched_ref)
-
-        self.redis.register_script("""
-            local q_key = KEYS[1]
-            local sched_ref = KEYS[2]
-            local sched_key = KEYS[3]
-            local run_id = ARGV[1]
-
-            redis.call("ZREM", q_key, sched_ref)
-            redis.call("ZREM", sched_ref, run_id)
-            redis.call("DEL", sched_key)
-        """)(keys=[q_key, sched_ref, sched_key], args=[run_id])
-
-        print(f"closed {run_id}")
-
-    # Agent related
-    async def active_leases(self, _lease_seconds: int) -> List[str]:
-        all_leases_key = self._key("leases")
-
-        lua_ret = self.redis.register_script("""
-            local all_leases_key = KEYS[1]
+        q_key = self._key("schedules", queue, "due")
+        run_q_key = self._key("runs", run_id, "schedules", queue)
+        sched_key = self._key(schedule.isoformat(), run_id)
 
-            local lease_refs = redis.call("ZRANGE", all_leases_key, 0, -1)
-            local results = {}
-            for i, lease_ref in ipairs(lease_refs) do
-                local exp_time = redis.call("GET", lease_ref)
-                table.insert(results, lease_ref)
-                table.insert(results, exp_time)
-            end
+        await self.scripts.run(
+            self.redis,
+            "close_schedule",
+            keys=[q_key, run_q_key, sched_key],
+        )
 
-            return results
-        """)(keys=[all_leases_key])
+        print(f"closed {run_id}")
 
-        assert len(lua_ret) % 2 == 0
+    async def watch_schedules(self, queue: str) -> Watch:
+        return await self.subscriptions.watch(self._key("schedules", queue, "due"))
 
-        active_lease_ids = []
-        while len(lua_ret) >= 2:
-            lease_ref, exp_time = lua_ret.pop(0), lua_ret.pop(0)
-            exp_time = datetime.fromisoformat(exp_time)
-            if exp_time > datetime.now():
-                run_id = self._parts(lease_ref)[-1]
-                active_lease_ids.append(run_id)
+    async def watch_events(self, run_id: str) -> Watch:
+        return await self.subscriptions.watch(self._key("runs", run_id, "events_log"))
 
-        return active_lease_ids
+    # Agent related
+    async def active_leases(self, _lease_seconds: int) -> List[str]:
+        # scans the keyspace, kept off the dispatch and autoscaling paths
+        lease_prefix = self._key("lease", "")
+        lease_refs = [
+            lease_ref
+            async for lease_ref in self.redis.scan_iter(
+                match=f"{lease_prefix}*", count=1000
+            )
+        ]
+
+        pipe = self.redis.pipeline(transaction=False)
+        for lease_ref in lease_refs:
+            pipe.pttl(lease_ref)
+            pipe.get(lease_ref)
+        replies = await pipe.execute()
+
+        # expired leases are evicted by redis, except the legacy ones (no TTL)
+        now = datetime.now()
+        active = []
+        for lease_ref, ttl, value in zip(lease_refs, replies[::2], replies[1::2]):
+            if value is None:
+                continue
+            if ttl == -1 and datetime.fromisoformat(value.decode()) < now:
+                continue
+            active.append(lease_ref.decode()[len(lease_prefix) :])
+        return active
 
     async def acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
         """
         Mental model:
-            * leases => Ordered lease refs (format: lease:/{run_id})
-                - Deref lease ref => lease expiration (isoformat date string)
-                - Could be overwritten by renew_lease (must exist before renew)
+            * lease:/{run_id} => lease key expiring natively after lease_seconds (PX)
+                - Set only if absent (NX), an expired lease is thus free again
+                - Legacy leases (no TTL, expiry date as value) are taken over once expired
+                - Expiration pushed back by renew_lease (must exist before renew)
                 - Freed by remove_lease
         """
 
-        all_leases_key = self._key("leases")
         lease_ref = self._key("lease", run_id)
-
-        exp_time_str = self.redis.register_script("""
-            local all_leases_key = KEYS[1]
-            local lease_ref = KEYS[2]
-            if redis.call("EXISTS", lease_ref) == 1 then
-                if redis.call("ZRANK", all_leases_key, lease_ref) == nil then
-                    error("Invalid state: integrity failure, lease ref " .. lease_ref .. " is not an element of " .. all_leases_key)
-                end
-                return redis.call("GET", lease_ref)                    
-            else
-                return nil
-            end
-        """)(keys=[all_leases_key, lease_ref])
-
-        not_held = True
-        if exp_time_str is not None:
-            not_held = False
-            exp_time = datetime.fromisoformat(exp_time_str)
-            if exp_time < datetime.now():
-                not_held = True
-
-        if not_held:
-            now = datetime.now()
-            lease_exp = now + timedelta(seconds=lease_seconds)
-            lease_exp = lease_exp.isoformat()
-            self.redis.register_script("""
-                local all_leases_key = KEYS[1]
-                local lease_ref = KEYS[2]
-                local lease_exp = ARGV[1]
-
-                redis.call("ZADD", all_leases_key, 0, lease_ref)
-                redis.call("SET", lease_ref, lease_exp)
-            """)(keys=[all_leases_key, lease_ref], args=[lease_exp])
-            return True
-
-        return False
+        acquired = await self.scripts.run(
+            self.redis,
+            "acquire_lease",
+            keys=[lease_ref],
+            args=[datetime.now().isoformat(), lease_seconds * 1000],
+        )
+        return acquired == 1
 
     async def renew_lease(self, run_id: str, lease_seconds: int) -> bool:
         lease_ref = self._key("lease", run_id)
-        new_lease_exp = datetime.now() + timedelta(seconds=lease_seconds)
-
-        lua_ret = self.redis.register_script("""
-            local lease_ref = KEYS[1]
-            local new_lease_exp = ARGV[1]
 
-            if redis.call("EXISTS", lease_ref) == 1 then
-                redis.call("SET", lease_ref, new_lease_exp)
-                return 1
-            else
-                return 0
-            end
-        """)(keys=[lease_ref], args=[new_lease_exp])
-
-        if lua_ret == 0:
+        renewed = await self.redis.pexpire(lease_ref, lease_seconds * 1000)
+        if not renewed:
             raise Exception(f"lease not found {lease_ref}")
 
         return True
 
     async def remove_lease(self, run_id: str, _lease_seconds: int):
-        all_leases_key = self._key("leases")
         lease_ref = self._key("lease", run_id)
-
-        self.redis.register_script("""
-            local all_leases_key = KEYS[1]
-            local lease_ref = KEYS[2]
-
-            redis.call("ZREM", all_leases_key, lease_ref)
-            redis.call("DEL", lease_ref)
-        """)(keys=[all_leases_key, lease_ref])
+        await self.redis.delete(lease_ref)
@@ -0,0 +1,424 @@
+import hashlib
+from typing import Dict, Sequence
+
+import redis.asyncio as redis
+from redis.exceptions import ConnectionError as RedisConnectionError, NoScriptError
+
+
+class ScriptRegistry:
+    """
+    Lua scripts loaded once with SCRIPT LOAD and invoked by SHA1 (EVALSHA).
+    The script cache of the server is emptied on restart or failover,
+    in which case all the scripts are transparently loaded again.
+    """
+
+    def __init__(self, sources: Dict[str, str]):
+        self.sources = sources
+        self.shas = {
+            name: hashlib.sha1(source.encode()).hexdigest()
+            for name, source in sources.items()
+        }
+        self.loaded = False
+
+    async def load(self, client: redis.Redis) -> None:
+        pipe = client.pipeline(transaction=False)
+        for source in self.sources.values():
+            pipe.script_load(source)
+        await pipe.execute()
+        self.loaded = True
+
+    async def run(
+        self,
+        client: redis.Redis,
+        name: str,
+        keys: Sequence[str] = (),
+        args: Sequence = (),
+    ):
+        if not self.loaded:
+            await self.load(client)
+        try:
+            return await client.evalsha(self.shas[name], len(keys), *keys, *args)
+        except NoScriptError:
+            # not run, the scripts are loaded again (idempotent) even if the server
+            # dropped the connection meanwhile (e.g. on failover)
+            try:
+                await self.load(client)
+            except RedisConnectionError:
+                await self.load(client)
+            return await client.evalsha(self.shas[name], len(keys), *keys, *args)
+
+
+APPEND_EVENTS = """
+local log_key = KEYS[1]
+local expected_len = tonumber(ARGV[1])
+
+local stored_len = redis.call("LLEN", log_key)
+if stored_len ~= expected_len then
+    return {0, stored_len}
+end
+
+for i = 2, #ARGV, 1000 do
+    redis.call("RPUSH", log_key, unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call("PUBLISH", log_key, "")
+return {1, stored_len + #ARGV - 1}
+"""
+
+WRITE_EVENTS = """
+local log_key = KEYS[1]
+local legacy_key = KEYS[2]
+
+redis.call("DEL", log_key, legacy_key)
+for i = 1, #ARGV, 1000 do
+    redis.call("RPUSH", log_key, unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call("PUBLISH", log_key, "")
+"""
+
+MIGRATE_EVENTS = """
+local log_key = KEYS[1]
+local legacy_key = KEYS[2]
+
+-- another reader may have migrated it already
+if redis.call("EXISTS", legacy_key) == 0 then
+    return
+end
+redis.call("DEL", legacy_key)
+-- legacy events come first
+for i = #ARGV, 1, -1 do
+    redis.call("LPUSH", log_key, ARGV[i])
+end
+"""
+
+# retention of the metadata list, entries beyond max_entries (if > 0) are dropped
+# and counted, the blobs expiring after ttl_ms (if > 0) are counted when read or
+# once their refs reach the tail (oldest first) on the next push
+PUSH_METADATA = """
+local function push_metadata(log_key, dropped_key, meta_key, content, max_entries, ttl_ms)
+    redis.call("LPUSH", log_key, meta_key)
+    if ttl_ms > 0 then
+        redis.call("SET", meta_key, content, "PX", ttl_ms)
+    else
+        redis.call("SET", meta_key, content)
+    end
+
+    if max_entries > 0 then
+        local dropped = redis.call("LRANGE", log_key, max_entries, -1)
+        if #dropped > 0 then
+            for i = 1, #dropped, 1000 do
+                redis.call("DEL", unpack(dropped, i, math.min(i + 999, #dropped)))
+            end
+            redis.call("LTRIM", log_key, 0, max_entries - 1)
+            redis.call("INCRBY", dropped_key, #dropped)
+        end
+    end
+
+    if ttl_ms > 0 then
+        local expired = 0
+        while true do
+            local oldest = redis.call("LINDEX", log_key, -1)
+            if not oldest or redis.call("EXISTS", oldest) == 1 then
+                break
+            end
+            redis.call("RPOP", log_key)
+            expired = expired + 1
+        end
+        if expired > 0 then
+            redis.call("INCRBY", dropped_key, expired)
+        end
+    end
+end
+"""
+
+# schedules of a queue, also indexed per run (run_q_key) so that a new schedule
+# overwrites the earlier replays of the run (empty payload) without scanning the queue,
+# the agents watching the queue are woken up (published on q_key)
+SCHEDULES = """
+local function close_schedule(q_key, run_q_key, sched_key)
+    redis.call("ZREM", q_key, sched_key)
+    redis.call("ZREM", run_q_key, sched_key)
+    redis.call("DEL", sched_key)
+end
+
+local function add_schedule(q_key, run_q_key, sched_key, score, content)
+    local planned = redis.call("ZRANGEBYSCORE", run_q_key, "-inf", score)
+    for _, planned_key in ipairs(planned) do
+        if planned_key ~= sched_key and redis.call("GET", planned_key) == "" then
+            close_schedule(q_key, run_q_key, planned_key)
+        end
+    end
+    redis.call("ZADD", q_key, score, sched_key)
+    redis.call("ZADD", run_q_key, score, sched_key)
+    redis.call("SET", sched_key, content)
+    redis.call("PUBLISH", q_key, "")
+end
+"""
+
+COMMIT_REPLAY = (
+    PUSH_METADATA
+    + SCHEDULES
+    + """
+local log_key = KEYS[1]
+local meta_log_key = KEYS[2]
+local meta_key = KEYS[3]
+local q_key = KEYS[4]
+local sched_key = KEYS[5]
+local dropped_key = KEYS[6]
+local run_q_key = KEYS[7]
+local next_sched_key = KEYS[8]
+local expected_len = tonumber(ARGV[1])
+local metadata = ARGV[2]
+local next_score = ARGV[3]
+local next_content = ARGV[4]
+local max_entries = tonumber(ARGV[5])
+local ttl_ms = tonumber(ARGV[6])
+local n_events = #ARGV - 6
+
+local stored_len = redis.call("LLEN", log_key)
+if n_events > 0 then
+    if stored_len ~= expected_len then
+        return {0, stored_len}
+    end
+    for i = 7, #ARGV, 1000 do
+        redis.call("RPUSH", log_key, unpack(ARGV, i, math.min(i + 999, #ARGV)))
+    end
+    redis.call("PUBLISH", log_key, "")
+end
+
+push_metadata(meta_log_key, dropped_key, meta_key, metadata, max_entries, ttl_ms)
+
+close_schedule(q_key, run_q_key, sched_key)
+
+if next_sched_key ~= nil then
+    add_schedule(q_key, run_q_key, next_sched_key, next_score, next_content)
+end
+
+return {1, stored_len + n_events}
+"""
+)
+
+APPEND_METADATA = (
+    PUSH_METADATA
+    + """
+local log_key = KEYS[1]
+local dropped_key = KEYS[2]
+local sched_key = KEYS[3]
+local content = ARGV[1]
+local max_entries = tonumber(ARGV[2])
+local ttl_ms = tonumber(ARGV[3])
+
+push_metadata(log_key, dropped_key, sched_key, content, max_entries, ttl_ms)
+"""
+)
+
+# reads the metadata blobs, the references to expired ones are removed and counted
+READ_METADATA = """
+local log_key = KEYS[1]
+local dropped_key = KEYS[2]
+
+local refs = redis.call("LRANGE", log_key, 0, -1)
+local logs = {}
+local expired = 0
+for _, ref in ipairs(refs) do
+    local log = redis.call("GET", ref)
+    if log then
+        table.insert(logs, log)
+    else
+        redis.call("LREM", log_key, 1, ref)
+        expired = expired + 1
+    end
+end
+
+if expired > 0 then
+    redis.call("INCRBY", dropped_key, expired)
+end
+return logs
+"""
+
+# sched_key => run_id, the run_id being the part after the last separator
+RUN_ID_OF = """
+local function run_id_of(sched_key, separator)
+    local from, last = 1, nil
+    while true do
+        local i = string.find(sched_key, separator, from, true)
+        if i == nil then
+            break
+        end
+        last, from = i, i + 1
+    end
+    return string.sub(sched_key, last + #separator)
+end
+"""
+
+NEXT_RUN = (
+    RUN_ID_OF
+    + """
+local q_key = KEYS[1]
+local separator = ARGV[1]
+local max_score = ARGV[2]
+local batch = 128
+
+local excludes = {}
+for i = 3, #ARGV do
+    excludes[ARGV[i]] = true
+end
+
+local offset = 0
+while true do
+    local sched_keys = redis.call(
+        "ZRANGEBYSCORE", q_key, "-inf", max_score, "LIMIT", offset, batch
+    )
+    for _, sched_key in ipairs(sched_keys) do
+        if not excludes[run_id_of(sched_key, separator)] then
+            return sched_key
+        end
+    end
+    if #sched_keys < batch then
+        return nil
+    end
+    offset = offset + batch
+end
+"""
+)
+
+# leases expire natively (PX), the legacy ones (without TTL) hold their expiry date
+# instead: taken over once it has passed, honoured until then
+TAKE_LEASE = """
+local function take_lease(lease_ref, now, lease_ms)
+    if redis.call("SET", lease_ref, now, "NX", "PX", lease_ms) then
+        return true
+    end
+    if redis.call("PTTL", lease_ref) == -1 then
+        -- str(datetime) or isoformat, both compare as strings once aligned
+        local legacy_exp = string.gsub(redis.call("GET", lease_ref), " ", "T")
+        if legacy_exp < now then
+            redis.call("SET", lease_ref, now, "PX", lease_ms)
+            return true
+        end
+    end
+    return false
+end
+"""
+
+ACQUIRE_LEASE = (
+    TAKE_LEASE
+    + """
+local lease_ref = KEYS[1]
+local now = ARGV[1]
+local lease_ms = ARGV[2]
+
+if take_lease(lease_ref, now, lease_ms) then
+    return 1
+end
+return 0
+"""
+)
+
+CLAIM_NEXT = (
+    RUN_ID_OF
+    + TAKE_LEASE
+    + """
+local q_key = KEYS[1]
+local separator = ARGV[1]
+local max_score = ARGV[2]
+local lease_prefix = ARGV[3]
+local now = ARGV[4]
+local lease_ms = ARGV[5]
+local batch = 128
+
+local offset = 0
+while true do
+    local sched_keys = redis.call(
+        "ZRANGEBYSCORE", q_key, "-inf", max_score, "LIMIT", offset, batch
+    )
+    for _, sched_key in ipairs(sched_keys) do
+        local lease_ref = lease_prefix .. run_id_of(sched_key, separator)
+        if take_lease(lease_ref, now, lease_ms) then
+            return sched_key
+        end
+    end
+    if #sched_keys < batch then
+        return nil
+    end
+    offset = offset + batch
+end
+"""
+)
+
+# schedules:/{queue} => ref_:/{run_id}:/{schedule} => run_id scored by due timestamp
+# (legacy layout) moved to the due and per-run sorted sets, payloads are kept as is
+MIGRATE_SCHEDULES = (
+    RUN_ID_OF
+    + """
+local legacy_q_key = KEYS[1]
+local q_key = KEYS[2]
+local separator = ARGV[1]
+local prefix = ARGV[2]
+local queue = ARGV[3]
+
+local migrated = 0
+for _, sched_ref in ipairs(redis.call("ZRANGE", legacy_q_key, 0, -1)) do
+    -- the schedule is the last part of the ref, as the run_id of a sched_key
+    local schedule = run_id_of(sched_ref, separator)
+    local planned = redis.call("ZRANGE", sched_ref, 0, -1, "WITHSCORES")
+    for i = 1, #planned, 2 do
+        local run_id, score = planned[i], planned[i + 1]
+        local sched_key = prefix .. separator .. schedule .. separator .. run_id
+        -- closed ones may have left their ref behind
+        if redis.call("EXISTS", sched_key) == 1 then
+            local run_q_key = prefix .. separator .. "runs" .. separator .. run_id
+                .. separator .. "schedules" .. separator .. queue
+            redis.call("ZADD", q_key, score, sched_key)
+            redis.call("ZADD", run_q_key, score, sched_key)
+            migrated = migrated + 1
+        end
+    end
+    redis.call("DEL", sched_ref)
+end
+redis.call("DEL", legacy_q_key)
+
+if migrated > 0 then
+    redis.call("PUBLISH", q_key, "")
+end
+return migrated
+"""
+)
+
+ADD_SCHEDULE = (
+    SCHEDULES
+    + """
+local q_key = KEYS[1]
+local run_q_key = KEYS[2]
+local sched_key = KEYS[3]
+local sched_score = ARGV[1]
+local content = ARGV[2]
+
+add_schedule(q_key, run_q_key, sched_key, sched_score, content)
+"""
+)
+
+CLOSE_SCHEDULE = (
+    SCHEDULES
+    + """
+local q_key = KEYS[1]
+local run_q_key = KEYS[2]
+local sched_key = KEYS[3]
+
+close_schedule(q_key, run_q_key, sched_key)
+"""
+)
+
+SCRIPTS = {
+    "append_events": APPEND_EVENTS,
+    "commit_replay": COMMIT_REPLAY,
+    "write_events": WRITE_EVENTS,
+    "migrate_events": MIGRATE_EVENTS,
+    "append_metadata": APPEND_METADATA,
+    "read_metadata": READ_METADATA,
+    "next_run": NEXT_RUN,
+    "claim_next": CLAIM_NEXT,
+    "acquire_lease": ACQUIRE_LEASE,
+    "add_schedule": ADD_SCHEDULE,
+    "migrate_schedules": MIGRATE_SCHEDULES,
+    "close_schedule": CLOSE_SCHEDULE,
+}
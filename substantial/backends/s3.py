@@ -0,0 +1,514 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+import os
+import random
+import time
+from typing import Callable, Dict, List, Tuple, TypeVar, Union
+from uuid import uuid4
+
+import orjson as json
+from substantial.backends.backend import Backend, ConflictError, Retention
+from substantial.backends.codec import Codec, Compression
+from substantial.protos.events import Event, Records
+from substantial.protos.metadata import Records as MetadataRecords
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # optional, only required by this backend
+    boto3 = None
+    ClientError = Exception
+
+
+T = TypeVar("T")
+
+# [schedule isoformat, run_id, "replay" | "event"]
+Entry = List[str]
+
+# concurrent conditional writes on the same key may also be rejected with a 409
+CONDITION_FAILED = {"PreconditionFailed", "ConditionalRequestConflict"}
+NOT_FOUND = {"NoSuchKey", "404", "NotFound"}
+NOT_MODIFIED = {"304", "NotModified"}
+
+# leases seen held by other processes are not tried again for that long
+lease_cache_seconds = 1
+# read-modify-writes given up (ConflictError) after that many rejected writes
+update_attempts = 16
+
+
+class S3Backend(Backend):
+    """
+    Backend built on an S3-compatible object storage supporting conditional
+    writes (If-None-Match / If-Match), e.g. AWS S3 or MinIO.
+
+    Mental model (all keys under prefix/):
+        * runs/{run_id}/events/{offset} => Records appended at that offset
+            - Immutable, created only if absent (If-None-Match: *), which makes
+              a concurrent append at the same offset fail
+        * runs/{run_id}/logs/{schedule} => metadata of a replay
+        * runs/{run_id}/logs_dropped => count of the entries dropped by the retention
+        * links/runs/{workflow_name}/{run_id} => empty
+        * schedules/{queue}/{schedule}/{run_id} => schedule payload (empty for replays)
+        * queues/{queue}/manifest => sorted [schedule, run_id, kind] of the queue
+            - Replaced with If-Match on its ETag, retried on conflicts
+            - Cached and revalidated (If-None-Match), next_run never lists the bucket
+        * leases/{run_id} => owner token of the process and a random nonce,
+          held until LastModified + lease_seconds
+            - Taken with If-None-Match: * or If-Match on the ETag of the expired one
+            - Renewed with If-Match by its owner only
+            - Claims try the due runs of the manifest one by one, never listing them
+
+    boto3 being blocking, the requests run on a thread pool (opened lazily per process).
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "substantial",
+        *,
+        io_concurrency: int = 16,
+        binary: bool = True,
+        compression: Union[Compression, None] = Compression(),
+        retention: Retention = Retention(),
+        **client_options,
+    ):
+        """
+        * bucket, prefix => location of the objects
+        * io_concurrency => requests in flight per process
+        * binary => protobuf wire encoding of the stored messages (JSON otherwise)
+        * compression => compression of the large binary payloads (None to disable)
+        * retention => bounds on the metadata kept per run (unbounded by default)
+        * client_options => passed to boto3.client("s3"), e.g. endpoint_url
+        """
+        if boto3 is None:
+            raise ImportError("S3Backend requires the boto3 package")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.io_concurrency = io_concurrency
+        self.codec = Codec(binary, compression)
+        self.retention = retention
+        self.client_options = client_options
+
+        self._pid: Union[int, None] = None
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._client = None
+        # queue => (etag, entries)
+        self._manifests: Dict[str, Tuple[str, List[Entry]]] = {}
+        # identifies the leases of this process
+        self._owner = ""
+        # run_id => seen held by another process until then (bounded by lease_cache)
+        self._held: Dict[str, datetime] = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pid=None, _executor=None, _client=None, _manifests={}, _held={})
+        return state
+
+    # Utils
+
+    async def _io(self, fn: Callable[..., T], *args) -> T:
+        if self._pid != os.getpid():
+            # neither threads nor connections survive a fork
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.io_concurrency, thread_name_prefix="substantial-s3"
+            )
+            self._client = boto3.client("s3", **self.client_options)
+            self._owner = str(uuid4())
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    def _key(self, *parts: str) -> str:
+        return "/".join([self.prefix, *parts])
+
+    def _list(self, prefix: str) -> List[dict]:
+        paginator = self._client.get_paginator("list_objects_v2")
+        objects = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.extend(page.get("Contents", []))
+        return objects
+
+    def _get(self, key: str) -> Union[bytes, None]:
+        try:
+            return self._client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except ClientError as e:
+            if code(e) in NOT_FOUND:
+                return None
+            raise
+
+    def _put(self, key: str, body: bytes, **conditions) -> Union[str, None]:
+        """ETag of the new object, None if the conditions do not hold"""
+        try:
+            return self._client.put_object(
+                Bucket=self.bucket, Key=key, Body=body, **conditions
+            )["ETag"]
+        except ClientError as e:
+            if code(e) in CONDITION_FAILED:
+                return None
+            raise
+
+    def _delete(self, keys: List[str]) -> None:
+        for i in range(0, len(keys), 1000):
+            self._client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+            )
+
+    # Backend
+
+    async def read_events(self, run_id: str) -> Union[Records, None]:
+        def read():
+            segments = self._segments(run_id)
+            if len(segments) == 0:
+                return None
+
+            events = []
+            for segment in segments:
+                events.extend(self.codec.decode(self._get(segment), Records).events)
+            return Records(run_id=run_id, events=events)
+
+        return await self._io(read)
+
+    async def write_events(self, run_id: str, content: Records) -> None:
+        def write():
+            self._delete(self._segments(run_id))
+            self._put(self._key("runs", run_id, "events", segment_name(0)), data)
+
+        data = self.codec.encode(content)
+        await self._io(write)
+
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        if len(new_events) == 0:
+            return
+
+        def append():
+            stored_len = 0
+            segments = self._segments(run_id)
+            if len(segments) > 0:
+                last = segments[-1]
+                stored_len = int(last.rsplit("/", 1)[1]) + len(
+                    self.codec.decode(self._get(last), Records).events
+                )
+
+            if stored_len != expected_len:
+                raise ConflictError(
+                    f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+                )
+
+            key = self._key("runs", run_id, "events", segment_name(expected_len))
+            if self._put(key, data, IfNoneMatch="*") is None:
+                raise ConflictError(f"events of {run_id}: concurrent append")
+
+        data = self.codec.encode(Records(run_id=run_id, events=new_events))
+        await self._io(append)
+
+    def _segments(self, run_id: str) -> List[str]:
+        objects = self._list(self._key("runs", run_id, "events", ""))
+        # zero-padded names, the lexicographic order is the offset order
+        return sorted(obj["Key"] for obj in objects)
+
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
+        def read():
+            return [self._get(key) for key in self._retain_metadata(run_id)]
+
+        logs = await self._io(read)
+        return [
+            self.codec.decode(log, MetadataRecords) for log in logs if log is not None
+        ]
+
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        count = await self._io(self._get, self._key("runs", run_id, "logs_dropped"))
+        return 0 if count is None else int(count)
+
+    async def append_metadata(
+        self, run_id: str, schedule: datetime, content: MetadataRecords
+    ) -> None:
+        def append():
+            self._put(self._key("runs", run_id, "logs", schedule.isoformat()), data)
+            if self.retention != Retention():
+                self._retain_metadata(run_id)
+
+        data = self.codec.encode(content)
+        await self._io(append)
+
+    def _retain_metadata(self, run_id: str) -> List[str]:
+        """Drop the entries beyond the retention policy, return the remaining ones"""
+        objects = sorted(
+            self._list(self._key("runs", run_id, "logs", "")), key=lambda o: o["Key"]
+        )
+        cut = 0
+        if self.retention.ttl is not None:
+            horizon = datetime.now(timezone.utc) - self.retention.ttl
+            while cut < len(objects) and objects[cut]["LastModified"] < horizon:
+                cut += 1
+        if self.retention.max_entries is not None:
+            cut = max(cut, len(objects) - self.retention.max_entries)
+
+        if cut > 0:
+            self._delete([obj["Key"] for obj in objects[:cut]])
+            counter = self._key("runs", run_id, "logs_dropped")
+            self._update(counter, lambda count: str(int(count or 0) + cut).encode())
+
+        return [obj["Key"] for obj in objects[cut:]]
+
+    def _update(self, key: str, update: Callable[[Union[bytes, None]], bytes]) -> str:
+        """
+        Read-modify-write of an object, retried until no one else changed it
+        (ConflictError after update_attempts).
+        """
+        for attempt in range(update_attempts):
+            if attempt > 0:
+                # capped exponential backoff, jittered so that writers spread out
+                time.sleep(random.uniform(0, min(1.0, 0.02 * 2**attempt)))
+            try:
+                obj = self._client.get_object(Bucket=self.bucket, Key=key)
+                etag, content = obj["ETag"], obj["Body"].read()
+            except ClientError as e:
+                if code(e) not in NOT_FOUND:
+                    raise
+                etag, content = None, None
+
+            conditions = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+            new_etag = self._put(key, update(content), **conditions)
+            if new_etag is not None:
+                return new_etag
+
+        raise ConflictError(f"{key}: still changed after {update_attempts} attempts")
+
+    async def read_workflow_links(self, workflow_name: str) -> List[str]:
+        prefix = self._key("links", "runs", workflow_name, "")
+        objects = await self._io(self._list, prefix)
+        return sorted(obj["Key"][len(prefix) :] for obj in objects)
+
+    async def write_workflow_link(self, workflow_name: str, run_id: str) -> None:
+        await self._io(
+            self._put, self._key("links", "runs", workflow_name, run_id), b""
+        )
+
+    async def next_run(
+        self, queue: str, excludes: list[str]
+    ) -> Union[Tuple[str, datetime], None]:
+        excludes_set = set(excludes)
+        now = datetime.now()
+
+        entries = await self._io(self._manifest, queue)
+        for schedule, run_id, _ in entries:
+            at = datetime.fromisoformat(schedule)
+            if at > now:
+                break
+            if run_id not in excludes_set:
+                return run_id, at
+
+        return None
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        now = datetime.now()
+        entries = await self._io(self._manifest, queue)
+        for schedule, _, _ in entries:
+            at = datetime.fromisoformat(schedule)
+            if at > now:
+                return at
+        return None
+
+    async def queue_depth(self, queue: str) -> int:
+        now = datetime.now()
+        entries = await self._io(self._manifest, queue)
+        return sum(
+            1 for schedule, _, _ in entries if datetime.fromisoformat(schedule) <= now
+        )
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        def claim():
+            now = datetime.now()
+            self._held = {r: until for r, until in self._held.items() if until > now}
+            tried = set()
+            for schedule, run_id, _ in self._manifest(queue):
+                at = datetime.fromisoformat(schedule)
+                if at > now:
+                    break
+                if run_id in tried or run_id in self._held:
+                    continue
+                tried.add(run_id)
+                if self._acquire_lease(run_id, lease_seconds):
+                    return run_id, at
+            return None
+
+        return await self._io(claim)
+
+    def _manifest(self, queue: str) -> List[Entry]:
+        key = self._key("queues", queue, "manifest")
+        cached = self._manifests.get(queue)
+        conditions = {} if cached is None else {"IfNoneMatch": cached[0]}
+        try:
+            obj = self._client.get_object(Bucket=self.bucket, Key=key, **conditions)
+        except ClientError as e:
+            if code(e) in NOT_MODIFIED:
+                return cached[1]
+            if code(e) in NOT_FOUND:
+                return []
+            raise
+
+        entries = json.loads(obj["Body"].read())
+        self._manifests[queue] = (obj["ETag"], entries)
+        return entries
+
+    def _update_manifest(
+        self, queue: str, update: Callable[[List[Entry]], None]
+    ) -> List[Entry]:
+        """Apply `update` to the entries of the manifest, return them"""
+        entries: List[Entry] = []
+
+        def apply(content: Union[bytes, None]) -> bytes:
+            nonlocal entries
+            entries = [] if content is None else json.loads(content)
+            update(entries)
+            entries.sort(key=lambda e: (datetime.fromisoformat(e[0]), e[1]))
+            return json.dumps(entries)
+
+        key = self._key("queues", queue, "manifest")
+        etag = self._update(key, apply)
+        self._manifests[queue] = (etag, entries)
+        return entries
+
+    async def add_schedule(
+        self, queue: str, run_id: str, schedule: datetime, content: Union[Event, None]
+    ) -> None:
+        iso = schedule.isoformat()
+        fused: List[str] = []
+
+        def update(entries: List[Entry]):
+            # new schedules overwrite the earlier replays of the run (see FSBackend)
+            fused.clear()
+            for entry in list(entries):
+                planned, planned_run, kind = entry
+                if (
+                    planned_run == run_id
+                    and kind == "replay"
+                    and datetime.fromisoformat(planned) <= schedule
+                ) or (planned == iso and planned_run == run_id):
+                    entries.remove(entry)
+                    if planned != iso:
+                        fused.append(planned)
+            entries.append([iso, run_id, "replay" if content is None else "event"])
+
+        def add():
+            # payload first, the manifest never points to a missing one
+            self._put(self._key("schedules", queue, iso, run_id), data)
+            self._update_manifest(queue, update)
+            self._delete(
+                [self._key("schedules", queue, planned, run_id) for planned in fused]
+            )
+
+        data = b"" if content is None else self.codec.encode(content)
+        await self._io(add)
+
+    async def read_schedule(
+        self, queue: str, run_id: str, schedule: datetime
+    ) -> Union[Event, None]:
+        key = self._key("schedules", queue, schedule.isoformat(), run_id)
+        ret = await self._io(self._get, key)
+        if ret is None:
+            raise Exception(f"schedule not found: {key}")
+        return None if ret == b"" else self.codec.decode(ret, Event)
+
+    async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
+        iso = schedule.isoformat()
+
+        def update(entries: List[Entry]):
+            entries[:] = [e for e in entries if not (e[0] == iso and e[1] == run_id)]
+
+        def close():
+            self._update_manifest(queue, update)
+            self._delete([self._key("schedules", queue, iso, run_id)])
+
+        await self._io(close)
+
+    # Agent related
+
+    async def active_leases(self, lease_seconds: int) -> List[str]:
+        return await self._io(self._active_leases, lease_seconds)
+
+    def _active_leases(self, lease_seconds: int) -> List[str]:
+        prefix = self._key("leases", "")
+        horizon = datetime.now(timezone.utc) - timedelta(seconds=lease_seconds)
+        return [
+            obj["Key"][len(prefix) :]
+            for obj in self._list(prefix)
+            if obj["LastModified"] > horizon
+        ]
+
+    async def acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
+        return await self._io(self._acquire_lease, run_id, lease_seconds)
+
+    def _lease_token(self) -> bytes:
+        # random nonce, distinct ETag on each write
+        return f"{self._owner} {uuid4()}".encode()
+
+    def _lease_owner(self, key: str) -> Tuple[Union[str, None], Union[str, None]]:
+        """Owner and ETag of the lease, None if absent"""
+        try:
+            obj = self._client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if code(e) in NOT_FOUND:
+                return None, None
+            raise
+        return obj["Body"].read().decode().split(" ")[0], obj["ETag"]
+
+    def _acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
+        key = self._key("leases", run_id)
+        if self._put(key, self._lease_token(), IfNoneMatch="*") is not None:
+            return True
+
+        try:
+            head = self._client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if code(e) not in NOT_FOUND:
+                raise
+            return False  # just removed, left to the next claim
+
+        expires = head["LastModified"] + timedelta(seconds=lease_seconds)
+        if expires > datetime.now(timezone.utc):
+            # skipped by the next claims for a while, it is likely still held then
+            until = datetime.now() + timedelta(seconds=lease_cache_seconds)
+            self._held[run_id] = min(expires.astimezone().replace(tzinfo=None), until)
+            return False
+        return self._put(key, self._lease_token(), IfMatch=head["ETag"]) is not None
+
+    async def renew_lease(self, run_id: str, lease_seconds: int) -> bool:
+        def renew():
+            key = self._key("leases", run_id)
+            owner, etag = self._lease_owner(key)
+            if owner is None:
+                raise Exception(f"lease not found {key}")
+            if owner != self._owner:
+                return False  # expired and taken over
+            return self._put(key, self._lease_token(), IfMatch=etag) is not None
+
+        return await self._io(renew)
+
+    async def remove_lease(self, run_id: str, _lease_seconds: int):
+        def remove():
+            key = self._key("leases", run_id)
+            owner, _ = self._lease_owner(key)
+            if owner == self._owner:
+                self._delete([key])
+
+        self._held.pop(run_id, None)
+        await self._io(remove)
+
+
+def code(e: ClientError) -> str:
+    return e.response.get("Error", {}).get("Code", "")
+
+
+def segment_name(offset: int) -> str:
+    # zero-padded so that the lexicographic order is the offset order
+    return f"{offset:012d}"
@@ -0,0 +1,565 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Callable, List, Tuple, TypeVar, Union
+
+from substantial.backends.backend import Backend, ConflictError, Retention
+from substantial.backends.codec import Codec, Compression
+from substantial.protos.events import Event, Records
+from substantial.protos.metadata import Records as MetadataRecords
+
+
+T = TypeVar("T")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    run_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event BLOB NOT NULL,
+    PRIMARY KEY (run_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS metadata (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    schedule TEXT NOT NULL,
+    content BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_run ON metadata (run_id, id);
+
+CREATE TABLE IF NOT EXISTS metadata_dropped (
+    run_id TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS links (
+    workflow_name TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    PRIMARY KEY (workflow_name, run_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS schedules (
+    queue TEXT NOT NULL,
+    schedule TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    due_at REAL NOT NULL,
+    content BLOB,
+    PRIMARY KEY (queue, schedule, run_id)
+);
+CREATE INDEX IF NOT EXISTS schedules_due ON schedules (queue, due_at);
+CREATE INDEX IF NOT EXISTS schedules_run ON schedules (run_id, queue, due_at);
+
+CREATE TABLE IF NOT EXISTS leases (
+    run_id TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SQLiteBackend(Backend):
+    """
+    Single host backend stored in one SQLite database (WAL mode), that can be
+    shared by the processes of the host (e.g. the agents).
+
+    Mental model:
+        * events => (run_id, seq) -> event, appended only if the run still
+          holds the expected number of events
+        * metadata => one row per replay, bounded by the retention policy
+        * schedules => (queue, schedule, run_id) -> payload (NULL for replays),
+          dispatched once due through the (queue, due_at) index
+        * leases => run_id -> expiration timestamp, claimed in the same
+          transaction as the schedule lookup
+
+    The blocking sqlite3 calls run on a single thread per process, the
+    connection being opened on it lazily (and again after a fork).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        busy_timeout: float = 5,
+        binary: bool = True,
+        compression: Union[Compression, None] = Compression(),
+        retention: Retention = Retention(),
+    ):
+        """
+        * path => database file, created if missing
+        * busy_timeout => seconds to wait for a lock held by another process
+        * binary => protobuf wire encoding of the stored messages (JSON otherwise)
+        * compression => compression of the large binary payloads (None to disable)
+        * retention => bounds on the metadata kept per run (unbounded by default)
+        """
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.codec = Codec(binary, compression)
+        self.retention = retention
+
+        self._pid: Union[int, None] = None
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self._conn: Union[sqlite3.Connection, None] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_pid=None, _executor=None, _conn=None)
+        return state
+
+    # Utils
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        if self._pid != os.getpid():
+            # threads and connections do not survive a fork
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="substantial-sqlite"
+            )
+            self._conn = None
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args))
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock upfront, the reads are thus consistent
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # Backend
+
+    async def read_events(self, run_id: str) -> Union[Records, None]:
+        def read():
+            return (
+                self._connection()
+                .execute(
+                    "SELECT event FROM events WHERE run_id = ? ORDER BY seq", (run_id,)
+                )
+                .fetchall()
+            )
+
+        rows = await self._run(read)
+        if len(rows) == 0:
+            return None
+
+        return Records(
+            run_id=run_id, events=[self.codec.decode(row[0], Event) for row in rows]
+        )
+
+    async def write_events(self, run_id: str, content: Records) -> None:
+        events = [self.codec.encode(event) for event in content.events]
+
+        def write():
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM events WHERE run_id = ?", (run_id,))
+                conn.executemany(
+                    "INSERT INTO events (run_id, seq, event) VALUES (?, ?, ?)",
+                    [(run_id, seq, event) for seq, event in enumerate(events)],
+                )
+
+        await self._run(write)
+
+    async def append_events(
+        self, run_id: str, new_events: List[Event], expected_len: int
+    ) -> None:
+        if len(new_events) == 0:
+            return
+
+        events = [self.codec.encode(event) for event in new_events]
+
+        def append():
+            with self._transaction() as conn:
+                self._append_events(conn, run_id, events, expected_len)
+
+        await self._run(append)
+
+    def _append_events(
+        self,
+        conn: sqlite3.Connection,
+        run_id: str,
+        events: List[bytes],
+        expected_len: int,
+    ) -> None:
+        # seq is contiguous from 0, the last one is found on the primary key
+        (stored_len,) = conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM events WHERE run_id = ?", (run_id,)
+        ).fetchone()
+        if stored_len != expected_len:
+            raise ConflictError(
+                f"events of {run_id}: expected {expected_len} stored, got {stored_len}"
+            )
+        conn.executemany(
+            "INSERT INTO events (run_id, seq, event) VALUES (?, ?, ?)",
+            [(run_id, stored_len + i, event) for i, event in enumerate(events)],
+        )
+
+    async def commit_replay(
+        self,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        new_events: List[Event],
+        expected_len: int,
+        metadata: MetadataRecords,
+        next_schedule: Union[Tuple[datetime, Union[Event, None]], None],
+    ) -> None:
+        events = [self.codec.encode(event) for event in new_events]
+        content = self.codec.encode(metadata)
+        next_content = None
+        if next_schedule is not None and next_schedule[1] is not None:
+            next_content = self.codec.encode(next_schedule[1])
+
+        def commit():
+            with self._transaction() as conn:
+                if len(events) > 0:
+                    self._append_events(conn, run_id, events, expected_len)
+                self._append_metadata(conn, run_id, schedule, content)
+                self._close_schedule(conn, queue, run_id, schedule)
+                if next_schedule is not None:
+                    self._add_schedule(
+                        conn, queue, run_id, next_schedule[0], next_content
+                    )
+
+        await self._run(commit)
+
+    async def read_all_metadata(self, run_id: str) -> List[MetadataRecords]:
+        def read():
+            # the write lock is only taken when there are expired entries to drop
+            if self._has_expired_metadata(run_id):
+                with self._transaction() as conn:
+                    self._retain_metadata(conn, run_id)
+            return (
+                self._connection()
+                .execute(
+                    "SELECT content FROM metadata WHERE run_id = ? ORDER BY id",
+                    (run_id,),
+                )
+                .fetchall()
+            )
+
+        rows = await self._run(read)
+        return [self.codec.decode(row[0], MetadataRecords) for row in rows]
+
+    async def read_dropped_metadata(self, run_id: str) -> int:
+        def read():
+            return (
+                self._connection()
+                .execute(
+                    "SELECT count FROM metadata_dropped WHERE run_id = ?", (run_id,)
+                )
+                .fetchone()
+            )
+
+        row = await self._run(read)
+        return 0 if row is None else row[0]
+
+    async def append_metadata(
+        self, run_id: str, schedule: datetime, content: MetadataRecords
+    ):
+        data = self.codec.encode(content)
+
+        def append():
+            with self._transaction() as conn:
+                self._append_metadata(conn, run_id, schedule, data)
+
+        await self._run(append)
+
+    def _append_metadata(
+        self, conn: sqlite3.Connection, run_id: str, schedule: datetime, data: bytes
+    ) -> None:
+        conn.execute(
+            "INSERT INTO metadata (run_id, schedule, content, created_at) VALUES (?, ?, ?, ?)",
+            (run_id, schedule.isoformat(), data, time.time()),
+        )
+        self._retain_metadata(conn, run_id)
+
+    def _has_expired_metadata(self, run_id: str) -> bool:
+        # max_entries is enforced on append, only the ttl expires entries later
+        if self.retention.ttl is None:
+            return False
+        horizon = time.time() - self.retention.ttl.total_seconds()
+        row = (
+            self._connection()
+            .execute(
+                "SELECT created_at FROM metadata WHERE run_id = ? ORDER BY id LIMIT 1",
+                (run_id,),
+            )
+            .fetchone()
+        )
+        return row is not None and row[0] < horizon
+
+    def _retain_metadata(self, conn: sqlite3.Connection, run_id: str) -> None:
+        dropped = 0
+        if self.retention.ttl is not None:
+            horizon = time.time() - self.retention.ttl.total_seconds()
+            dropped += conn.execute(
+                "DELETE FROM metadata WHERE run_id = ? AND created_at < ?",
+                (run_id, horizon),
+            ).rowcount
+        if self.retention.max_entries is not None:
+            dropped += conn.execute(
+                """
+                DELETE FROM metadata WHERE run_id = ? AND id NOT IN (
+                    SELECT id FROM metadata WHERE run_id = ? ORDER BY id DESC LIMIT ?
+                )
+                """,
+                (run_id, run_id, self.retention.max_entries),
+            ).rowcount
+        if dropped > 0:
+            conn.execute(
+                """
+                INSERT INTO metadata_dropped (run_id, count) VALUES (?, ?)
+                ON CONFLICT (run_id) DO UPDATE SET count = count + excluded.count
+                """,
+                (run_id, dropped),
+            )
+
+    async def read_workflow_links(self, workflow_name: str) -> List[str]:
+        def read():
+            return (
+                self._connection()
+                .execute(
+                    "SELECT run_id FROM links WHERE workflow_name = ? ORDER BY run_id",
+                    (workflow_name,),
+                )
+                .fetchall()
+            )
+
+        return [row[0] for row in await self._run(read)]
+
+    async def write_workflow_link(self, workflow_name: str, run_id: str) -> None:
+        def write():
+            self._connection().execute(
+                "INSERT OR IGNORE INTO links (workflow_name, run_id) VALUES (?, ?)",
+                (workflow_name, run_id),
+            )
+
+        await self._run(write)
+
+    async def next_run(
+        self, queue: str, excludes: list[str]
+    ) -> Union[Tuple[str, datetime], None]:
+        excludes_set = set(excludes)
+
+        def first():
+            cursor = self._connection().execute(
+                """
+                SELECT schedule, run_id FROM schedules
+                WHERE queue = ? AND due_at <= ? ORDER BY due_at
+                """,
+                (queue, time.time()),
+            )
+            try:
+                for schedule, run_id in cursor:
+                    if run_id not in excludes_set:
+                        return run_id, datetime.fromisoformat(schedule)
+                return None
+            finally:
+                cursor.close()
+
+        return await self._run(first)
+
+    async def next_due(self, queue: str) -> Union[datetime, None]:
+        def first():
+            row = (
+                self._connection()
+                .execute(
+                    """
+                    SELECT schedule FROM schedules
+                    WHERE queue = ? AND due_at > ? ORDER BY due_at LIMIT 1
+                    """,
+                    (queue, time.time()),
+                )
+                .fetchone()
+            )
+            return None if row is None else datetime.fromisoformat(row[0])
+
+        return await self._run(first)
+
+    async def queue_depth(self, queue: str) -> int:
+        def count():
+            (depth,) = (
+                self._connection()
+                .execute(
+                    "SELECT COUNT(*) FROM schedules WHERE queue = ? AND due_at <= ?",
+                    (queue, time.time()),
+                )
+                .fetchone()
+            )
+            return depth
+
+        return await self._run(count)
+
+    async def claim_next(
+        self, queue: str, lease_seconds: int
+    ) -> Union[Tuple[str, datetime], None]:
+        def claim():
+            with self._transaction() as conn:
+                now = time.time()
+                row = conn.execute(
+                    """
+                    SELECT s.schedule, s.run_id FROM schedules s
+                    LEFT JOIN leases l ON l.run_id = s.run_id AND l.expires_at > ?
+                    WHERE s.queue = ? AND s.due_at <= ? AND l.run_id IS NULL
+                    ORDER BY s.due_at LIMIT 1
+                    """,
+                    (now, queue, now),
+                ).fetchone()
+                if row is None:
+                    return None
+
+                schedule, run_id = row
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (run_id, expires_at) VALUES (?, ?)",
+                    (run_id, now + lease_seconds),
+                )
+                return run_id, datetime.fromisoformat(schedule)
+
+        return await self._run(claim)
+
+    async def add_schedule(
+        self, queue: str, run_id: str, schedule: datetime, content: Union[Event, None]
+    ) -> None:
+        data = None if content is None else self.codec.encode(content)
+
+        def add():
+            with self._transaction() as conn:
+                self._add_schedule(conn, queue, run_id, schedule, data)
+
+        await self._run(add)
+
+    def _add_schedule(
+        self,
+        conn: sqlite3.Connection,
+        queue: str,
+        run_id: str,
+        schedule: datetime,
+        data: Union[bytes, None],
+    ) -> None:
+        # new schedules overwrite the earlier replays of the run (see FSBackend)
+        conn.execute(
+            """
+            DELETE FROM schedules
+            WHERE run_id = ? AND queue = ? AND due_at <= ? AND content IS NULL
+            """,
+            (run_id, queue, schedule.timestamp()),
+        )
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO schedules (queue, schedule, run_id, due_at, content)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (queue, schedule.isoformat(), run_id, schedule.timestamp(), data),
+        )
+
+    async def read_schedule(
+        self, queue: str, run_id: str, schedule: datetime
+    ) -> Union[Event, None]:
+        def read():
+            return (
+                self._connection()
+                .execute(
+                    """
+                    SELECT content FROM schedules
+                    WHERE queue = ? AND schedule = ? AND run_id = ?
+                    """,
+                    (queue, schedule.isoformat(), run_id),
+                )
+                .fetchone()
+            )
+
+        row = await self._run(read)
+        if row is None:
+            raise Exception(f"schedule not found: {queue} {schedule} {run_id}")
+        return None if row[0] is None else self.codec.decode(row[0], Event)
+
+    async def close_schedule(self, queue: str, run_id: str, schedule: datetime) -> None:
+        def close():
+            self._close_schedule(self._connection(), queue, run_id, schedule)
+
+        await self._run(close)
+
+    def _close_schedule(
+        self, conn: sqlite3.Connection, queue: str, run_id: str, schedule: datetime
+    ) -> None:
+        conn.execute(
+            "DELETE FROM schedules WHERE queue = ? AND schedule = ? AND run_id = ?",
+            (queue, schedule.isoformat(), run_id),
+        )
+
+    # Agent related
+
+    async def active_leases(self, _lease_seconds: int) -> List[str]:
+        def read():
+            return (
+                self._connection()
+                .execute(
+                    "SELECT run_id FROM leases WHERE expires_at > ?", (time.time(),)
+                )
+                .fetchall()
+            )
+
+        return [row[0] for row in await self._run(read)]
+
+    async def acquire_lease(self, run_id: str, lease_seconds: int) -> bool:
+        def acquire():
+            now = time.time()
+            return (
+                self._connection()
+                .execute(
+                    """
+                    INSERT INTO leases (run_id, expires_at) VALUES (?, ?)
+                    ON CONFLICT (run_id) DO UPDATE SET expires_at = excluded.expires_at
+                    WHERE leases.expires_at <= ?
+                    """,
+                    (run_id, now + lease_seconds, now),
+                )
+                .rowcount
+                > 0
+            )
+
+        return await self._run(acquire)
+
+    async def renew_lease(self, run_id: str, lease_seconds: int) -> bool:
+        def renew():
+            return (
+                self._connection()
+                .execute(
+                    "UPDATE leases SET expires_at = ? WHERE run_id = ?",
+                    (time.time() + lease_seconds, run_id),
+                )
+                .rowcount
+            )
+
+        if await self._run(renew) == 0:
+            raise Exception(f"lease not found {run_id}")
+        return True
+
+    async def remove_lease(self, run_id: str, _lease_seconds: int):
+        def remove():
+            self._connection().execute("DELETE FROM leases WHERE run_id = ?", (run_id,))
+
+        await self._run(remove)
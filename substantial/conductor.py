@@ -5,6 +5,7 @@ from substantial.agent import Agent
 from substantial.backends.backend import Backend
 from substantial.workflows import Store
 from substantial.filters import WorkflowFilter
+from substantial.pool import AgentPool
 from substantial.workflows.run import Run
 from substantial.workflows.workflow import Workflow
 import aioprocessing
@@ -38,11 +39,21 @@ class Conductor:
     def run_for(self, run_id, queue="default"):
         return Run(run_id, queue, self.backend)
 
-    def run(self, queue="default"):
-        return asyncio.create_task(self.run_as_process(queue))
+    def run(self, queue="default", in_process=False, concurrency=32):
+        """Agent replaying up to `concurrency` runs of the queue at once"""
+        if in_process or self.backend.process_local:
+            return asyncio.create_task(Agent(self.backend, queue, concurrency).run())
+        return asyncio.create_task(self.run_as_process(queue, concurrency))
 
-    async def run_as_process(self, queue):
-        agent = Agent(self.backend, queue)
+    def run_pool(
+        self, queue="default", min_workers=1, max_workers=None, concurrency=32
+    ):
+        """Agent processes scaled with the load of the queue (see AgentPool)"""
+        pool = AgentPool(self.backend, queue, min_workers, max_workers, concurrency)
+        return asyncio.create_task(pool.run())
+
+    async def run_as_process(self, queue, concurrency=32):
+        agent = Agent(self.backend, queue, concurrency)
         p = aioprocessing.AioProcess(target=agent.run_sync)
         try:
             p.start()
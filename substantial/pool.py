@@ -0,0 +1,138 @@
+import asyncio
+from datetime import timedelta
+import math
+import multiprocessing
+import os
+from typing import Any, Dict, List, Set, Union
+
+import aioprocessing
+
+from substantial.agent import Agent, lease_seconds
+from substantial.backends.backend import Backend
+
+
+class AgentPool:
+    """
+    Supervises between min_workers and max_workers agent processes on a queue.
+
+    Every `interval` seconds:
+        * workers that exited on their own (crash) are replaced
+        * the pool grows to cover the runs waiting (due schedules not in flight)
+          and the runs in flight (reported by the agents) with the slots of its
+          agents (`concurrency` each), or by one worker while the runs claimed
+          by an agent waited more than `max_lag` once due (claims lag behind)
+        * the pool shrinks by one worker when fewer are needed
+    The pool keeps its size while the queue depth cannot be read.
+
+    Workers are stopped with SIGTERM: they stop claiming and complete the runs in
+    flight, they are killed after `grace_seconds` (the runs are replayed again).
+    Cancelling the pool stops all its workers that way.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        queue: str = "default",
+        min_workers: int = 1,
+        max_workers: Union[int, None] = None,
+        concurrency: int = 32,
+        interval: float = 5,
+        max_lag: timedelta = timedelta(seconds=5),
+        grace_seconds: float = lease_seconds,
+    ):
+        if max_workers is None:
+            max_workers = max(min_workers, os.cpu_count() or 1)
+        if not (0 <= min_workers <= max_workers and max_workers >= 1):
+            raise ValueError(
+                f"expected 0 <= min_workers <= max_workers, got {min_workers} and {max_workers}"
+            )
+        if backend.process_local:
+            raise ValueError(f"{type(backend).__name__} cannot be shared by processes")
+
+        self.backend = backend
+        self.queue = queue
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_lag = max_lag
+        self.grace_seconds = grace_seconds
+
+        self.workers: List[aioprocessing.AioProcess] = []
+        # worker => runs in flight / claim lag (seconds), reported by its agent
+        self.in_flight: Dict[aioprocessing.AioProcess, Any] = {}
+        self.claim_lag: Dict[aioprocessing.AioProcess, Any] = {}
+        self.stopping: Set[asyncio.Task] = set()
+        self.restarts = 0
+
+    async def run(self):
+        try:
+            while True:
+                self.replace_crashed()
+                try:
+                    target = await self.target()
+                except Exception as e:
+                    print(f"queue {self.queue} not sized, keeping the pool: {e}")
+                else:
+                    self.scale(target)
+                await asyncio.sleep(self.interval)
+        finally:
+            workers, self.workers = self.workers, []
+            await asyncio.gather(
+                *[self.stop(worker) for worker in workers],
+                *self.stopping,
+                return_exceptions=True,
+            )
+
+    async def target(self) -> int:
+        depth = await self.backend.queue_depth(self.queue)
+        in_flight = sum(self.in_flight[worker].value for worker in self.workers)
+        # runs in flight keep their schedule until committed, only the others wait
+        waiting = max(0, depth - in_flight)
+        wanted = math.ceil((waiting + in_flight) / self.concurrency)
+
+        lag = max((self.claim_lag[worker].value for worker in self.workers), default=0)
+        if lag > self.max_lag.total_seconds():
+            wanted = max(wanted, len(self.workers) + 1)
+
+        return min(max(wanted, self.min_workers), self.max_workers)
+
+    def scale(self, target: int):
+        while len(self.workers) < target:
+            self.workers.append(self.spawn())
+
+        if len(self.workers) > target:
+            # one at a time, the depth often only dips between two polls
+            task = asyncio.create_task(self.stop(self.workers.pop()))
+            self.stopping.add(task)
+            task.add_done_callback(self.stopping.discard)
+
+    def replace_crashed(self):
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                print(f"worker {worker.pid} exited ({worker.exitcode}), restarting")
+                self.restarts += 1
+                self.forget(worker)
+                self.workers[i] = self.spawn()
+
+    def spawn(self) -> aioprocessing.AioProcess:
+        in_flight = multiprocessing.Value("i", 0)
+        claim_lag = multiprocessing.Value("d", 0)
+        agent = Agent(self.backend, self.queue, self.concurrency, in_flight, claim_lag)
+        worker = aioprocessing.AioProcess(target=agent.run_sync)
+        worker.start()
+        self.in_flight[worker] = in_flight
+        self.claim_lag[worker] = claim_lag
+        return worker
+
+    async def stop(self, worker: aioprocessing.AioProcess):
+        worker.terminate()
+        await worker.coro_join(self.grace_seconds)
+        if worker.is_alive():
+            worker.kill()
+            await worker.coro_join()
+        self.forget(worker)
+
+    def forget(self, worker: aioprocessing.AioProcess):
+        self.in_flight.pop(worker, None)
+        self.claim_lag.pop(worker, None)
@@ -1,5 +1,5 @@
 import asyncio
-from datetime import timedelta
+from datetime import datetime, timedelta
 import inspect
 
 import orjson as json
@@ -12,10 +12,18 @@ from substantial.protos import events
 
 
 class Interrupt(BaseException):
+    """
+    Raised while waiting on events, the run is parked until a send (a new
+    schedule) or until `until` (aware) when the wait has a timeout.
+    """
+
     hint: str
 
-    def __init__(self, hint: Union[str, None] = None) -> None:
+    def __init__(
+        self, hint: Union[str, None] = None, until: Union[datetime, None] = None
+    ) -> None:
         self.hint = hint or ""
+        self.until = until
 
 
 class RetryMode(BaseException):
@@ -30,7 +38,12 @@ class RetryFail(BaseException):
 
 
 class DelayMode(BaseException):
-    def __init__(self, hint: Union[str, None] = None) -> None:
+    """Raised by timers, `until` (aware) is when the run should be replayed"""
+
+    def __init__(
+        self, until: Union[datetime, None] = None, hint: Union[str, None] = None
+    ) -> None:
+        self.until = until
         self.hint = hint or ""
 
 
@@ -71,12 +84,13 @@ class RetryStrategy:
             )
 
     def linear(self, retries_left: int) -> timedelta:
-        """Scaled timeout in seconds"""
+        """Backoff growing from initial_backoff_interval to max_backoff_interval (seconds)"""
         if retries_left <= 0:
             raise Exception("retries_left <= 0")
         dt = self.max_backoff_interval - self.initial_backoff_interval
         return timedelta(
-            int(((self.max_retries - retries_left) * dt) / self.max_retries)
+            seconds=self.initial_backoff_interval
+            + ((self.max_retries - retries_left) * dt) / self.max_retries
         )
 
 
@@ -112,12 +112,40 @@ class Context:
                 return ret
         return None
 
-    async def ensure(self, f: Callable[[], bool]):
-        """Wait for `condition()` to be True"""
+    async def ensure(self, f: Callable[[], bool], timeout: Optional[timedelta] = None):
+        """
+        Wait for `condition()` to be True, re-evaluated when events are sent.
+        With a timeout, TimeoutError is raised once it elapses.
+        """
+        if timeout is None:
+            result = f()
+            if not result:
+                raise Interrupt("wait => condition is still false")
+            return result
+
+        wait_id = self.__next_id()
+        # the timeout is recorded, replays keep raising whatever is sent later
+        if any(e.is_set("save") and wait_id == e.save.id for e in self.events):
+            raise TimeoutError(f"Wait id#{wait_id} timed out")
+
         result = f()
-        if not result:
-            raise Interrupt("wait => condition is still false")
-        return result
+        if result:
+            return result
+
+        timers = [e for e in self.events if e.is_set("sleep") and wait_id == e.sleep.id]
+        now = datetime.now(tz=timezone.utc)
+        if len(timers) == 0:
+            end = now + timeout
+            self.source(events.Event(sleep=events.Sleep(wait_id, start=now, end=end)))
+        else:
+            end = timers[0].sleep.end.replace(tzinfo=timezone.utc)
+            if now >= end:
+                self.source(
+                    events.Event(save=events.Save(wait_id, json.dumps(False), -1))
+                )
+                raise TimeoutError(f"Wait id#{wait_id} timed out")
+
+        raise Interrupt(f"wait id#{wait_id} => condition is still false", end)
 
     # high-level
 
@@ -132,12 +160,9 @@ class Context:
 
         now = datetime.now(tz=timezone.utc)
         if len(sleep_records) == 0:
-            self.source(
-                events.Event(
-                    sleep=events.Sleep(sleep_id, start=now, end=now + duration)
-                )
-            )
-            raise DelayMode(f"Sleep id#{sleep_id} encoutered")
+            end = now + duration
+            self.source(events.Event(sleep=events.Sleep(sleep_id, start=now, end=end)))
+            raise DelayMode(end, f"Sleep id#{sleep_id} encoutered")
 
         for record in sleep_records:
             op_end = record.sleep.end.replace(tzinfo=timezone.utc)
@@ -145,15 +170,15 @@ class Context:
                 print(f"Skip sleep id#{sleep_id}")
                 return
 
-        raise DelayMode(f"Sleep id#{sleep_id} not ending yet")
+        raise DelayMode(op_end, f"Sleep id#{sleep_id} not ending yet")
 
-    async def receive(self, event_name: str):
+    async def receive(self, event_name: str, timeout: Optional[timedelta] = None):
         """
         Wait for events emitted from outside the workflow
         """
         proxy = {}
         self.handle(event_name, lambda payload: proxy.update(val=payload))
-        await self.ensure(lambda: "val" in proxy)
+        await self.ensure(lambda: "val" in proxy, timeout)
         return proxy["val"]
 
     def cancel_run(self):
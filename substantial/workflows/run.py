@@ -1,7 +1,7 @@
 import asyncio
 import orjson as json
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import List
 
 from substantial.backends.backend import Backend
@@ -39,7 +39,7 @@ class Run:
 
         now = datetime.now()
         event = events.Event(
-            at=now,
+            at=now.astimezone(timezone.utc),
             start=events.Start(
                 kwargs=protobuf.Struct(kwargs),
             ),
@@ -51,7 +51,7 @@ class Run:
     async def send(self, name, value=None):
         now = datetime.now()
         event = events.Event(
-            at=now,
+            at=now.astimezone(timezone.utc),
             send=events.Send(
                 name=name,
                 value=json.dumps(value),
@@ -62,22 +62,27 @@ class Run:
         await self.backend.add_schedule(self.queue, self.run_id, now, event)
 
     async def result(self):
-        while True:
-            events_records = await self.backend.read_events(self.run_id)  # can be none?
-            if events_records is None:
-                await asyncio.sleep(1)
-                continue
-
-            for record in events_records.events:
-                if not record.is_set("stop"):
+        # woken up on new events, polling is only the fallback
+        watch = await self.backend.watch_events(self.run_id)
+        try:
+            while True:
+                events_records = await self.backend.read_events(self.run_id)
+                if events_records is None:
+                    await watch.wait(watch.poll_seconds)
                     continue
 
-                if record.stop.is_set("err"):
-                    raise Exception(json.loads(record.stop.err))
+                for record in events_records.events:
+                    if not record.is_set("stop"):
+                        continue
+
+                    if record.stop.is_set("err"):
+                        raise Exception(json.loads(record.stop.err))
 
-                return json.loads(record.stop.ok)
+                    return json.loads(record.stop.ok)
 
-            await asyncio.sleep(1)
+                await watch.wait(watch.poll_seconds)
+        finally:
+            await watch.close()
 
     async def replay(self, schedule=None):
         start_at = datetime.now()
@@ -85,25 +90,23 @@ class Run:
         # fetch previous events
         records = await self.backend.read_events(self.run_id)
         events_records = [] if records is None else records.events
+        stored_len = len(events_records)
 
         # new on each replay
         metadata_records = [
-            metadata.Metadata(at=start_at, info=metadata.Info("replay"))
+            metadata.Metadata(
+                at=start_at.astimezone(timezone.utc), info=metadata.Info("replay")
+            )
         ]
 
         stopped_run = execution_has_stopped(events_records)
 
         if schedule is not None:
+            # closed by commit_replay only, an abandoned replay keeps it
             new_event = await self.backend.read_schedule(
                 self.queue, self.run_id, schedule
             )
-            if new_event is None:
-                await self.backend.close_schedule(
-                    self.queue,
-                    self.run_id,
-                    schedule,
-                )
-            elif not stopped_run:
+            if new_event is not None and not stopped_run:
                 events_records.append(new_event)
         else:
             schedule = start_at
@@ -115,6 +118,9 @@ class Run:
         if workflow is None:
             raise Exception(f"Unknown workflow: {self.run_id}")
 
+        # follow-up schedule, committed along with the replay outcome
+        next_schedule = None
+        abandoned = False
         try:
             if not stopped_run:
                 ret = await workflow(
@@ -122,9 +128,7 @@ class Run:
                     **ctx.events[0].start.kwargs.to_dict(),
                 )
                 # Alt impl: ctx.events.append(..)
-                await self.backend.add_schedule(
-                    self.queue,
-                    self.run_id,
+                next_schedule = (
                     schedule + timedelta(seconds=0.5),
                     events.Event(
                         stop=events.Stop(
@@ -133,25 +137,22 @@ class Run:
                     ),
                 )
         except Interrupt as interrupt:
-            # FIXME need to specify the delta
             print(f"Interrupted: {interrupt.hint}")
-            await self.backend.add_schedule(
-                self.queue, self.run_id, schedule + timedelta(seconds=10), None
-            )
+            # parked: the sends add schedules, only a timeout needs one here
+            if interrupt.until is not None:
+                next_schedule = (local_schedule(interrupt.until), None)
         except DelayMode as delay:
             print(f"Delay: {delay.hint}")
-            await self.backend.add_schedule(
-                self.queue, self.run_id, schedule + timedelta(seconds=0.5), None
-            )
+            if delay.until is None:
+                next_schedule = (schedule + timedelta(seconds=0.5), None)
+            else:
+                # a single replay once the timer ends
+                next_schedule = (local_schedule(delay.until), None)
         except RetryMode as retry:
             # should be max(0, schedule + retry.delta - **dur_next_lease_avail_if_exp** - **poll_interv**)
-            await self.backend.add_schedule(
-                self.queue, self.run_id, schedule + retry.delta, None
-            )
+            next_schedule = (schedule + retry.delta, None)
         except RetryFail as fail:
-            await self.backend.add_schedule(
-                self.queue,
-                self.run_id,
+            next_schedule = (
                 schedule + timedelta(seconds=0.5),
                 events.Event(
                     stop=events.Stop(
@@ -165,29 +166,37 @@ class Run:
         except Exception as e:
             metadata_records.append(
                 metadata.Metadata(
-                    at=datetime.now(),
+                    at=datetime.now(tz=timezone.utc),
                     error=metadata.Error(f"error: {e}", "stacktrace", str(type(e))),
                 )
             )
-            await self.backend.add_schedule(
-                self.queue, self.run_id, schedule + timedelta(seconds=0.5), None
-            )
+            next_schedule = (schedule + timedelta(seconds=0.5), None)
+            raise
+        except asyncio.CancelledError:
+            # lease lost or agent stopped, the schedule is left for another replay
+            abandoned = True
             raise
 
         finally:
-            events_save = events.Records(
-                run_id=self.run_id,
-                events=ctx.events,
-            )
+            if not abandoned:
+                metadata_save = metadata.Records(
+                    run_id=self.run_id, metadata=metadata_records
+                )
+                # only persist the events produced by this replay
+                await self.backend.commit_replay(
+                    self.queue,
+                    self.run_id,
+                    schedule,
+                    ctx.events[stored_len:],
+                    stored_len,
+                    metadata_save,
+                    next_schedule,
+                )
 
-            metadata_save = metadata.Records(
-                run_id=self.run_id, metadata=metadata_records
-            )
-            await self.backend.write_events(self.run_id, events_save)
-            await self.backend.append_metadata(
-                self.run_id, schedule, metadata_save.to_json()
-            )
-            await self.backend.close_schedule(self.queue, self.run_id, schedule)
+
+def local_schedule(at: datetime) -> datetime:
+    # schedules are naive local datetimes
+    return at.astimezone().replace(tzinfo=None)
 
 
 def execution_has_stopped(records: List[events.Event]):
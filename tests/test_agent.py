@@ -0,0 +1,170 @@
+import asyncio
+from datetime import datetime, timedelta
+import time
+
+import pytest
+
+from substantial.agent import Agent
+from substantial.backends.backend import LocalWatch, Watch
+from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
+from substantial.backends.redis import RedisBackend
+from substantial.conductor import Conductor
+from substantial.workflows.context import Context
+from substantial.workflows.workflow import workflow
+from tests.utils import async_test
+
+
+@async_test
+async def test_agent_concurrency():
+    running, peak = 0, 0
+
+    async def io_bound():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.5)
+        running -= 1
+        return "done"
+
+    @workflow()
+    async def io_workflow(c: Context):
+        return await c.save(io_bound)
+
+    for concurrency, expected_peak in [(50, 50), (4, 4)]:
+        running, peak = 0, 0
+        conductor = Conductor(InMemoryBackend())
+        conductor.register(io_workflow)
+        runs = [await conductor.start(io_workflow) for _ in range(50)]
+
+        start = time.monotonic()
+        agent = conductor.run(concurrency=concurrency)
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*[run.result() for run in runs]), 60
+            )
+        finally:
+            agent.cancel()
+
+        assert results == ["done"] * 50
+        # slots bound the runs in flight (backpressure)
+        assert peak == expected_peak
+        if concurrency == 50:
+            assert time.monotonic() - start < 10
+
+
+@async_test
+async def test_agent_cancelled_replay_kept():
+    @workflow()
+    async def slow_workflow(c: Context):
+        return await c.save(lambda: asyncio.sleep(30))
+
+    backend = InMemoryBackend()
+    conductor = Conductor(backend)
+    conductor.register(slow_workflow)
+    run = await conductor.start(slow_workflow)
+
+    agent = conductor.run()
+    await asyncio.sleep(0.5)
+    agent.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await agent
+
+    # nothing committed, the run is replayed again later
+    assert await backend.read_events(run.run_id) is None
+    assert (await backend.next_run("default", []))[0] == run.run_id
+
+
+@async_test
+async def test_agent_cancelled_wake_up_kept():
+    @workflow()
+    async def sleeping_workflow(c: Context):
+        await c.sleep(timedelta(seconds=0.5))
+        return await c.save(lambda: asyncio.sleep(30))
+
+    backend = InMemoryBackend()
+    conductor = Conductor(backend)
+    conductor.register(sleeping_workflow)
+    run = await conductor.start(sleeping_workflow)
+
+    agent = conductor.run()
+    await asyncio.sleep(2)
+    agent.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await agent
+
+    # the wake-up schedule (no event) outlives the abandoned replay
+    assert (await backend.next_run("default", []))[0] == run.run_id
+
+
+@async_test
+async def test_agent_stop_drains():
+    @workflow()
+    async def draining_workflow(c: Context):
+        return await c.save(lambda: asyncio.sleep(1, "done"))
+
+    backend = InMemoryBackend()
+    conductor = Conductor(backend)
+    conductor.register(draining_workflow)
+    run = await conductor.start(draining_workflow)
+
+    agent = Agent(backend, "default")
+    task = asyncio.create_task(agent.run())
+    await asyncio.sleep(0.5)
+    agent.stop()
+    await asyncio.wait_for(task, 5)
+
+    # the replay in flight was completed, nothing else claimed
+    records = await backend.read_events(run.run_id)
+    assert [event.save.value for event in records.events if event.is_set("save")] == [
+        b'"done"'
+    ]
+    assert not any(event.is_set("stop") for event in records.events)
+
+
+@async_test
+async def test_agent_idle_seconds():
+    backend = InMemoryBackend()
+    agent = Agent(backend, "default")
+
+    # notified of new schedules, it only polls for what is not notified
+    assert await agent.idle_seconds(LocalWatch()) == LocalWatch.poll_seconds
+    assert await agent.idle_seconds(Watch()) == Watch.poll_seconds
+
+    # and wakes up when the next schedule is due
+    await backend.add_schedule("default", "run", datetime.now() + timedelta(1), None)
+    assert await agent.idle_seconds(LocalWatch()) == LocalWatch.poll_seconds
+    await backend.add_schedule(
+        "default", "other", datetime.now() + timedelta(seconds=5), None
+    )
+    assert 4 < await agent.idle_seconds(LocalWatch()) <= 5
+
+
+@async_test
+async def test_agent_send_during_replay(tmp_path):
+    @workflow()
+    async def busy_workflow(c: Context):
+        await c.save(lambda: asyncio.sleep(1))
+        return await c.receive("go")
+
+    backends = [
+        InMemoryBackend(),
+        FSBackend(str(tmp_path / "fs")),
+        RedisBackend(host="localhost", port=6380, password="password"),
+    ]
+    for backend in backends:
+        conductor = Conductor(backend)
+        conductor.register(busy_workflow)
+        run = await conductor.start(busy_workflow)
+
+        agent = conductor.run()
+        try:
+            await asyncio.sleep(0.5)
+            # the schedule of the send is skipped while the replay holds the lease
+            start = time.monotonic()
+            await run.send("go", "now")
+            assert await asyncio.wait_for(run.result(), 10) == "now"
+            # claimed again once the replay ends, not at the next poll
+            assert time.monotonic() - start < 2.5
+        finally:
+            agent.cancel()
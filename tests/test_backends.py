@@ -0,0 +1,162 @@
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import orjson as json
+import pytest
+from substantial.backends.conformance import run_suite
+from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
+from substantial.backends.redis import RedisBackend
+from substantial.backends.sqlite import SQLiteBackend
+from substantial.protos.events import Event, Start
+from substantial.protos.metadata import Records as MetadataRecords
+from tests.utils import async_test
+
+
+@async_test
+async def test_conformance_all_backends(tmp_path):
+    backends = [
+        FSBackend(str(tmp_path / "fs")),
+        RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend(str(tmp_path / "substantial.db")),
+        InMemoryBackend(),
+    ]
+    for backend in backends:
+        report = await run_suite(
+            backend, agents=4, pending=[10, 100], histories=[10, 100], samples=5
+        )
+        assert all(check["ok"] for check in report["checks"].values()), report
+        assert [r["pending"] for r in report["benchmarks"]["schedules"]] == [10, 100]
+        assert json.loads(json.dumps(report)) == report
+
+
+@async_test
+async def test_redis_legacy_leases():
+    backend = RedisBackend(host="localhost", port=6380, password="password")
+    queue, expired, held = f"legacy-{uuid4()}", f"run-{uuid4()}", f"run-{uuid4()}"
+    # leases before native expiry: expiry date as value, no TTL
+    now = datetime.now()
+    await backend.redis.set(backend._key("lease", expired), str(now - timedelta(1)))
+    await backend.redis.set(backend._key("lease", held), str(now + timedelta(1)))
+    await backend.add_schedule(queue, expired, now - timedelta(seconds=2), None)
+    await backend.add_schedule(queue, held, now - timedelta(seconds=1), None)
+
+    active = await backend.active_leases(30)
+    assert held in active and expired not in active
+
+    assert await backend.claim_next(queue, 30) == (expired, now - timedelta(seconds=2))
+    assert await backend.claim_next(queue, 30) is None
+    assert await backend.redis.pttl(backend._key("lease", expired)) > 0
+    assert not await backend.acquire_lease(held, 30)
+
+
+@async_test
+async def test_redis_legacy_schedules():
+    backend = RedisBackend(host="localhost", port=6380, password="password")
+    queue, run_id = f"legacy-{uuid4()}", f"run-{uuid4()}"
+    schedules = [datetime.now() - timedelta(seconds=i) for i in (2, 1)]
+    event = Event(start=Start())
+
+    # as written before the due index, with JSON payloads
+    for schedule, content in zip(schedules, [event.to_json(), ""]):
+        sched_ref = backend._key("ref_", run_id, schedule.isoformat())
+        await backend.redis.zadd(backend._key("schedules", queue), {sched_ref: 0})
+        await backend.redis.zadd(sched_ref, {run_id: schedule.timestamp()})
+        await backend.redis.set(backend._key(schedule.isoformat(), run_id), content)
+
+    assert await backend.queue_depth(queue) == 2
+    assert await backend.next_run(queue, []) == (run_id, schedules[0])
+    assert await backend.read_schedule(queue, run_id, schedules[0]) == event
+    await backend.close_schedule(queue, run_id, schedules[0])
+    assert await backend.claim_next(queue, 30) == (run_id, schedules[1])
+    assert not await backend.redis.exists(backend._key("schedules", queue))
+
+
+@async_test
+async def test_redis_unhashable_options():
+    retry_on_error = [ConnectionError]
+    backends = [
+        RedisBackend(
+            host="localhost",
+            port=6380,
+            password="password",
+            retry_on_error=retry_on_error,
+        )
+        for _ in range(2)
+    ]
+    # shared by the backends given the same options
+    assert backends[0].redis.connection_pool is backends[1].redis.connection_pool
+    assert await backends[0].redis.ping()
+
+    other = RedisBackend(
+        host="localhost", port=6380, password="password", retry_on_error=[]
+    )
+    assert other.redis.connection_pool is not backends[0].redis.connection_pool
+
+
+@async_test
+async def test_fs_commit_replay(tmp_path, monkeypatch):
+    backend = FSBackend(str(tmp_path))
+    start = datetime.now() - timedelta(minutes=1)
+    await backend.add_schedule("q", "run", start, Event(start=Start()))
+
+    # in one I/O job
+    hops = 0
+    io = backend._io
+
+    async def counted(fn, *args):
+        nonlocal hops
+        hops += 1
+        return await io(fn, *args)
+
+    backend._io = counted
+    metadata = MetadataRecords(run_id="run")
+    next_at = start + timedelta(seconds=1)
+    await backend.commit_replay(
+        "q", "run", start, [Event(start=Start())], 0, metadata, (next_at, None)
+    )
+    assert hops == 1
+    assert await backend.next_run("q", []) == ("run", next_at)
+    assert len((await backend.read_events("run")).events) == 1
+
+    # a crash between the add and the close is completed on the next claim
+    remove = backend._remove_schedule
+
+    def crash(queue, run_id, schedule):
+        raise KeyboardInterrupt()
+
+    monkeypatch.setattr(backend, "_remove_schedule", crash)
+    last_at = start + timedelta(seconds=2)
+    with pytest.raises(KeyboardInterrupt):
+        await backend.commit_replay(
+            "q", "run", next_at, [Event(start=Start())], 1, metadata, (last_at, None)
+        )
+    monkeypatch.setattr(backend, "_remove_schedule", remove)
+    other = FSBackend(str(tmp_path))
+    assert await other.next_run("q", []) == ("run", next_at)
+    assert await other.claim_next("q", 10) == ("run", last_at)
+    assert await other.next_run("q", []) == ("run", last_at)
+    assert not (tmp_path / "runs" / "run" / "commit").exists()
+
+    # dropped if its events were not appended, the replay is done again
+    (tmp_path / "runs" / "run" / "commit").write_bytes(
+        f"3 {last_at.isoformat()} - replay q\n".encode()
+    )
+    await other.remove_lease("run", 10)
+    assert await other.claim_next("q", 10) == ("run", last_at)
+    assert not (tmp_path / "runs" / "run" / "commit").exists()
+
+
+@async_test
+async def test_redis_script_flush():
+    backend = RedisBackend(host="localhost", port=6380, password="password")
+    queue, run_id = f"flush-{uuid4()}", f"run-{uuid4()}"
+    at = datetime.now() - timedelta(seconds=1)
+    await backend.add_schedule(queue, run_id, at, None)
+
+    # emptied script cache (e.g. restart or failover), loaded again on NOSCRIPT
+    await backend.redis.script_flush()
+    assert await backend.next_run(queue, []) == (run_id, at)
+    await backend.redis.script_flush()
+    await backend.append_events(run_id, [Event(start=Start())], 0)
+    assert len((await backend.read_events(run_id)).events) == 1
@@ -0,0 +1,65 @@
+import orjson as json
+import pytest
+from substantial.backends.codec import Codec, Compression
+from substantial.protos.events import Event, Records, Save, Stop
+
+
+@pytest.fixture
+def records():
+    big = json.dumps([{"id": i, "value": "lorem ipsum"} for i in range(1000)])
+    return Records(
+        run_id="run",
+        events=[
+            Event(save=Save(1, json.dumps("A"), -1)),
+            Event(save=Save(2, big, -1)),
+            Event(stop=Stop(ok=json.dumps("A"))),
+        ],
+    )
+
+
+def test_legacy_json_still_readable(records):
+    legacy = records.to_json(indent=4).encode()
+    assert Codec().decode(legacy, Records) == records
+    assert Codec(binary=False).encode(records) == records.to_json().encode()
+
+
+def test_binary_roundtrip(records):
+    codec = Codec(compression=None)
+    data = codec.encode(records)
+    assert data[:2] == b"\xff\x01"
+    assert len(data) < len(records.to_json())
+    assert codec.decode(data, Records) == records
+
+
+def test_compression(records):
+    small = Event(save=Save(1, json.dumps("A"), -1))
+    for compression in [
+        Compression(algorithm="zlib"),
+        Compression(algorithm="zlib", dictionary=b'{"id": "value": "lorem ipsum"}'),
+    ]:
+        codec = Codec(compression=compression)
+        assert codec.decode(codec.encode(small), Event) == small
+        assert codec.stats.compressed == 0
+
+        data = codec.encode(records)
+        assert codec.decode(data, Records) == records
+        assert codec.stats.compressed == 1
+        assert codec.stats.ratio > 2
+
+
+def test_zstd_compression(records):
+    pytest.importorskip("zstandard")
+    for compression in [
+        Compression(algorithm="zstd"),
+        Compression(algorithm="zstd", dictionary=b'{"id": "value": "lorem ipsum"}'),
+    ]:
+        codec = Codec(compression=compression)
+        data = codec.encode(records)
+        assert data[:2] == b"\xff\x03"
+        assert codec.decode(data, Records) == records
+        assert codec.stats.ratio > 2
+
+
+def test_zlib_by_default(records):
+    data = Codec(compression=Compression()).encode(records)
+    assert data[:2] == b"\xff\x02"
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+
+from substantial.backends.fs import FSBackend
+from substantial.protos.events import Event, Start
+from tests.utils import async_test
+
+
+@async_test
+async def test_schedule_index(tmp_path):
+    backend = FSBackend(str(tmp_path))
+    start = datetime.now() - timedelta(minutes=1)
+    for i in reversed(range(10)):
+        await backend.add_schedule("q", f"run-{i}", start + timedelta(seconds=i), None)
+
+    assert await backend.next_run("q", []) == ("run-0", start)
+    assert await backend.next_run("q", ["run-0", "run-1"]) == (
+        "run-2",
+        start + timedelta(seconds=2),
+    )
+
+    # another process sees the appends and removals
+    other = FSBackend(str(tmp_path))
+    await backend.close_schedule("q", "run-0", start)
+    assert await other.next_run("q", []) == ("run-1", start + timedelta(seconds=1))
+    await other.close_schedule("q", "run-1", start + timedelta(seconds=1))
+    assert await backend.next_run("q", []) == ("run-2", start + timedelta(seconds=2))
+
+    # compaction keeps only the live entries
+    backend.indexes["q"].compact_min = 0
+    for i in range(2, 8):
+        await backend.close_schedule("q", f"run-{i}", start + timedelta(seconds=i))
+    journal = tmp_path / "indexes" / "q.journal"
+    assert len(journal.read_text().splitlines()) <= 6
+    assert await other.next_run("q", []) == ("run-8", start + timedelta(seconds=8))
+
+    # lost journal lines (crash) are recovered from the schedule files
+    (tmp_path / "schedules" / "q" / start.isoformat()).mkdir(exist_ok=True)
+    (tmp_path / "schedules" / "q" / start.isoformat() / "run-lost").write_bytes(b"")
+    with open(journal, "ab") as f:
+        f.write(b"+ 2000-01-01T00:00:00 torn")
+    assert await FSBackend(str(tmp_path)).next_run("q", []) == ("run-lost", start)
+
+
+@async_test
+async def test_schedule_index_bounded_by_live(tmp_path, monkeypatch):
+    backend = FSBackend(str(tmp_path))
+    start = datetime.now() - timedelta(minutes=1)
+    await backend.add_schedule("q", "kept", start, None)
+    backend.indexes["q"].compact_min = 0
+    for i in range(20):
+        at = start + timedelta(seconds=i + 1)
+        await backend.add_schedule("q", f"run-{i}", at, None)
+        await backend.close_schedule("q", f"run-{i}", at)
+
+    # the directories of the closed schedules are removed with them
+    assert [d.name for d in (tmp_path / "schedules" / "q").iterdir()] == [
+        start.isoformat()
+    ]
+
+    # once recovered, compactions rewrite the live entries without a scan
+    def no_scan(queue_dir):
+        raise AssertionError("scanned")
+
+    monkeypatch.setattr("substantial.backends.fs_index.scan", no_scan)
+    journal = tmp_path / "indexes" / "q.journal"
+    for i in range(20):
+        await backend.add_schedule("q", "run", start + timedelta(seconds=i + 1), None)
+    assert len(journal.read_text().splitlines()) <= 4
+    assert await backend.next_run("q", []) == ("kept", start)
+
+    # a journal rewritten in place (same inode) is replayed from the start
+    monkeypatch.undo()
+    other = FSBackend(str(tmp_path))
+    assert await other.next_run("q", []) == ("kept", start)
+    journal.write_text(f"# other\n+ {start.isoformat()} run\n")
+    (tmp_path / "schedules" / "q" / start.isoformat() / "run").write_bytes(b"")
+    other.indexes["q"].recovered = True
+    assert await other.next_run("q", []) == ("run", start)
+
+
+@async_test
+async def test_run_schedules_coalesce(tmp_path):
+    backend = FSBackend(str(tmp_path))
+    start = datetime.now()
+    for i in range(100):
+        await backend.add_schedule("q", f"other-{i}", start, None)
+
+    await backend.add_schedule("q", "run", start, None)
+    await backend.add_schedule(
+        "q", "run", start + timedelta(seconds=1), Event(start=Start())
+    )
+    await backend.add_schedule("q", "run", start + timedelta(seconds=2), None)
+
+    # earlier replays are fused into the new one, events are kept
+    pending = tmp_path / "runs" / "run" / "schedules" / "q"
+    assert sorted(f.name for f in pending.iterdir()) == [
+        (start + timedelta(seconds=1)).isoformat(),
+        (start + timedelta(seconds=2)).isoformat(),
+    ]
+    assert not (tmp_path / "schedules" / "q" / start.isoformat() / "run").exists()
+    assert (
+        len(list((tmp_path / "schedules" / "q" / start.isoformat()).iterdir())) == 100
+    )
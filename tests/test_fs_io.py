@@ -0,0 +1,95 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+import time
+
+import pytest
+from substantial.backends.fs import FSBackend
+from substantial.backends.fs_io import Durability, Syncer, write_atomic
+
+
+def test_write_atomic(tmp_path):
+    syncer = Syncer(Durability(group_window=None))
+    f = tmp_path / "file"
+    write_atomic(f, b"first", tmp_path, syncer)
+    write_atomic(f, b"second", tmp_path, syncer)
+    assert f.read_bytes() == b"second"
+    assert [p.name for p in tmp_path.iterdir()] == ["file"]
+
+    with pytest.raises(FileExistsError):
+        write_atomic(f, b"third", tmp_path, syncer, exclusive=True)
+    assert f.read_bytes() == b"second"
+    # file + directory of each write (only the file for the failed one)
+    assert syncer.fsyncs == syncer.batches == 5
+
+
+def test_group_commit(tmp_path):
+    syncer = Syncer(Durability(group_window=0.05))
+    writes = 32
+
+    def write(i: int):
+        write_atomic(tmp_path / str(i), str(i).encode(), tmp_path, syncer)
+
+    with ThreadPoolExecutor(max_workers=writes) as pool:
+        list(pool.map(write, range(writes)))
+
+    assert sorted(int(p.read_text()) for p in tmp_path.iterdir()) == list(range(writes))
+    assert syncer.fsyncs == 2 * writes
+    assert syncer.batches < writes
+
+
+def test_fs_io_bounded(tmp_path):
+    backend = FSBackend(str(tmp_path), io_concurrency=2)
+    running, peak, threads = 0, 0, set()
+    lock = threading.Lock()
+    write = backend.write
+
+    def slow_write(f, data, exclusive=False):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+            threads.add(threading.current_thread().name)
+        time.sleep(0.2)  # a slow disk
+        with lock:
+            running -= 1
+        write(f, data, exclusive)
+
+    backend.write = slow_write
+
+    async def main():
+        # the event loop keeps ticking during the slow writes
+        lag = 0.0
+
+        async def tick():
+            nonlocal lag
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.01)
+                lag = max(lag, time.monotonic() - before - 0.01)
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.gather(
+            *[backend.write_workflow_link("w", f"run-{i}") for i in range(8)]
+        )
+        ticker.cancel()
+        return lag
+
+    lag = asyncio.run(main())
+    assert lag < 0.1
+    # on the threads of the backend, at most io_concurrency at once
+    assert peak == 2
+    assert all(name.startswith("substantial-fs") for name in threads)
+
+    # threads do not survive a fork, the child opens its own
+    def child(results):
+        links = asyncio.run(backend.read_workflow_links("w"))
+        results.put(len(links))
+
+    fork = multiprocessing.get_context("fork")
+    results = fork.Queue()
+    process = fork.Process(target=child, args=(results,))
+    process.start()
+    assert results.get(timeout=10) == 8
+    process.join(10)
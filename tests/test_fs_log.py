@@ -0,0 +1,51 @@
+import orjson as json
+import pytest
+from substantial.backends.backend import ConflictError
+from substantial.backends.fs import FSBackend
+from substantial.protos.events import Event, Records, Save
+from tests.utils import async_test
+
+
+def saves(start: int, end: int):
+    return [
+        Event(save=Save(i, json.dumps(f"value {i}"), -1)) for i in range(start, end)
+    ]
+
+
+@async_test
+async def test_segmented_log(tmp_path):
+    backend = FSBackend(str(tmp_path), segment_size=256)
+    for i in range(0, 30, 3):
+        await backend.append_events("run", saves(i, i + 3), i)
+
+    with pytest.raises(ConflictError):
+        await backend.append_events("run", saves(0, 1), 0)
+
+    segments = sorted((tmp_path / "runs" / "run" / "events.log").iterdir())
+    assert len(segments) > 1
+    assert all(int(segment.name) % 3 == 0 for segment in segments)
+    records = await backend.read_events("run")
+    assert records.events == saves(0, 30)
+
+    # a torn append is ignored, the next one starts a new segment
+    tail = segments[-1]
+    with open(tail, "ab") as f:
+        f.write(b"\x00\x00\x01\x00\x01partial")
+    assert (await backend.read_events("run")).events == saves(0, 30)
+    await backend.append_events("run", saves(30, 31), 30)
+    assert (await backend.read_events("run")).events == saves(0, 31)
+
+
+@async_test
+async def test_legacy_segments_migrated(tmp_path):
+    backend = FSBackend(str(tmp_path))
+    legacy = tmp_path / "runs" / "run" / "events.d"
+    legacy.mkdir(parents=True)
+    for offset in [0, 2]:
+        records = Records(run_id="run", events=saves(offset, offset + 2))
+        (legacy / f"{offset:012d}").write_bytes(bytes(records.to_json(), "utf-8"))
+
+    assert (await backend.read_events("run")).events == saves(0, 4)
+    assert not legacy.exists()
+    await backend.append_events("run", saves(4, 5), 4)
+    assert (await backend.read_events("run")).events == saves(0, 5)
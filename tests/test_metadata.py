@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from substantial.backends.backend import Retention
+from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
+from substantial.backends.redis import RedisBackend
+from substantial.backends.sqlite import SQLiteBackend
+from substantial.protos.metadata import Info, Metadata, Records
+from tests.utils import async_test
+
+
+def backends(retention: Retention):
+    return [
+        FSBackend("./logs", retention=retention),
+        RedisBackend(
+            host="localhost", port=6380, password="password", retention=retention
+        ),
+        SQLiteBackend("./logs/substantial.db", retention=retention),
+        InMemoryBackend(retention=retention),
+    ]
+
+
+def entry(run_id: str, i: int) -> Records:
+    return Records(
+        run_id=run_id,
+        metadata=[Metadata(at=datetime.now(timezone.utc), info=Info(message=str(i)))],
+    )
+
+
+@async_test
+async def test_metadata_max_entries():
+    for backend in backends(Retention(max_entries=3)):
+        run_id = f"retention-{uuid4()}"
+        start = datetime.now()
+        for i in range(5):
+            await backend.append_metadata(
+                run_id, start + timedelta(seconds=i), entry(run_id, i)
+            )
+
+        logs = await backend.read_all_metadata(run_id)
+        kept = sorted(log.metadata[0].info.message for log in logs)
+        assert kept == ["2", "3", "4"]
+        assert await backend.read_dropped_metadata(run_id) == 2
+
+
+@async_test
+async def test_metadata_ttl():
+    for backend in backends(Retention(ttl=timedelta(milliseconds=300))):
+        run_id = f"retention-{uuid4()}"
+        start = datetime.now()
+        await backend.append_metadata(run_id, start, entry(run_id, 0))
+        await asyncio.sleep(0.5)
+        await backend.append_metadata(
+            run_id, start + timedelta(seconds=1), entry(run_id, 1)
+        )
+
+        logs = await backend.read_all_metadata(run_id)
+        assert [log.metadata[0].info.message for log in logs] == ["1"]
+        assert await backend.read_dropped_metadata(run_id) == 1
+
+
+@async_test
+async def test_redis_metadata_ttl_refs_pruned():
+    backend = RedisBackend(
+        host="localhost",
+        port=6380,
+        password="password",
+        retention=Retention(ttl=timedelta(milliseconds=200)),
+    )
+    run_id = f"retention-{uuid4()}"
+    start = datetime.now()
+    for i in range(10):
+        await backend.append_metadata(
+            run_id, start + timedelta(seconds=i), entry(run_id, i)
+        )
+    await asyncio.sleep(0.3)
+    await backend.append_metadata(
+        run_id, start + timedelta(seconds=10), entry(run_id, 10)
+    )
+
+    # the refs to the expired entries are dropped without reading them
+    assert await backend.redis.llen(backend._key("runs", run_id, "logs")) == 1
+    assert await backend.read_dropped_metadata(run_id) == 10
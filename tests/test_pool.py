@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+import signal
+
+import pytest
+from substantial.agent import Agent
+from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
+from substantial.conductor import Conductor
+from substantial.pool import AgentPool
+from substantial.workflows.context import Context
+from substantial.workflows.workflow import workflow
+from tests.utils import async_test
+
+
+async def until(condition, timeout: float = 30):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.1)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+@async_test
+async def test_pool_scales_and_restarts(tmp_path):
+    @workflow()
+    async def pooled_workflow(c: Context):
+        return await c.save(lambda: asyncio.sleep(0.5, "done"))
+
+    backend = FSBackend(str(tmp_path))
+    conductor = Conductor(backend)
+    conductor.register(pooled_workflow)
+    runs = [await conductor.start(pooled_workflow) for _ in range(40)]
+
+    pool = AgentPool(backend, min_workers=1, max_workers=3, concurrency=4, interval=0.2)
+    task = asyncio.create_task(pool.run())
+    try:
+        # depth beyond the slots of one worker
+        await until(lambda: len(pool.workers) == 3)
+        # the agents report the runs they replay
+        await until(lambda: sum(v.value for v in pool.in_flight.values()) > 0)
+        results = await asyncio.wait_for(
+            asyncio.gather(*[run.result() for run in runs]), 60
+        )
+        assert results == ["done"] * 40
+
+        # back to min_workers once drained
+        await until(lambda: len(pool.workers) == 1)
+
+        os.kill(pool.workers[0].pid, signal.SIGKILL)
+        await until(lambda: pool.restarts == 1)
+        assert all(worker.is_alive() for worker in pool.workers)
+    finally:
+        workers = list(pool.workers)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    assert not any(worker.is_alive() for worker in workers)
+
+
+def test_pool_process_local():
+    with pytest.raises(ValueError):
+        AgentPool(InMemoryBackend())
+
+
+@async_test
+async def test_pool_keeps_size_on_errors(tmp_path):
+    backend = FSBackend(str(tmp_path))
+    failures = 0
+
+    async def queue_depth(queue):
+        nonlocal failures
+        failures += 1
+        raise ConnectionError("unreachable")
+
+    backend.queue_depth = queue_depth
+    pool = AgentPool(backend, min_workers=1, max_workers=2, interval=0.1)
+    task = asyncio.create_task(pool.run())
+    try:
+        await until(lambda: failures > 3)
+        assert not task.done()
+        assert len(pool.workers) == 0
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+
+@async_test
+async def test_pool_claim_lag(tmp_path):
+    backend = FSBackend(str(tmp_path))
+    pool = AgentPool(
+        backend, min_workers=1, max_workers=4, max_lag=timedelta(seconds=5)
+    )
+    worker = object()
+    pool.workers = [worker]
+    pool.in_flight[worker] = multiprocessing.Value("i", 0)
+    pool.claim_lag[worker] = multiprocessing.Value("d", 0)
+    assert await pool.target() == 1
+
+    # the agents claim the runs too late, one more worker
+    pool.claim_lag[worker].value = 6
+    assert await pool.target() == 2
+
+    # reported by the agents
+    agent = Agent(backend, "default", claim_lag=multiprocessing.Value("d", 0))
+    await backend.add_schedule(
+        "default", "late", datetime.now() - timedelta(seconds=10), None
+    )
+    assert await agent.claim() is not None
+    assert agent.claim_lag.value >= 10
+    assert await agent.claim() is None
+    assert agent.claim_lag.value == 0
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+import orjson as json
+import pytest
+from substantial.backends.backend import ConflictError
+from substantial.backends.conformance import run_suite
+from substantial.protos.events import Event, Save, Send
+from substantial.workflows.context import Context
+from substantial.workflows.workflow import workflow
+from tests.utils import WorkflowTest, async_test
+
+moto_server = pytest.importorskip("moto.server")
+boto3 = pytest.importorskip("boto3")
+
+from substantial.backends.s3 import S3Backend  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def s3():
+    server = moto_server.ThreadedMotoServer(port=5055)
+    server.start()
+    options = dict(
+        endpoint_url="http://localhost:5055",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    boto3.client("s3", **options).create_bucket(Bucket="bucket-test")
+    yield options
+    server.stop()
+
+
+def saves(start: int, end: int):
+    return [
+        Event(save=Save(i, json.dumps(f"value {i}"), -1)) for i in range(start, end)
+    ]
+
+
+@async_test
+async def test_s3_events_and_leases(s3):
+    backend = S3Backend("bucket-test", "events", **s3)
+    assert await backend.read_events("run") is None
+    for i in range(0, 9, 3):
+        await backend.append_events("run", saves(i, i + 3), i)
+    with pytest.raises(ConflictError):
+        await backend.append_events("run", saves(3, 4), 3)
+    assert (await backend.read_events("run")).events == saves(0, 9)
+
+    assert await backend.acquire_lease("run", 30)
+    assert not await backend.acquire_lease("run", 30)
+    assert await backend.active_leases(30) == ["run"]
+    assert await backend.renew_lease("run", 30)
+    await backend.remove_lease("run", 30)
+    assert await backend.active_leases(30) == []
+    assert await backend.acquire_lease("run", 30)
+
+    # only the owner renews or removes it
+    other = S3Backend("bucket-test", "events", **s3)
+    assert not await other.renew_lease("run", 30)
+    await other.remove_lease("run", 30)
+    assert await backend.active_leases(30) == ["run"]
+    assert await backend.renew_lease("run", 30)
+
+
+@async_test
+async def test_s3_schedules(s3):
+    backend = S3Backend("bucket-test", "schedules", **s3)
+    start = datetime.now() - timedelta(minutes=1)
+    event = Event(send=Send(name="event", value=json.dumps(1)))
+    for i in range(3):
+        await backend.add_schedule("q", "a", start + timedelta(seconds=i), None)
+    await backend.add_schedule("q", "a", start + timedelta(seconds=5), event)
+    await backend.add_schedule("q", "b", start + timedelta(seconds=1), None)
+
+    # the replays of a are fused into the latest schedule
+    assert await backend.next_run("q", []) == ("b", start + timedelta(seconds=1))
+    assert await backend.next_run("q", ["b"]) == ("a", start + timedelta(seconds=5))
+    assert await backend.read_schedule("q", "a", start + timedelta(seconds=5)) == event
+    with pytest.raises(Exception):
+        await backend.read_schedule("q", "a", start)
+
+    assert await backend.claim_next("q", 30) == ("b", start + timedelta(seconds=1))
+    assert await backend.claim_next("q", 30) == ("a", start + timedelta(seconds=5))
+    assert await backend.claim_next("q", 30) is None
+
+    await backend.close_schedule("q", "b", start + timedelta(seconds=1))
+    other = S3Backend("bucket-test", "schedules", **s3)
+    assert await other.next_run("q", []) == ("a", start + timedelta(seconds=5))
+
+
+@async_test
+async def test_s3_workflow(s3):
+    @workflow()
+    async def s3_workflow(c: Context):
+        r1 = await c.save(lambda: "A")
+        r2 = await c.save(lambda: f"B {r1}")
+        return r2
+
+    backend = S3Backend("bucket-test", "workflow", **s3)
+    s = await WorkflowTest().step(backend).exec_workflow(s3_workflow, 20)
+    assert s.w_output == "B A"
+
+
+@async_test
+async def test_s3_conformance(s3):
+    backend = S3Backend("bucket-test", "conformance", **s3)
+    report = await run_suite(backend, agents=4, benchmarks=False)
+    assert all(check["ok"] for check in report["checks"].values()), report
+
+
+@async_test
+async def test_s3_update_gives_up(s3, monkeypatch):
+    backend = S3Backend("bucket-test", "conflicts", **s3)
+    await backend.add_schedule("q", "run", datetime.now(), None)
+
+    # e.g. a persistent 412, each write is rejected
+    monkeypatch.setattr("substantial.backends.s3.update_attempts", 3)
+    monkeypatch.setattr(backend, "_put", lambda key, data, **conditions: None)
+    with pytest.raises(ConflictError):
+        await backend.add_schedule("q", "other", datetime.now(), None)
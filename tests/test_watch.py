@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime
+import time
+from uuid import uuid4
+
+from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
+from substantial.backends.redis import RedisBackend
+from substantial.protos.events import Event, Start, Stop
+from tests.utils import async_test
+
+
+async def elapsed(wait) -> float:
+    start = time.monotonic()
+    await wait
+    return time.monotonic() - start
+
+
+@async_test
+async def test_watch_wakeups(tmp_path):
+    backends = [
+        FSBackend(str(tmp_path)),
+        RedisBackend(host="localhost", port=6380, password="password"),
+        InMemoryBackend(),
+    ]
+    for backend in backends:
+        queue, run_id = f"watch-{uuid4()}", f"run-{uuid4()}"
+        schedules = await backend.watch_schedules(queue)
+        events = await backend.watch_events(run_id)
+        try:
+            # changes between reading the state and waiting are not lost
+            await backend.add_schedule(queue, run_id, datetime.now(), None)
+            assert await elapsed(schedules.wait(5)) < 1
+            await backend.append_events(run_id, [Event(start=Start())], 0)
+            assert await elapsed(events.wait(5)) < 1
+
+            # nor those while waiting
+            waiting = asyncio.create_task(elapsed(events.wait(5)))
+            await asyncio.sleep(0.1)
+            await backend.append_events(run_id, [Event(stop=Stop(ok=b"1"))], 1)
+            assert await waiting < 1
+
+            # otherwise it waits for the timeout
+            assert await elapsed(events.wait(0.3)) >= 0.3
+        finally:
+            await schedules.close()
+            await events.close()
+
+
+@async_test
+async def test_redis_watch_idle_past_socket_timeout():
+    backend = RedisBackend(
+        host="localhost", port=6380, password="password", socket_timeout=1
+    )
+    queue = f"watch-{uuid4()}"
+    schedules = await backend.watch_schedules(queue)
+    try:
+        # the pub/sub reader outlives idle periods longer than socket_timeout
+        await asyncio.sleep(2.5)
+        waiting = asyncio.create_task(elapsed(schedules.wait(5)))
+        await asyncio.sleep(0.1)
+        await backend.add_schedule(queue, f"run-{uuid4()}", datetime.now(), None)
+        assert await waiting < 1
+    finally:
+        await schedules.close()
@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass
 from datetime import timedelta, datetime
 import orjson as json
@@ -5,7 +6,10 @@ from typing import List
 import pytest
 from substantial.backends.backend import Backend
 from substantial.backends.fs import FSBackend
+from substantial.backends.memory import InMemoryBackend
 from substantial.backends.redis import RedisBackend
+from substantial.backends.sqlite import SQLiteBackend
+from substantial.conductor import Conductor
 
 from substantial.types import RetryStrategy
 from substantial.workflows.workflow import workflow
@@ -41,6 +45,8 @@ async def test_simple_all_backends(t: WorkflowTest):
     backends = [
         FSBackend("./logs"),
         RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend("./logs/substantial.db"),
+        InMemoryBackend(),
     ]
     for backend in backends:
         s = await t.step(backend).exec_workflow(simple_workflow, 20)
@@ -81,6 +87,8 @@ async def test_failing_workflow_with_retry(t: WorkflowTest):
     backends = [
         FSBackend("./logs"),
         RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend("./logs/substantial.db"),
+        InMemoryBackend(),
     ]
     for backend in backends:
         s = t.step(backend)
@@ -117,6 +125,8 @@ async def test_events_with_sleep(t: WorkflowTest):
     backends: List[Backend] = [
         FSBackend("./logs"),
         RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend("./logs/substantial.db"),
+        InMemoryBackend(),
     ]
     for backend in backends:
         s = t.step(backend)
@@ -167,6 +177,8 @@ async def test_utils_methods(t: WorkflowTest, utils_state):
     backends = [
         FSBackend("./logs"),
         RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend("./logs/substantial.db"),
+        InMemoryBackend(),
     ]
 
     for backend in backends:
@@ -225,9 +237,64 @@ async def test_banking_compensation(t: WorkflowTest, account_balance):
     backends = [
         FSBackend("./logs"),
         RedisBackend(host="localhost", port=6380, password="password"),
+        SQLiteBackend("./logs/substantial.db"),
+        InMemoryBackend(),
     ]
 
     for backend in backends:
         s = t.step(backend)
         with pytest.raises(Exception) as _:
             s = await s.exec_workflow(banking_workflow)
+
+
+@async_test
+async def test_sleep_replayed_once_at_end():
+    @workflow()
+    async def long_sleep_workflow(c: Context):
+        await c.sleep(timedelta(hours=1))
+        return "woke up"
+
+    backend = InMemoryBackend()
+    conductor = Conductor(backend)
+    conductor.register(long_sleep_workflow)
+    run = await conductor.start(long_sleep_workflow)
+
+    _, schedule = await backend.next_run("default", [])
+    await run.replay(schedule)
+
+    # no replay before the end of the sleep, then exactly at it
+    assert await backend.next_run("default", []) is None
+    end = await backend.next_due("default")
+    assert abs(end - (datetime.now() + timedelta(hours=1))) < timedelta(seconds=5)
+
+    # an early replay does not move it
+    await run.replay(end)
+    assert await backend.next_due("default") == end
+
+
+@async_test
+async def test_receive_parked_until_send():
+    @workflow()
+    async def approval_workflow(c: Context):
+        approved = await c.receive("approve")
+        try:
+            await c.receive("comment", timeout=timedelta(seconds=1))
+        except TimeoutError:
+            return f"approved by {approved}"
+
+    backend = InMemoryBackend()
+    conductor = Conductor(backend)
+    conductor.register(approval_workflow)
+    run = await conductor.start(approval_workflow)
+
+    agent = conductor.run()
+    try:
+        await asyncio.sleep(1)
+        # parked: nothing to replay until a send
+        assert await backend.next_run("default", []) is None
+        assert await backend.next_due("default") is None
+
+        await run.send("approve", "alice")
+        assert await asyncio.wait_for(run.result(), 10) == "approved by alice"
+    finally:
+        agent.cancel()